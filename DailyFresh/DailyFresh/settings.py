@@ -68,6 +68,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                # 全部商品分类
+                'apps.goods.context_processors.goods_types',
             ],
         },
     },
@@ -184,8 +186,8 @@ HAYSTACK_CONNECTIONS = {
         'PATH': os.path.join(BASE_DIR, 'whoosh_index'),
     }
 }
-# 当修改数据时，自动生成索引
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+# 当修改数据时，放入队列由celery任务批量更新索引
+HAYSTACK_SIGNAL_PROCESSOR = 'apps.goods.search_queue.QueuedSignalProcessor'
 # 指定搜索结果每页显示10条信息
 HAYSTACK_SEARCH_RESULTS_PER_PAGE = 10
 
@@ -208,9 +210,9 @@ EMAIL_FROM = '' #发件人邮箱
 # 支付宝配置
 ALIPAY_APP_ID = '沙箱app id'
 # 支付包网站回调url地址
-ALIPAY_APP_NOTIFY_URL = None
+ALIPAY_APP_NOTIFY_URL = 'http://127.0.0.1:8000/order/notify/'
 # 支付宝同步return_url地址
-ALIPAY_APP_RETURN_URL = ''
+ALIPAY_APP_RETURN_URL = 'http://127.0.0.1:8000/order/check/'
 # 网站私钥文件路径
 APP_PRIVATE_KEY_PATH = os.path.join(BASE_DIR, 'apps/order/app_private_key.pem')
 # 支付宝公钥文件路径
@@ -218,4 +220,95 @@ ALIPAY_PUBLIC_KEY_PATH = os.path.join(BASE_DIR, 'apps/order/alipay_public_key.pe
 # 支付宝的开发模式
 ALIPAY_DEBUG = True
 # 支付宝沙箱支付网关地址
-ALIPAY_GATEWAY_URL = 'https://openapi.alipaydev.com/gateway.do?'
\ No newline at end of file
+ALIPAY_GATEWAY_URL = 'https://openapi.alipaydev.com/gateway.do?'
+# 使用本地模拟的支付网关,不访问支付宝,用于离线测试
+ALIPAY_FAKE_GATEWAY = False
+# 模拟网关交易查询接口的延迟(秒)
+ALIPAY_FAKE_LATENCY = 0
+
+# 下单时的库存并发控制策略
+# pessimistic: 悲观锁  optimistic: 乐观锁  redis: redis预扣库存
+ORDER_COMMIT_STRATEGY = 'optimistic'
+# 乐观锁冲突时的重试次数
+ORDER_OPTIMISTIC_RETRIES = 3
+# 乐观锁重试的退避基数(秒),第i次重试随机等待0~ORDER_OPTIMISTIC_BACKOFF*2^i秒
+ORDER_OPTIMISTIC_BACKOFF = 0.01
+
+# 是否异步下单,开启后下单请求放入redis队列,由celery worker批量创建订单
+ORDER_COMMIT_ASYNC = False
+# worker每批处理的下单请求数
+ORDER_INTAKE_BATCH_SIZE = 50
+# 下单结果的保存时间(秒)
+ORDER_TICKET_EXPIRES = 3600
+
+# 订单id生成器的服务器编号(0~99),多台服务器部署时每台需要不同的编号,None表示使用环境变量DF_SERVER_ID或0
+ORDER_ID_SERVER_ID = None
+
+# 在线支付订单的支付超时时间(秒),超时未支付的订单自动关闭并归还库存
+ORDER_PAY_TIMEOUT = 30 * 60
+# 每批关闭的超时订单数
+ORDER_EXPIRE_BATCH_SIZE = 500
+
+# 支付对账每批查询的订单数
+PAY_RECONCILE_CHUNK_SIZE = 500
+# 支付对账并发调用交易查询接口的线程数
+PAY_RECONCILE_WORKERS = 16
+
+# 幂等key及第一次请求结果的保存时间(秒)
+IDEMPOTENCY_KEY_TTL = 24 * 3600
+# 第一次请求处理中标记的有效时间(秒),与请求超时时间相当,进程中途退出时到期后允许重试
+IDEMPOTENCY_PENDING_TTL = 60
+
+# 提交订单页面价格快照的有效时间(秒)
+ORDER_SNAPSHOT_EXPIRES = 15 * 60
+
+# 商品详情页每页评论数
+GOODS_REVIEW_PAGE_SIZE = 10
+# 商品第一页评论缓存的有效时间(秒),写入评论时会主动刷新
+GOODS_REVIEW_CACHE_TIMEOUT = 3600
+
+# 商品详情页数据缓存的有效时间(秒),商品数据修改时会通过版本号主动失效
+GOODS_DETAIL_CACHE_TIMEOUT = 24 * 3600
+
+# 首页各部分数据缓存的有效时间(秒),修改数据时会通过版本号主动失效
+INDEX_SECTION_TIMEOUT = 3600
+# 首页各部分数据过期后继续保留旧数据的时间(秒),重新生成完成前返回旧数据
+INDEX_SECTION_STALE_TIMEOUT = 24 * 3600
+
+# 缓存过期时间的随机抖动比例
+CACHE_TTL_JITTER = 0.1
+# 重新生成缓存时锁的有效时间(秒)
+CACHE_REBUILD_LOCK_TIMEOUT = 10
+# 缓存不存在时等待其他请求生成的最长时间(秒)
+CACHE_REBUILD_WAIT = 2
+
+# 静态首页的静默期(秒),最后一次修改首页数据后经过该时间才重新生成
+STATIC_INDEX_DEBOUNCE = 5
+
+# 商品列表页种类商品总数缓存的有效时间(秒)
+GOODS_LIST_COUNT_TIMEOUT = 300
+
+# 进程内缓存的商品分类检查版本的间隔(秒),后台修改分类时会通过redis发布订阅立即失效
+GOODS_TYPES_LOCAL_TTL = 60
+
+# 每批写入搜索索引的商品数
+SEARCH_INDEX_BATCH_SIZE = 200
+
+# 进程内商品搜索索引的快照文件
+NGRAM_SNAPSHOT_PATH = os.path.join(BASE_DIR, 'ngram_index.pickle')
+# 进程内商品搜索索引应用修改记录的间隔(秒)
+NGRAM_SYNC_INTERVAL = 2
+# 进程内商品搜索索引中已删除的文档超过该比例时重新生成快照
+NGRAM_COMPACT_RATIO = 0.2
+# uwsgi主进程加载应用时预先加载搜索索引,fork出的工作进程共享同一份内存
+NGRAM_SEARCH_PRELOAD = False
+
+# 每个搜索关键字缓存的最多商品数
+SEARCH_RESULT_LIMIT = 1000
+# 搜索结果缓存的有效时间(秒),写入搜索索引时会通过版本号主动失效
+SEARCH_RESULT_CACHE_TIMEOUT = 600
+
+# 搜索结果按价格筛选的区间边界(元)
+SEARCH_PRICE_BANDS = [10, 20, 50, 100]
+# 进程内搜索筛选位图应用修改记录的间隔(秒)
+FACET_SYNC_INTERVAL = 2
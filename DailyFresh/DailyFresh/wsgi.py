@@ -14,3 +14,13 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'DailyFresh.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings
+
+if settings.NGRAM_SEARCH_PRELOAD:
+    # 在uwsgi主进程中加载搜索索引,工作进程fork后以写时复制的方式共享
+    from DailyFresh.apps.goods import ngram_search
+    ngram_search.get_index(wait=True)
+    # 工作进程不能共用主进程的数据库连接
+    from django import db
+    db.connections.close_all()
@@ -1,3 +1,5 @@
 import pymysql as pymysql
 
-pymysql.install_as_MySQLdb()
\ No newline at end of file
+pymysql.install_as_MySQLdb()
+
+default_app_config = 'apps.apps.DailyfreshConfig'
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class DailyfreshConfig(AppConfig):
     name = 'apps'
+
+    def ready(self):
+        # 注册信号处理函数
+        from DailyFresh.apps.goods import detail, facets, index_data, list_index, reviews  # noqa
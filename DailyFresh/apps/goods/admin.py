@@ -1,6 +1,7 @@
 from django.contrib import admin
-from django.core.cache import cache
 
+from DailyFresh.apps.goods import index_data, static_index
+from DailyFresh.apps.goods.context_processors import invalidate_goods_types
 from DailyFresh.apps.goods.models import GoodsType, IndexGoodsBanner, IndexTypeGoodsBanner, IndexPromotionBanner
 
 
@@ -10,42 +11,65 @@ class BaseModelAdmin(admin.ModelAdmin):
         # 调用ModelAdmin中save_model来实现更新或新增
         super(BaseModelAdmin, self).save_model(request, obj, form, change)
 
-        # 附加操作,发出生成静态首页的任务
-        from DailyFresh.celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()
+        # 只让首页中修改的部分失效,需要在生成静态首页之前
+        index_data.invalidate(*self.index_sections(obj, form))
 
-        # 清除首页缓存
-        cache.delete('index_page_data')
+        # 附加操作,登记重新生成静态首页,短时间内的多次修改只生成一次
+        static_index.request_render()
 
     def delete_model(self, request, obj):
         """删除数据时调用"""
         # 调用ModelAdmin中的delete_model来实现删除操作
         super(BaseModelAdmin, self).delete_model(request, obj)
 
-        from DailyFresh.celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()
+        index_data.invalidate(*self.index_sections(obj))
 
-        cache.delete('index_page_data')
+        static_index.request_render()
+
+    def index_sections(self, obj, form=None):
+        """obj修改后需要重新生成的首页部分"""
+        return []
 
 
 class GoodsTypeAdmin(BaseModelAdmin):
     """商品种类模型Admin管理类"""
-    pass
+
+    def save_model(self, request, obj, form, change):
+        super(GoodsTypeAdmin, self).save_model(request, obj, form, change)
+        # 通知所有进程更新商品分类菜单
+        invalidate_goods_types()
+
+    def delete_model(self, request, obj):
+        super(GoodsTypeAdmin, self).delete_model(request, obj)
+        invalidate_goods_types()
+
+    def index_sections(self, obj, form=None):
+        return [index_data.TYPES, index_data.category_section(obj.id)]
 
 
 class IndexGoodsBannerAdmin(BaseModelAdmin):
     """首页轮播商品模型admin管理类"""
-    pass
+
+    def index_sections(self, obj, form=None):
+        return [index_data.BANNER]
 
 
 class IndexTypeGoodsBannerAdmin(BaseModelAdmin):
     """首页分类商品展示模型admin管理类"""
-    pass
+
+    def index_sections(self, obj, form=None):
+        sections = [index_data.category_section(obj.category_id)]
+        # 修改了所属种类时原来的种类也需要重新生成
+        if form is not None and 'category' in form.changed_data and form.initial.get('category'):
+            sections.append(index_data.category_section(int(form.initial['category'])))
+        return sections
 
 
 class IndexPromotionBannerAdmin(BaseModelAdmin):
     """首页促销活动admin管理类"""
-    pass
+
+    def index_sections(self, obj, form=None):
+        return [index_data.PROMOTION]
 
 admin.site.register(GoodsType, GoodsTypeAdmin)
 admin.site.register(IndexGoodsBanner, IndexGoodsBannerAdmin)
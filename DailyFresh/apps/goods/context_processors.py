@@ -0,0 +1,110 @@
+import logging
+import os
+import threading
+import time
+
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods.models import GoodsType
+
+"""
+商品分类菜单
+base_detail.html等页面都需要展示全部商品分类,由模板上下文处理器统一提供types,
+分类数据缓存在进程内存中,不需要每个请求查询数据库:
+    缓存超过GOODS_TYPES_LOCAL_TTL秒后读取redis中的版本,版本没有变化时继续使用,否则重新查询
+    后台修改商品分类后增加版本并发布到goods_types_changed频道,
+    每个进程中的监听线程收到消息后立即使本进程的缓存失效
+goods_types_version: 商品分类的版本
+"""
+
+logger = logging.getLogger(__name__)
+
+TYPES_VERSION_KEY = 'goods_types_version'
+TYPES_CHANNEL = 'goods_types_changed'
+
+_lock = threading.Lock()
+_cache = {
+    'types': None,
+    'version': None,
+    # 缓存需要检查版本的时间
+    'check_at': 0,
+    # 收到的修改通知数,读取版本期间收到通知时不延长缓存
+    'generation': 0,
+    # 启动监听线程的进程id,fork之后需要在子进程中重新启动
+    'listener_pid': None,
+}
+
+
+def invalidate_goods_types():
+    """商品分类修改后增加版本,事务提交后通知所有进程"""
+    def publish():
+        conn = get_redis_connection('default')
+        version = conn.incr(TYPES_VERSION_KEY)
+        conn.publish(TYPES_CHANNEL, version)
+
+    transaction.on_commit(publish)
+
+
+def expire_local_cache():
+    _cache['generation'] += 1
+    _cache['check_at'] = 0
+
+
+def listen():
+    """监听商品分类的修改,连接断开时重新订阅"""
+    while True:
+        try:
+            pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(TYPES_CHANNEL)
+            # 订阅之前可能已经错过了消息
+            expire_local_cache()
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    expire_local_cache()
+        except Exception:
+            logger.exception('商品分类修改的订阅断开')
+            time.sleep(1)
+
+
+def start_listener():
+    if _cache['listener_pid'] == os.getpid():
+        return
+    with _lock:
+        if _cache['listener_pid'] == os.getpid():
+            return
+        thread = threading.Thread(target=listen, name='goods-types-listener')
+        thread.daemon = True
+        thread.start()
+        _cache['listener_pid'] = os.getpid()
+
+
+def get_goods_types():
+    """获取全部商品分类,优先使用进程内的缓存"""
+    start_listener()
+    if _cache['types'] is not None and time.time() < _cache['check_at']:
+        return _cache['types']
+
+    with _lock:
+        now = time.time()
+        if _cache['types'] is not None and now < _cache['check_at']:
+            return _cache['types']
+        generation = _cache['generation']
+        version = get_redis_connection('default').get(TYPES_VERSION_KEY)
+        if _cache['types'] is None or version != _cache['version']:
+            _cache['types'] = [{
+                'id': t.id,
+                'name': t.name,
+                'logo': t.logo,
+                'image_url': t.image.url,
+            } for t in GoodsType.objects.all()]
+            _cache['version'] = version
+        if _cache['generation'] == generation:
+            _cache['check_at'] = now + settings.GOODS_TYPES_LOCAL_TTL
+        return _cache['types']
+
+
+def goods_types(request):
+    """模板上下文处理器,提供全部商品分类types"""
+    return {'types': get_goods_types()}
@@ -0,0 +1,133 @@
+import json
+
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods.models import GoodsType, GoodsSKU, Goods, GoodsImage
+
+"""
+商品详情页数据缓存
+详情页中除购物车条目数和浏览记录外的内容对每个商品都是相同的,生成一次后以json保存在redis中
+goods_detail_商品id: 详情页数据 {versions: [...], sku: {...}, same_spu_skus: [...], new_skus: [...]}
+goods_detail_version: 数据版本 {sku:商品id, goods:SPU id, type:种类id}
+商品、SPU、商品图片、商品种类保存或删除时增加对应的版本,读取缓存时版本不一致即重新生成
+    商品修改了SPU或种类、图片修改了商品时,修改前后的版本都增加
+"""
+
+DETAIL_KEY = 'goods_detail_%d'
+DETAIL_VERSION_KEY = 'goods_detail_version'
+
+
+def version_fields(sku_id, goods_id, category_id):
+    """详情页数据依赖的版本"""
+    return ['sku:%d' % sku_id, 'goods:%d' % goods_id, 'type:%d' % category_id]
+
+
+def bump_versions(*fields):
+    """增加版本,使依赖这些数据的详情页缓存失效"""
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    for field in fields:
+        pipe.hincrby(DETAIL_VERSION_KEY, field)
+    pipe.execute()
+
+
+def sku_card(sku):
+    """同一SPU的其他规格、新品推荐中展示的商品信息"""
+    return {'id': sku.id, 'name': sku.name, 'price': str(sku.price), 'image_url': sku.image.url}
+
+
+def build_detail_payload(sku_id, conn=None):
+    """查询数据库生成详情页数据并写入缓存,商品不存在返回None"""
+    conn = conn or get_redis_connection('default')
+    try:
+        sku = GoodsSKU.objects.select_related('goods', 'category').get(id=sku_id)
+    except GoodsSKU.DoesNotExist:
+        return None
+
+    # 先读取版本再查询数据,查询期间数据被修改时缓存的版本较旧,下次读取会重新生成
+    fields = version_fields(sku.id, sku.goods_id, sku.category_id)
+    versions = conn.hmget(DETAIL_VERSION_KEY, fields)
+
+    payload = {
+        'versions': [int(v or 0) for v in versions],
+        'sku': {
+            'id': sku.id,
+            'name': sku.name,
+            'desc': sku.desc,
+            'price': str(sku.price),
+            'unite': sku.unite,
+            'image_url': sku.image.url,
+            'category_id': sku.category_id,
+            'category_name': sku.category.name,
+            'goods_id': sku.goods_id,
+            'detail': sku.goods.detail,
+        },
+        # 获取同一SPU的其他规格商品
+        'same_spu_skus': [sku_card(s) for s in GoodsSKU.objects.filter(goods_id=sku.goods_id).exclude(id=sku.id)],
+        # 获取同一种类的新品信息
+        'new_skus': [sku_card(s) for s in
+                     GoodsSKU.objects.filter(category_id=sku.category_id).order_by('-created_time')[:2]],
+    }
+    conn.set(DETAIL_KEY % sku.id, json.dumps(payload), ex=settings.GOODS_DETAIL_CACHE_TIMEOUT)
+    return payload
+
+
+def get_detail_payload(sku_id, conn=None):
+    """获取商品详情页数据,缓存不存在或版本不一致时重新生成,商品不存在返回None"""
+    conn = conn or get_redis_connection('default')
+    payload = conn.get(DETAIL_KEY % sku_id)
+    if payload is not None:
+        payload = json.loads(payload.decode())
+        sku = payload['sku']
+        versions = conn.hmget(DETAIL_VERSION_KEY, version_fields(sku['id'], sku['goods_id'], sku['category_id']))
+        if [int(v or 0) for v in versions] == payload['versions']:
+            return payload
+    return build_detail_payload(sku_id, conn)
+
+
+def saved_fields(sender, instance, fields):
+    """保存前数据库中的外键值,新建的对象返回None"""
+    if instance.pk is None:
+        return None
+    return sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+
+
+@receiver(pre_save, sender=GoodsSKU)
+def remember_sku_relations(sender, instance, **kwargs):
+    # 修改前的SPU和种类,它们的同规格商品和新品推荐中同样包含该商品
+    old = saved_fields(sender, instance, ['goods_id', 'category_id'])
+    instance._old_version_fields = ['goods:%d' % old[0], 'type:%d' % old[1]] if old else []
+
+
+@receiver([post_save, post_delete], sender=GoodsSKU)
+def on_sku_changed(sender, instance, **kwargs):
+    # 同一SPU的其他规格和同一种类的新品推荐同样需要更新
+    fields = ['sku:%d' % instance.id, 'goods:%d' % instance.goods_id, 'type:%d' % instance.category_id]
+    fields += [field for field in getattr(instance, '_old_version_fields', []) if field not in fields]
+    bump_versions(*fields)
+
+
+@receiver([post_save, post_delete], sender=Goods)
+def on_goods_changed(sender, instance, **kwargs):
+    bump_versions('goods:%d' % instance.id)
+
+
+@receiver(pre_save, sender=GoodsImage)
+def remember_image_sku(sender, instance, **kwargs):
+    old = saved_fields(sender, instance, ['sku_id'])
+    instance._old_version_fields = ['sku:%d' % old[0]] if old else []
+
+
+@receiver([post_save, post_delete], sender=GoodsImage)
+def on_image_changed(sender, instance, **kwargs):
+    fields = ['sku:%d' % instance.sku_id]
+    fields += [field for field in getattr(instance, '_old_version_fields', []) if field not in fields]
+    bump_versions(*fields)
+
+
+@receiver([post_save, post_delete], sender=GoodsType)
+def on_type_changed(sender, instance, **kwargs):
+    bump_versions('type:%d' % instance.id)
@@ -0,0 +1,276 @@
+import bisect
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods.models import GoodsSKU
+from DailyFresh.utils.background import PeriodicThread
+
+"""
+搜索结果的分面筛选(商品种类、价格区间、是否有货)
+每个筛选项对应一个以商品id为位序号的位图(python的int),全部位图保存在进程内存中,
+    搜索结果的商品id同样转为位图,与筛选项的位图按位与即可得到筛选结果和每个筛选项的商品数,不需要查询数据库
+进程第一次使用时启动后台线程从数据库生成位图,之后由同一个线程按照redis stream facet_change_stream中的商品修改记录增量更新:
+    重新查询修改过的商品,从全部位图中清除这些商品后再按照最新的种类、价格、库存置位
+    请求中只读取当前的位图,位图生成之前只查询本次搜索结果中的商品进行筛选
+facet_change_stream: 种类、价格、库存可能变化的商品 {sku_id: 商品id}
+    商品保存、删除时,以及批量修改库存的decrement_stock在事务提交后写入
+"""
+
+logger = logging.getLogger(__name__)
+
+FACET_STREAM_KEY = 'facet_change_stream'
+# stream中最多保留的修改记录数
+FACET_STREAM_MAXLEN = 100000
+
+# 筛选项分组,同一组内的筛选项互斥
+GROUPS = ('category', 'price', 'stock')
+
+
+def price_band(price):
+    """价格所在的区间序号,区间边界见settings.SEARCH_PRICE_BANDS"""
+    return bisect.bisect_right(settings.SEARCH_PRICE_BANDS, price)
+
+
+def band_label(band):
+    bands = settings.SEARCH_PRICE_BANDS
+    if band == 0:
+        return '%s元以下' % bands[0]
+    if band == len(bands):
+        return '%s元以上' % bands[-1]
+    return '%s-%s元' % (bands[band - 1], bands[band])
+
+
+def facet_of(category_id, price, stock):
+    """商品所属的筛选项 {分组: 筛选项}"""
+    return {'category': category_id, 'price': price_band(price), 'stock': int(stock > 0)}
+
+
+def set_bit(buf, sku_id):
+    """在bytearray中置位,长度不够时扩展"""
+    i = sku_id >> 3
+    if i >= len(buf):
+        buf.extend(bytes(i - len(buf) + 1))
+    buf[i] |= 1 << (sku_id & 7)
+
+
+def to_bitmap(sku_ids):
+    """商品id转为位图,先在bytearray中置位再一次转换为int"""
+    buf = bytearray()
+    for sku_id in sku_ids:
+        set_bit(buf, sku_id)
+    return int.from_bytes(bytes(buf), 'little')
+
+
+if hasattr(int, 'bit_count'):
+    # python3.10以上
+    def popcount(bits):
+        return bits.bit_count()
+else:
+    def popcount(bits):
+        return bin(bits).count('1')
+
+
+def load_bits(bitmaps, rows):
+    """rows为[(商品id, 种类id, 价格, 库存)],先在每个筛选项的bytearray中置位,最后只转换一次位图"""
+    buffers = {}
+    for sku_id, category_id, price, stock in rows:
+        for group, value in facet_of(category_id, price, stock).items():
+            set_bit(buffers.setdefault((group, value), bytearray()), sku_id)
+    for key, buf in buffers.items():
+        bitmaps[key] = bitmaps.get(key, 0) | int.from_bytes(bytes(buf), 'little')
+
+
+def clear_bits(bitmaps, sku_ids):
+    """从全部位图中清除商品"""
+    mask = to_bitmap(sku_ids)
+    for key in list(bitmaps):
+        bits = bitmaps[key] & ~mask
+        if bits:
+            bitmaps[key] = bits
+        else:
+            del bitmaps[key]
+
+
+class FacetIndex(object):
+    """
+    全部筛选项的位图
+    修改时在副本上修改,完成后整体替换self.bitmaps,查询的线程不加锁也不会读到修改到一半的字典
+    """
+
+    def __init__(self):
+        # {(分组, 筛选项): 位图}
+        self.bitmaps = {}
+        # 已经应用到的修改记录id
+        self.feed_id = '0-0'
+
+    def load(self, rows):
+        bitmaps = dict(self.bitmaps)
+        load_bits(bitmaps, rows)
+        self.bitmaps = bitmaps
+
+    def apply_changes(self, conn, count=1000):
+        """应用stream中新的修改记录,返回应用的记录数,查询数据库失败时不修改位图和stream的位置"""
+        applied = 0
+        while True:
+            entries = conn.xread({FACET_STREAM_KEY: self.feed_id}, count=count)
+            if not entries:
+                return applied
+            _, messages = entries[0]
+            sku_ids = set(int(fields[b'sku_id']) for _, fields in messages)
+            rows = list(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'category_id', 'price', 'stock'))
+            bitmaps = dict(self.bitmaps)
+            # 已经删除的商品只清除
+            clear_bits(bitmaps, sku_ids)
+            load_bits(bitmaps, rows)
+            self.bitmaps = bitmaps
+            self.feed_id = messages[-1][0].decode()
+            applied += len(messages)
+
+    def sync(self, conn=None):
+        """应用新的修改记录,失败时继续使用当前的位图"""
+        try:
+            return self.apply_changes(conn or get_redis_connection('default'))
+        except Exception:
+            logger.exception('同步搜索筛选位图失败')
+            return 0
+
+    def filter(self, sku_ids, selected):
+        """
+        筛选搜索结果,selected为{分组: 筛选项}
+        返回(筛选后保持原顺序的商品id, {分组: {筛选项: 商品数}}),
+        每组的商品数按照其他分组已选的筛选项计算,切换同组的筛选项时数量不变
+        """
+        # 同步线程会整体替换位图字典,只读取一次引用
+        bitmaps = self.bitmaps
+        hits = to_bitmap(sku_ids)
+        group_bits = {}
+        for group, value in selected.items():
+            group_bits[group] = bitmaps.get((group, value), 0)
+
+        counts = dict((group, {}) for group in GROUPS)
+        for group in GROUPS:
+            base = hits
+            for other, bits in group_bits.items():
+                if other != group:
+                    base &= bits
+            for (key_group, value), bits in bitmaps.items():
+                if key_group == group:
+                    count = popcount(bits & base)
+                    if count:
+                        counts[group][value] = count
+
+        matched = hits
+        for bits in group_bits.values():
+            matched &= bits
+        if matched == hits:
+            return list(sku_ids), counts
+        buf = matched.to_bytes(matched.bit_length() // 8 + 1, 'little')
+        result = [sku_id for sku_id in sku_ids if sku_id >> 3 < len(buf) and buf[sku_id >> 3] >> (sku_id & 7) & 1]
+        return result, counts
+
+
+def record_changes(sku_ids, conn=None):
+    """登记种类、价格、库存可能变化的商品"""
+    conn = conn or get_redis_connection('default')
+    pipe = conn.pipeline()
+    for sku_id in sku_ids:
+        pipe.xadd(FACET_STREAM_KEY, {'sku_id': sku_id}, maxlen=FACET_STREAM_MAXLEN, approximate=True)
+    pipe.execute()
+
+
+def record_changes_on_commit(sku_ids):
+    sku_ids = list(sku_ids)
+    transaction.on_commit(lambda: record_changes(sku_ids))
+
+
+def build_from_db(chunk_size=5000, conn=None):
+    conn = conn or get_redis_connection('default')
+    # 先记录stream的位置再读取数据库,读取期间的修改会在之后重新应用
+    last = conn.xrevrange(FACET_STREAM_KEY, count=1)
+    index = FacetIndex()
+    index.feed_id = last[0][0].decode() if last else '0-0'
+    index.load(GoodsSKU.objects.values_list('id', 'category_id', 'price', 'stock').iterator(chunk_size=chunk_size))
+    return index
+
+
+_state = {
+    'index': None,
+}
+
+
+def refresh():
+    """第一次调用时从数据库生成位图,之后应用新的修改记录,在后台线程中每FACET_SYNC_INTERVAL秒调用一次"""
+    index = _state['index']
+    if index is None:
+        index = build_from_db()
+        index.sync()
+        _state['index'] = index
+    else:
+        index.sync()
+
+
+_refresher = PeriodicThread('facet-index-refresher', refresh, lambda: settings.FACET_SYNC_INTERVAL)
+
+
+def get_index():
+    """本进程的筛选位图,尚未生成完成时返回None,生成和同步都在后台线程中进行"""
+    _refresher.ensure_started()
+    return _state['index']
+
+
+def filter_results(sku_ids, selected):
+    """筛选搜索结果,参数和返回值同FacetIndex.filter"""
+    index = get_index()
+    if index is None:
+        # 位图生成之前,只查询搜索结果中的商品生成临时的位图
+        index = FacetIndex()
+        index.load(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'category_id', 'price', 'stock'))
+    return index.filter(sku_ids, selected)
+
+
+def parse_selected(params):
+    """从请求参数中解析已选的筛选项,格式错误的参数忽略"""
+    selected = {}
+    for group in GROUPS:
+        value = params.get(group, '')
+        if value.isdigit():
+            selected[group] = int(value)
+    return selected
+
+
+def filter_params(selected, group=None, value=None):
+    """链接中的筛选参数,将group分组替换为value,value为None时去掉该分组"""
+    selected = dict(selected)
+    selected.pop(group, None)
+    if value is not None:
+        selected[group] = value
+    return ''.join('&%s=%d' % (g, selected[g]) for g in GROUPS if g in selected)
+
+
+def facet_options(counts, selected, types):
+    """模板中展示的筛选项,types为全部商品分类,再次点击已选的筛选项时取消"""
+    def option(group, value, label):
+        is_selected = selected.get(group) == value
+        return {
+            'label': label,
+            'count': counts[group].get(value, 0),
+            'selected': is_selected,
+            'filters': filter_params(selected, group, None if is_selected else value),
+        }
+
+    return {
+        'category': [option('category', t['id'], t['name']) for t in types if t['id'] in counts['category']],
+        'price': [option('price', band, band_label(band))
+                  for band in range(len(settings.SEARCH_PRICE_BANDS) + 1) if band in counts['price']],
+        'stock': option('stock', 1, '仅显示有货'),
+    }
+
+
+@receiver([post_save, post_delete], sender=GoodsSKU)
+def on_sku_changed(sender, instance, **kwargs):
+    record_changes_on_commit([instance.id])
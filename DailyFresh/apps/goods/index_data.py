@@ -0,0 +1,132 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods.models import GoodsType, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, \
+    IndexTypeGoodsBanner
+from DailyFresh.utils.cache import SWRCache
+
+"""
+首页数据
+首页和静态首页共用,数据分为以下几部分分别缓存,内容均为可以json序列化的dict/list:
+    types: 商品分类
+    banner: 轮播商品
+    promotion: 促销活动
+    category:种类id: 该种类在首页展示的文字商品和图片商品
+index_section_version: 各部分的版本 {部分名称: 版本}
+index_section_部分名称: 该部分的数据及生成时的版本,由SWRCache读写
+修改某一部分的数据后增加其版本,只重新查询该部分,缓存未命中时全部数据最多4条SQL
+版本变化或软过期后只有一个请求重新查询,其余请求在生成完成前继续使用旧数据
+"""
+
+SECTION_VERSION_KEY = 'index_section_version'
+SECTION_KEY = 'index_section_%s'
+
+TYPES = 'types'
+BANNER = 'banner'
+PROMOTION = 'promotion'
+
+
+section_cache = SWRCache('index', SECTION_KEY, settings.INDEX_SECTION_TIMEOUT, settings.INDEX_SECTION_STALE_TIMEOUT)
+
+
+def category_section(category_id):
+    """种类展示商品部分的名称"""
+    return 'category:%d' % category_id
+
+
+def invalidate(*sections):
+    """数据修改后增加对应部分的版本,下次读取时重新生成"""
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    for section in sections:
+        pipe.hincrby(SECTION_VERSION_KEY, section)
+    pipe.execute()
+
+
+def build_types():
+    return [{
+        'id': t.id,
+        'name': t.name,
+        'logo': t.logo,
+        'image_url': t.image.url,
+    } for t in GoodsType.objects.all()]
+
+
+def build_banner():
+    return [{
+        'sku_id': b.sku_id,
+        'image_url': b.image.url,
+    } for b in IndexGoodsBanner.objects.all().order_by('index')]
+
+
+def build_promotion():
+    return [{
+        'name': b.name,
+        'url': b.url,
+        'image_url': b.image.url,
+    } for b in IndexPromotionBanner.objects.all().order_by('index')]
+
+
+def build_categories(category_ids):
+    """一次查询生成多个种类的展示商品,返回{种类id: {title_banner: [...], image_banner: [...]}}"""
+    sections = dict((category_id, {'title_banner': [], 'image_banner': []}) for category_id in category_ids)
+    banners = IndexTypeGoodsBanner.objects.filter(category_id__in=category_ids) \
+        .select_related('sku').order_by('index', 'id')
+    for banner in banners:
+        key = 'image_banner' if banner.display_type == 1 else 'title_banner'
+        sections[banner.category_id][key].append({
+            'sku_id': banner.sku_id,
+            'sku_name': banner.sku.name,
+            'sku_price': str(banner.sku.price),
+            'sku_image_url': banner.sku.image.url,
+        })
+    return sections
+
+
+SECTION_BUILDERS = {
+    TYPES: build_types,
+    BANNER: build_banner,
+    PROMOTION: build_promotion,
+}
+
+
+def get_index_context(conn=None):
+    """获取首页模板上下文(不含购物车数量)"""
+    conn = conn or get_redis_connection('default')
+    versions = dict((k.decode(), int(v)) for k, v in conn.hgetall(SECTION_VERSION_KEY).items())
+
+    sections = section_cache.get_many([TYPES, BANNER, PROMOTION],
+                                      lambda names: dict((name, SECTION_BUILDERS[name]()) for name in names),
+                                      versions, conn)
+
+    # 未命中的种类合并为一次查询生成
+    names = dict((category_section(t['id']), t['id']) for t in sections[TYPES])
+
+    def build(missing):
+        built = build_categories([names[name] for name in missing])
+        return dict((category_section(category_id), data) for category_id, data in built.items())
+
+    categories = section_cache.get_many(list(names), build, versions, conn)
+
+    types = []
+    for category in sections[TYPES]:
+        category = dict(category)
+        category.update(categories[category_section(category['id'])])
+        types.append(category)
+
+    return {
+        'types': types,
+        'index_banner': sections[BANNER],
+        'promotion_banner': sections[PROMOTION],
+        'cart_count': 0,
+    }
+
+
+@receiver(post_save, sender=GoodsSKU)
+def on_sku_saved(sender, instance, **kwargs):
+    # 首页展示的商品名称、价格、图片发生变化
+    category_ids = set(IndexTypeGoodsBanner.objects.filter(sku_id=instance.id).values_list('category_id', flat=True))
+    if category_ids:
+        invalidate(*[category_section(category_id) for category_id in category_ids])
@@ -0,0 +1,294 @@
+import uuid
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from DailyFresh.apps.goods.models import GoodsSKU, GoodsStockFlush
+
+"""
+redis中的商品库存镜像
+key: goods_stock_商品id  value: 可售库存
+下单时使用lua脚本一次性校验并扣减订单中全部商品的库存,不足时不做任何修改
+"""
+
+STOCK_KEY = 'goods_stock_%d'
+
+# 库存镜像的有效时间(秒),过期后从数据库重新加载
+STOCK_MIRROR_TTL = 60
+
+# KEYS: 商品库存key  ARGV: 对应的购买数量
+# 返回值: 1 成功  0 库存不足  -1 库存镜像不存在
+RESERVE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    local stock = redis.call('get', key)
+    if not stock then
+        return -1
+    end
+    if tonumber(stock) < tonumber(ARGV[i]) then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('decrby', key, ARGV[i])
+end
+return 1
+"""
+
+# 归还库存,只对仍然存在的镜像生效
+RELEASE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        redis.call('incrby', key, ARGV[i])
+    end
+end
+return 1
+"""
+
+
+def load_stock_mirror(sku_ids, conn=None):
+    """从数据库加载库存到redis,已存在的镜像不覆盖"""
+    conn = conn or get_redis_connection('default')
+    pipe = conn.pipeline()
+    for sku_id, stock in GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'):
+        pipe.set(STOCK_KEY % sku_id, stock, ex=STOCK_MIRROR_TTL, nx=True)
+    pipe.execute()
+
+
+def reserve_stock(counts, conn=None):
+    """
+    预扣库存,counts为{sku_id: count}
+    返回True表示预扣成功,False表示库存不足
+    """
+    conn = conn or get_redis_connection('default')
+    keys = [STOCK_KEY % sku_id for sku_id in counts]
+    args = list(counts.values())
+    res = conn.eval(RESERVE_SCRIPT, len(keys), *(keys + args))
+    if res == -1:
+        # 镜像不存在,从数据库加载后重新预扣
+        load_stock_mirror(list(counts.keys()), conn)
+        res = conn.eval(RESERVE_SCRIPT, len(keys), *(keys + args))
+    return res == 1
+
+
+def release_stock(counts, conn=None):
+    """归还预扣的库存"""
+    conn = conn or get_redis_connection('default')
+    keys = [STOCK_KEY % sku_id for sku_id in counts]
+    conn.eval(RELEASE_SCRIPT, len(keys), *(keys + list(counts.values())))
+
+
+"""
+秒杀商品库存
+秒杀商品的库存以redis为准,下单时只在redis中扣减,不再锁定df_goods_sku中的商品行
+flash_sale_skus: 秒杀商品id集合
+flash_stock_商品id: 秒杀商品的可售库存
+flash_stock_journal: 已预扣但尚未写入数据库的数量{sku_id: count},由celery任务异步写入mysql
+    预扣库存时在同一个lua脚本中记入journal,订单创建失败或关闭时同样在一个脚本中归还库存并记入负数,
+    下单进程在事务提交前后退出时journal与可售库存仍然一致,不会因为校对而调高可售库存
+flash_stock_journal_flushing: 正在写入数据库的journal,写入时将journal整体改名并分配批次id(flash_stock_journal_batch),
+    批次id与库存在同一个事务中写入df_goods_stock_flush,事务提交后来不及删除时,下一次写入只删除不再扣减
+始终满足: 可售库存 = 数据库库存 - journal中的数量 - 正在写入的数量
+"""
+
+FLASH_SALE_SET = 'flash_sale_skus'
+FLASH_STOCK_KEY = 'flash_stock_%d'
+FLASH_JOURNAL_KEY = 'flash_stock_journal'
+FLASH_FLUSHING_KEY = 'flash_stock_journal_flushing'
+FLASH_BATCH_KEY = 'flash_stock_journal_batch'
+# 写入数据库和校对库存时使用的锁
+FLASH_LOCK_KEY = 'flash_stock_lock'
+# 上一次校对时发现的库存偏差
+FLASH_DRIFT_KEY = 'flash_stock_drift'
+# 异步写入任务已经发出的标记
+FLASH_PERSIST_SCHEDULED_KEY = 'flash_stock_persist_scheduled'
+# 写入批次记录的保留时间
+FLUSH_BATCH_KEEP = timedelta(days=1)
+
+# KEYS[1]: 秒杀商品库存key KEYS[2]: journal KEYS[3]: 正在写入的journal
+# ARGV[1]: 商品id ARGV[2]: 数据库库存 ARGV[3]: 1表示覆盖已有库存
+# 将可售库存设置为 数据库库存 - journal中的数量 - 正在写入的数量, 返回设置后的库存
+SEED_SCRIPT = """
+if ARGV[3] == '0' and redis.call('exists', KEYS[1]) == 1 then
+    return tonumber(redis.call('get', KEYS[1]))
+end
+local pending = tonumber(redis.call('hget', KEYS[2], ARGV[1]) or '0')
+pending = pending + tonumber(redis.call('hget', KEYS[3], ARGV[1]) or '0')
+local stock = tonumber(ARGV[2]) - pending
+redis.call('set', KEYS[1], stock)
+return stock
+"""
+
+# KEYS: 秒杀商品库存key..., journal  ARGV: 对应的购买数量..., 对应的商品id...
+# 校验并扣减可售库存,同时记入journal
+# 返回值: 1 成功  0 库存不足  -1 库存不存在
+FLASH_RESERVE_SCRIPT = """
+local n = #KEYS - 1
+for i = 1, n do
+    local stock = redis.call('get', KEYS[i])
+    if not stock then
+        return -1
+    end
+    if tonumber(stock) < tonumber(ARGV[i]) then
+        return 0
+    end
+end
+for i = 1, n do
+    redis.call('decrby', KEYS[i], ARGV[i])
+    redis.call('hincrby', KEYS[n + 1], ARGV[n + i], ARGV[i])
+end
+return 1
+"""
+
+# 参数同FLASH_RESERVE_SCRIPT,归还可售库存并在journal中记入负数
+# 库存不存在时只修改journal,重新生成时按照数据库库存和journal计算
+FLASH_RELEASE_SCRIPT = """
+local n = #KEYS - 1
+for i = 1, n do
+    if redis.call('exists', KEYS[i]) == 1 then
+        redis.call('incrby', KEYS[i], ARGV[i])
+    end
+    redis.call('hincrby', KEYS[n + 1], ARGV[n + i], -tonumber(ARGV[i]))
+end
+return 1
+"""
+
+
+def get_flash_sale_skus(conn=None):
+    """获取全部秒杀商品id"""
+    conn = conn or get_redis_connection('default')
+    return {int(sku_id) for sku_id in conn.smembers(FLASH_SALE_SET)}
+
+
+def seed_flash_stock(sku_id, stock, overwrite=False, conn=None):
+    """根据数据库库存设置秒杀商品的可售库存"""
+    conn = conn or get_redis_connection('default')
+    return conn.eval(SEED_SCRIPT, 3, FLASH_STOCK_KEY % sku_id, FLASH_JOURNAL_KEY, FLASH_FLUSHING_KEY,
+                     sku_id, stock, int(overwrite))
+
+
+def get_pending(conn, sku_id):
+    """已预扣但尚未写入数据库的数量"""
+    pipe = conn.pipeline()
+    pipe.hget(FLASH_JOURNAL_KEY, sku_id)
+    pipe.hget(FLASH_FLUSHING_KEY, sku_id)
+    return sum(int(count or 0) for count in pipe.execute())
+
+
+def flash_script_args(counts):
+    """FLASH_RESERVE_SCRIPT和FLASH_RELEASE_SCRIPT的参数"""
+    keys = [FLASH_STOCK_KEY % sku_id for sku_id in counts] + [FLASH_JOURNAL_KEY]
+    return [len(keys)] + keys + list(counts.values()) + list(counts.keys())
+
+
+def add_flash_sale(sku_ids, conn=None):
+    """将商品标记为秒杀商品,并将库存同步到redis"""
+    conn = conn or get_redis_connection('default')
+    with conn.lock(FLASH_LOCK_KEY, timeout=60):
+        for sku_id, stock in GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'):
+            seed_flash_stock(sku_id, stock, overwrite=True, conn=conn)
+            conn.sadd(FLASH_SALE_SET, sku_id)
+
+
+def remove_flash_sale(sku_ids, conn=None):
+    """取消秒杀,先将未写入数据库的数量写入数据库"""
+    conn = conn or get_redis_connection('default')
+    conn.srem(FLASH_SALE_SET, *sku_ids)
+    persist_flash_journal(conn)
+    conn.delete(*[FLASH_STOCK_KEY % int(sku_id) for sku_id in sku_ids])
+
+
+def reserve_flash_stock(counts, conn=None):
+    """预扣秒杀商品库存并记入journal,返回True表示预扣成功"""
+    conn = conn or get_redis_connection('default')
+    args = flash_script_args(counts)
+    res = conn.eval(FLASH_RESERVE_SCRIPT, *args)
+    if res == -1:
+        # 可售库存丢失,根据数据库库存重新生成后再预扣
+        for sku_id, stock in GoodsSKU.objects.filter(id__in=list(counts)).values_list('id', 'stock'):
+            seed_flash_stock(sku_id, stock, conn=conn)
+        res = conn.eval(FLASH_RESERVE_SCRIPT, *args)
+    return res == 1
+
+
+def release_flash_stock(counts, conn=None):
+    """订单创建失败或关闭,归还预扣的秒杀商品库存并在journal中记入负数"""
+    conn = conn or get_redis_connection('default')
+    conn.eval(FLASH_RELEASE_SCRIPT, *flash_script_args(counts))
+
+
+def schedule_flash_persist(conn=None):
+    """订单提交或关闭后发出异步写入任务"""
+    conn = conn or get_redis_connection('default')
+    if conn.set(FLASH_PERSIST_SCHEDULED_KEY, 1, ex=10, nx=True):
+        from DailyFresh.celery_tasks.tasks import persist_flash_sale_stock
+        persist_flash_sale_stock.apply_async(countdown=1)
+
+
+def persist_flash_journal(conn=None):
+    """将journal中的数量写入数据库,返回写入的商品种数"""
+    conn = conn or get_redis_connection('default')
+    from DailyFresh.apps.order.commit import decrement_stock
+    with conn.lock(FLASH_LOCK_KEY, timeout=60):
+        # 上一次写入中断时先处理遗留的journal,否则将当前journal整体改名,之后的预扣记入新的hash中
+        if not conn.exists(FLASH_FLUSHING_KEY):
+            if not conn.exists(FLASH_JOURNAL_KEY):
+                return 0
+            pipe = conn.pipeline()
+            pipe.rename(FLASH_JOURNAL_KEY, FLASH_FLUSHING_KEY)
+            pipe.set(FLASH_BATCH_KEY, uuid.uuid4().hex)
+            pipe.execute()
+
+        batch_id = conn.get(FLASH_BATCH_KEY)
+        if batch_id is None:
+            # 改名后来不及写入批次id,遗留的journal还没有写入过数据库
+            batch_id = uuid.uuid4().hex
+            conn.set(FLASH_BATCH_KEY, batch_id)
+        else:
+            batch_id = batch_id.decode()
+
+        counts = {int(sku_id): int(count) for sku_id, count in conn.hgetall(FLASH_FLUSHING_KEY).items()}
+        # 关闭超时订单时归还的数量记为负数
+        counts = {sku_id: count for sku_id, count in counts.items() if count != 0}
+        with transaction.atomic():
+            _, created = GoodsStockFlush.objects.get_or_create(batch_id=batch_id)
+            if not created:
+                # 该批次已经写入,上一次在删除redis中的journal前中断
+                counts = {}
+            elif counts:
+                # 库存已经在redis中校验过,这里不再加库存条件,一条语句写入全部商品
+                decrement_stock(counts, check=False)
+            GoodsStockFlush.objects.filter(created_time__lt=timezone.now() - FLUSH_BATCH_KEEP).delete()
+        conn.delete(FLASH_FLUSHING_KEY, FLASH_BATCH_KEY)
+    return len(counts)
+
+
+def reconcile_flash_stock(conn=None):
+    """
+    校对秒杀商品的可售库存,返回修复的商品id列表
+    可售库存大于 数据库库存-journal 时有超卖风险,立即修复
+    可售库存偏小时连续两次校对偏差相同才修复
+    """
+    conn = conn or get_redis_connection('default')
+    repaired = []
+    with conn.lock(FLASH_LOCK_KEY, timeout=60):
+        sku_ids = get_flash_sale_skus(conn)
+        if not sku_ids:
+            return repaired
+        last_drift = {int(sku_id): int(drift) for sku_id, drift in conn.hgetall(FLASH_DRIFT_KEY).items()}
+        pipe = conn.pipeline()
+        for sku_id, stock in GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'):
+            mirror = conn.get(FLASH_STOCK_KEY % sku_id)
+            pending = get_pending(conn, sku_id)
+            drift = int(mirror) - (stock - pending) if mirror is not None else None
+            if drift is None or drift > 0 or (drift < 0 and last_drift.get(sku_id) == drift):
+                seed_flash_stock(sku_id, stock, overwrite=True, conn=conn)
+                repaired.append(sku_id)
+                pipe.hdel(FLASH_DRIFT_KEY, sku_id)
+            elif drift < 0:
+                pipe.hset(FLASH_DRIFT_KEY, sku_id, drift)
+            else:
+                pipe.hdel(FLASH_DRIFT_KEY, sku_id)
+        pipe.execute()
+    return repaired
@@ -0,0 +1,256 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+from DailyFresh.apps.goods.models import GoodsSKU
+from DailyFresh.apps.goods.sales import SALES_DELTA_KEY, SALES_FLUSHING_KEY
+
+"""
+商品列表排序索引
+每个种类每种排序方式一个redis有序集合,列表页用ZRANGE取出一页商品id,再一次IN查询取出商品
+goods_list_种类id_price: 分值为价格
+goods_list_种类id_sales: 分值为销量(数据库销量 + redis中尚未写入数据库的增量)
+goods_list_种类id_default: 分值为商品id
+成员为补零到固定长度的商品id,分值相同时按照成员的字典序即按照id排序
+goods_list_category: 商品所属的种类 {商品id: 种类id}
+商品保存、删除时更新索引,下单、取消订单时累加销量,python manage.py rebuild_list_index 重建全部索引
+goods_list_rebuilding: 正在重建的标记,重建期间修改过的商品id记入goods_list_rebuild_changed,
+    这些修改写在即将被替换的旧索引上,替换后按照数据库重新写入这些商品,重建期间的修改不会丢失
+"""
+
+LIST_KEY = 'goods_list_%d_%s'
+CATEGORY_KEY = 'goods_list_category'
+SORT_KEYS = ('price', 'sales', 'default')
+REBUILDING_KEY = 'goods_list_rebuilding'
+REBUILD_CHANGED_KEY = 'goods_list_rebuild_changed'
+# 重建标记的有效时间(秒),重建中途退出时到期后不再记录修改
+REBUILD_TIMEOUT = 3600
+# 排序方式是否按照分值从高到低
+SORT_DESC = {'price': False, 'sales': True, 'default': True}
+
+
+def member(sku_id):
+    return '%010d' % sku_id
+
+
+def list_key(category_id, sort):
+    return LIST_KEY % (category_id, sort)
+
+
+def scores(sku_id, price, sales):
+    """商品在各个排序索引中的分值"""
+    return {'price': float(price), 'sales': sales, 'default': sku_id}
+
+
+def add_skus(pipe, rows, key_format=LIST_KEY, category_key=CATEGORY_KEY):
+    """
+    将商品写入索引,rows为[(sku_id, category_id, price, sales)],sales需要已经合并redis中的增量
+    key_format、category_key用于重建时写入临时key
+    """
+    by_key = {}
+    categories = {}
+    for sku_id, category_id, price, sales in rows:
+        categories[sku_id] = category_id
+        for sort, score in scores(sku_id, price, sales).items():
+            by_key.setdefault(key_format % (category_id, sort), {})[member(sku_id)] = score
+    for key, mapping in by_key.items():
+        pipe.zadd(key, mapping)
+    if categories:
+        pipe.hmset(category_key, categories)
+
+
+def remove_sku(pipe, sku_id, category_id):
+    for sort in SORT_KEYS:
+        pipe.zrem(list_key(category_id, sort), member(sku_id))
+
+
+# 正在重建时记录修改过的商品id
+# KEYS[1]: 重建标记 KEYS[2]: 修改过的商品id集合  ARGV: 商品id
+TRACK_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('sadd', KEYS[2], unpack(ARGV))
+end
+return 1
+"""
+
+
+def track_changes(pipe, sku_ids):
+    """在pipeline中登记修改过的商品,只在重建期间生效"""
+    if sku_ids:
+        pipe.eval(TRACK_SCRIPT, 2, REBUILDING_KEY, REBUILD_CHANGED_KEY, *sku_ids)
+
+
+def refresh_skus(conn, sku_ids):
+    """按照数据库重新写入商品的索引,已经删除的商品从索引中删除"""
+    sku_ids = list(sku_ids)
+    if not sku_ids:
+        return
+    rows = list(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'category_id', 'price', 'sales'))
+    deltas = pending_sales(conn, sku_ids)
+    categories = dict((sku_id, category_id) for sku_id, category_id
+                      in zip(sku_ids, conn.hmget(CATEGORY_KEY, sku_ids)) if category_id is not None)
+    found = set(row[0] for row in rows)
+    pipe = conn.pipeline()
+    for sku_id, category_id, _, _ in rows:
+        # 修改了种类时从原来种类的索引中删除
+        if sku_id in categories and int(categories[sku_id]) != category_id:
+            remove_sku(pipe, sku_id, int(categories[sku_id]))
+    for sku_id, category_id in categories.items():
+        if sku_id not in found:
+            remove_sku(pipe, sku_id, int(category_id))
+            pipe.hdel(CATEGORY_KEY, sku_id)
+    add_skus(pipe, [(sku_id, category_id, price, sales + deltas[sku_id])
+                    for sku_id, category_id, price, sales in rows])
+    pipe.execute()
+
+
+def pending_sales(conn, sku_ids):
+    """redis中尚未写入数据库的销量增量 {商品id: 增量}"""
+    pipe = conn.pipeline()
+    pipe.hmget(SALES_DELTA_KEY, sku_ids)
+    pipe.hmget(SALES_FLUSHING_KEY, sku_ids)
+    deltas, flushing = pipe.execute()
+    return dict((sku_id, int(delta or 0) + int(pending or 0))
+                for sku_id, delta, pending in zip(sku_ids, deltas, flushing))
+
+
+def incr_sales(counts, conn=None):
+    """下单、取消订单时累加索引中的销量,counts为{sku_id: count}"""
+    if not counts:
+        return
+    conn = conn or get_redis_connection('default')
+    sku_ids = list(counts.keys())
+    pipe = conn.pipeline()
+    for sku_id, category_id in zip(sku_ids, conn.hmget(CATEGORY_KEY, sku_ids)):
+        # 不在索引中的商品由重建索引处理
+        if category_id is not None:
+            pipe.zincrby(list_key(int(category_id), 'sales'), counts[sku_id], member(sku_id))
+    track_changes(pipe, sku_ids)
+    pipe.execute()
+
+
+def exists(category_id, conn=None):
+    """种类的索引是否已经建立"""
+    conn = conn or get_redis_connection('default')
+    return conn.exists(list_key(category_id, 'default'))
+
+
+def count(category_id, conn=None):
+    conn = conn or get_redis_connection('default')
+    return conn.zcard(list_key(category_id, 'default'))
+
+
+def page_ids(category_id, sort, start, stop, conn=None):
+    """按照排序方式取出第start到stop个(不含)商品的id"""
+    conn = conn or get_redis_connection('default')
+    key = list_key(category_id, sort)
+    if SORT_DESC[sort]:
+        members = conn.zrevrange(key, start, stop - 1)
+    else:
+        members = conn.zrange(key, start, stop - 1)
+    return [int(m) for m in members]
+
+
+def rebuild(chunk_size=1000, conn=None):
+    """
+    分批读取全部商品重建索引,先写入临时key,完成后改名替换,重建期间列表页继续使用旧索引
+    替换后重新写入重建期间修改过的商品
+    返回{种类id: 商品数}
+    """
+    conn = conn or get_redis_connection('default')
+    tmp_format = LIST_KEY + '_rebuild'
+    tmp_category_key = CATEGORY_KEY + '_rebuild'
+    # 清除上一次中断的重建留下的临时key
+    for key in conn.scan_iter('goods_list_*_rebuild'):
+        conn.delete(key)
+    pipe = conn.pipeline()
+    pipe.delete(REBUILD_CHANGED_KEY)
+    pipe.set(REBUILDING_KEY, 1, ex=REBUILD_TIMEOUT)
+    pipe.execute()
+
+    totals = {}
+    last_id = 0
+    while True:
+        rows = list(GoodsSKU.objects.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', 'category_id', 'price', 'sales')[:chunk_size])
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        deltas = pending_sales(conn, [row[0] for row in rows])
+        pipe = conn.pipeline(transaction=False)
+        add_skus(pipe, [(sku_id, category_id, price, sales + deltas[sku_id])
+                        for sku_id, category_id, price, sales in rows], tmp_format, tmp_category_key)
+        pipe.execute()
+        for row in rows:
+            totals[row[1]] = totals.get(row[1], 0) + 1
+
+    # 全部写入临时key后改名替换
+    pipe = conn.pipeline()
+    for category_id in totals:
+        for sort in SORT_KEYS:
+            pipe.rename(tmp_format % (category_id, sort), list_key(category_id, sort))
+    if totals:
+        pipe.rename(tmp_category_key, CATEGORY_KEY)
+    pipe.delete(REBUILDING_KEY)
+    pipe.smembers(REBUILD_CHANGED_KEY)
+    pipe.delete(REBUILD_CHANGED_KEY)
+    changed = pipe.execute()[-2]
+
+    # 已经没有商品的种类删除旧索引
+    for key in conn.scan_iter('goods_list_[0-9]*'):
+        parts = key.decode().split('_')
+        if len(parts) == 4 and parts[3] in SORT_KEYS and int(parts[2]) not in totals:
+            conn.delete(key)
+
+    # 重建期间的修改写在了被替换的旧索引上,按照数据库重新写入
+    refresh_skus(conn, [int(sku_id) for sku_id in changed])
+    return totals
+
+
+def check(category_id, conn=None):
+    """
+    对比种类的索引与数据库,返回{missing: 索引中缺少的商品id, extra: 索引中多余的商品id,
+    mismatched: 分值不一致的 [(商品id, 排序方式, 索引中的分值, 数据库中的分值)]}
+    """
+    conn = conn or get_redis_connection('default')
+    rows = dict((row[0], row) for row in GoodsSKU.objects.filter(category_id=category_id)
+                .values_list('id', 'category_id', 'price', 'sales').iterator())
+    deltas = pending_sales(conn, list(rows)) if rows else {}
+
+    result = {'missing': set(), 'extra': set(), 'mismatched': []}
+    for sort in SORT_KEYS:
+        indexed = dict((int(m), score) for m, score in conn.zrange(list_key(category_id, sort), 0, -1, withscores=True))
+        result['missing'].update(set(rows) - set(indexed))
+        result['extra'].update(set(indexed) - set(rows))
+        for sku_id, score in indexed.items():
+            if sku_id not in rows:
+                continue
+            _, _, price, sales = rows[sku_id]
+            expected = scores(sku_id, price, sales + deltas[sku_id])[sort]
+            if abs(score - float(expected)) > 1e-6:
+                result['mismatched'].append((sku_id, sort, score, expected))
+    return result
+
+
+@receiver(post_save, sender=GoodsSKU)
+def on_sku_saved(sender, instance, **kwargs):
+    conn = get_redis_connection('default')
+    old_category = conn.hget(CATEGORY_KEY, instance.id)
+    sales = instance.sales + pending_sales(conn, [instance.id])[instance.id]
+    pipe = conn.pipeline()
+    # 修改了种类时从原来种类的索引中删除
+    if old_category is not None and int(old_category) != instance.category_id:
+        remove_sku(pipe, instance.id, int(old_category))
+    add_skus(pipe, [(instance.id, instance.category_id, instance.price, sales)])
+    track_changes(pipe, [instance.id])
+    pipe.execute()
+
+
+@receiver(post_delete, sender=GoodsSKU)
+def on_sku_deleted(sender, instance, **kwargs):
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    remove_sku(pipe, instance.id, instance.category_id)
+    pipe.hdel(CATEGORY_KEY, instance.id)
+    track_changes(pipe, [instance.id])
+    pipe.execute()
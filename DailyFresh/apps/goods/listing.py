@@ -0,0 +1,153 @@
+import math
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods import list_index
+from DailyFresh.apps.goods.models import GoodsSKU
+
+"""
+商品列表分页
+上一页/下一页使用游标(keyset)分页: 游标为当前页第一条/最后一条商品的排序字段值,
+    按照 (排序字段, id) 比较取下一页,不使用OFFSET,翻到多深的页都只扫描一页的索引
+    索引: df_goods_sku(category_id, price)、(category_id, sales),InnoDB二级索引中自带主键id
+直接点击页码时没有游标,使用OFFSET查询,只在页码附近跳转时代价不大
+只查询列表中展示需要的字段
+种类的商品总数缓存在 goods_list_count_种类id 中,用于计算页码,允许短时间内不准确
+已经建立redis排序索引(list_index)的种类直接按照页码从索引中取出商品id,不再查询排序
+"""
+
+PAGE_SIZE = 5
+COUNT_KEY = 'goods_list_count_%d'
+
+# 排序方式: [(字段, 是否降序)],最后一个字段为id保证顺序唯一
+SORTS = {
+    'price': [('price', False), ('id', False)],
+    'sales': [('sales', True), ('id', True)],
+    'default': [('id', True)],
+}
+
+# 字段值与游标字符串的转换
+FIELD_TYPES = {
+    'price': Decimal,
+    'sales': int,
+    'id': int,
+}
+
+# 列表中展示需要的字段
+CARD_FIELDS = ('id', 'name', 'price', 'unite', 'image', 'sales')
+
+
+def encode_cursor(sku, sort):
+    return '_'.join(str(getattr(sku, field)) for field, _ in SORTS[sort])
+
+
+def decode_cursor(cursor, sort):
+    """解析游标,格式错误返回None"""
+    values = cursor.split('_')
+    fields = SORTS[sort]
+    if len(values) != len(fields):
+        return None
+    try:
+        return [FIELD_TYPES[field](value) for (field, _), value in zip(fields, values)]
+    except (ValueError, InvalidOperation):
+        return None
+
+
+def keyset_filter(sort, values, backward=False):
+    """
+    生成游标之后(backward为True时为之前)的过滤条件,
+    如 (price, id) > (p, i) 展开为 price > p OR (price = p AND id > i)
+    """
+    condition = Q()
+    equal = Q()
+    for (field, desc), value in zip(SORTS[sort], values):
+        lookup = 'lt' if desc != backward else 'gt'
+        condition |= equal & Q(**{'%s__%s' % (field, lookup): value})
+        equal &= Q(**{field: value})
+    return condition
+
+
+def order_fields(sort, backward=False):
+    return ['-' + field if desc != backward else field for field, desc in SORTS[sort]]
+
+
+def get_category_count(category_id, conn=None):
+    """种类的商品总数,优先读取缓存"""
+    conn = conn or get_redis_connection('default')
+    count = conn.get(COUNT_KEY % category_id)
+    if count is not None:
+        return int(count)
+    count = GoodsSKU.objects.filter(category_id=category_id).count()
+    conn.set(COUNT_KEY % category_id, count, ex=settings.GOODS_LIST_COUNT_TIMEOUT)
+    return count
+
+
+class ListingPage(object):
+    """一页商品,提供模板中分页需要的属性"""
+
+    def __init__(self, object_list, number, num_pages, sort):
+        self.object_list = object_list
+        self.number = number
+        self.num_pages = num_pages
+        # 游标使用数据库中的排序字段值,需要在合并redis中的销量之前生成
+        self.prev_cursor = encode_cursor(object_list[0], sort) if object_list else ''
+        self.next_cursor = encode_cursor(object_list[-1], sort) if object_list else ''
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_next(self):
+        return self.number < self.num_pages
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+
+def get_page(category_id, sort, page, after=None, before=None, conn=None):
+    """
+    获取种类的第page页商品,after/before为上一页最后一条/下一页第一条的游标
+    返回ListingPage
+    """
+    if sort not in SORTS:
+        sort = 'default'
+    conn = conn or get_redis_connection('default')
+
+    # 已经建立排序索引时直接从redis中取出一页商品id
+    if list_index.exists(category_id, conn):
+        num_pages = max(1, int(math.ceil(list_index.count(category_id, conn) / float(PAGE_SIZE))))
+        if page < 1 or page > num_pages:
+            page = 1
+        sku_ids = list_index.page_ids(category_id, sort, (page - 1) * PAGE_SIZE, page * PAGE_SIZE, conn)
+        sku_dict = GoodsSKU.objects.only(*CARD_FIELDS).in_bulk(sku_ids)
+        skus = [sku_dict[sku_id] for sku_id in sku_ids if sku_id in sku_dict]
+        return ListingPage(skus, page, num_pages, sort)
+
+    num_pages = max(1, int(math.ceil(get_category_count(category_id, conn) / float(PAGE_SIZE))))
+    if page < 1 or page > num_pages:
+        page = 1
+
+    skus = GoodsSKU.objects.filter(category_id=category_id).only(*CARD_FIELDS)
+    cursor = after or before
+    values = decode_cursor(cursor, sort) if cursor else None
+    if values is not None:
+        backward = before is not None and after is None
+        skus = list(skus.filter(keyset_filter(sort, values, backward))
+                    .order_by(*order_fields(sort, backward))[:PAGE_SIZE])
+        if backward:
+            skus.reverse()
+    else:
+        offset = (page - 1) * PAGE_SIZE
+        skus = list(skus.order_by(*order_fields(sort))[offset:offset + PAGE_SIZE])
+    return ListingPage(skus, page, num_pages, sort)
@@ -42,6 +42,11 @@ class GoodsSKU(BaseModel):
         db_table = 'df_goods_sku'
         verbose_name = '商品'
         verbose_name_plural = '商品列表'
+        indexes = [
+            # 商品列表按照价格、销量排序分页
+            models.Index(fields=['category', 'price'], name='goods_sku_category_price_idx'),
+            models.Index(fields=['category', 'sales'], name='goods_sku_category_sales_idx'),
+        ]
 
 
 class Goods(BaseModel):
@@ -112,3 +117,27 @@ class IndexPromotionBanner(BaseModel):
         db_table = 'df_index_promotion'
         verbose_name = '主页促销活动'
         verbose_name_plural = '主页促销活动列表'
+
+
+class GoodsSalesFlush(models.Model):
+    """已经写入数据库的销量增量批次,与销量在同一个事务中写入,同一批次不会重复累加"""
+
+    batch_id = models.CharField(max_length=32, primary_key=True, verbose_name='批次id')
+    created_time = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+
+    class Meta:
+        db_table = 'df_goods_sales_flush'
+        verbose_name = '销量写入批次'
+        verbose_name_plural = verbose_name
+
+
+class GoodsStockFlush(models.Model):
+    """已经写入数据库的秒杀商品库存批次,与库存在同一个事务中写入,同一批次不会重复扣减"""
+
+    batch_id = models.CharField(max_length=32, primary_key=True, verbose_name='批次id')
+    created_time = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+
+    class Meta:
+        db_table = 'df_goods_stock_flush'
+        verbose_name = '库存写入批次'
+        verbose_name_plural = verbose_name
@@ -0,0 +1,441 @@
+import array
+import bisect
+import heapq
+import logging
+import os
+import pickle
+import re
+import tempfile
+import threading
+
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods.models import GoodsSKU
+from DailyFresh.utils.background import PeriodicThread
+
+"""
+进程内的商品名称搜索
+对商品名称和简介按照单字和相邻两字(bigram)建立倒排索引,倒排表为按文档号递增的array('I'),
+    查询时取出查询词中全部bigram(单字查询使用单字)的倒排表,从最短的开始用二分查找求交集
+    bigram的交集近似于短语匹配,对商品名称这类短文本足够准确
+名称前缀补全使用按照规范化名称排序的数组,二分查找定位前缀
+索引快照保存在NGRAM_SNAPSHOT_PATH中,由celery任务build_ngram_snapshot从数据库生成(每小时一次,
+    以及快照不存在、快照之后的修改记录已被stream裁剪、已删除的文档超过NGRAM_COMPACT_RATIO时)
+    进程在后台线程中加载快照,快照更新后重新加载替换,请求中不会从数据库生成索引
+加载后由同一个后台线程按照redis stream search_change_stream中的商品修改记录增量更新,请求中不访问redis和数据库,
+    修改的商品追加为新的文档号,旧文档号标记为删除,倒排表始终保持有序
+查询与修改使用同一个锁,修改只在查询数据库之后进行,持有锁的时间很短
+search_change_stream: 商品修改记录 {sku_id: 商品id, op: update/delete},由search_queue.enqueue写入
+ngram_snapshot_scheduled: 生成快照的任务已经发出的标记
+"""
+
+logger = logging.getLogger(__name__)
+
+CHANGE_STREAM_KEY = 'search_change_stream'
+# stream中最多保留的修改记录数
+CHANGE_STREAM_MAXLEN = 100000
+SNAPSHOT_SCHEDULED_KEY = 'ngram_snapshot_scheduled'
+
+NORMALIZE_RE = re.compile(r'[\W_]+')
+# 倒排表长度超过候选集合的该倍数时使用二分查找求交集
+BISECT_RATIO = 32
+
+
+def normalize(text):
+    """转为小写,标点和空白统一替换为空格"""
+    return NORMALIZE_RE.sub(' ', text.lower()).strip()
+
+
+def index_terms(text):
+    """文本中全部的单字和相邻两字,不跨越空格"""
+    terms = set()
+    for run in normalize(text).split():
+        terms.update(run)
+        terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def query_terms(query):
+    """查询词的bigram,只有一个字的部分使用单字"""
+    terms = set()
+    for run in normalize(query).split():
+        if len(run) == 1:
+            terms.add(run)
+        else:
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def contains(postings, docnum):
+    """二分查找有序的倒排表中是否包含docnum"""
+    i = bisect.bisect_left(postings, docnum)
+    return i < len(postings) and postings[i] == docnum
+
+
+def stream_id(message_id):
+    """stream记录id转为可以比较大小的元组"""
+    ms, seq = message_id.split('-')
+    return int(ms), int(seq)
+
+
+class NgramIndex(object):
+    """商品名称、简介的bigram倒排索引"""
+
+    def __init__(self):
+        # 文档号 -> 商品id、商品名称
+        self.sku_ids = array.array('q')
+        self.names = []
+        # 商品id -> 当前的文档号
+        self.docnums = {}
+        # 已删除或已被新文档代替的文档号,deleted_order按照删除顺序保存
+        self.deleted = set()
+        self.deleted_order = array.array('I')
+        # 词 -> 倒排表中已删除的文档数 (已检查到的deleted_order位置, 数量),查询时只检查新删除的文档
+        self.dead_counts = {}
+        # 词 -> 文档号数组
+        self.postings = {}
+        # 按照规范化名称排序的 名称、文档号,用于前缀补全
+        self.prefix_keys = []
+        self.prefix_docs = array.array('I')
+        # 已经应用到的修改记录id
+        self.feed_id = '0-0'
+        # 加载的快照文件的修改时间
+        self.snapshot_mtime = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docnums)
+
+    def add(self, sku_id, name, desc, sort_prefix=True):
+        """添加或更新商品,sort_prefix为False时由调用方最后统一排序前缀数组"""
+        self.remove(sku_id)
+        docnum = len(self.sku_ids)
+        self.sku_ids.append(sku_id)
+        self.names.append(name)
+        self.docnums[sku_id] = docnum
+        for term in index_terms(name + ' ' + desc):
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array.array('I')
+            postings.append(docnum)
+
+        key = normalize(name)
+        if sort_prefix:
+            i = bisect.bisect_right(self.prefix_keys, key)
+            self.prefix_keys.insert(i, key)
+            self.prefix_docs.insert(i, docnum)
+        else:
+            self.prefix_keys.append(key)
+            self.prefix_docs.append(docnum)
+
+    def name(self, sku_id):
+        """商品名称,查询后商品已被删除时返回空字符串"""
+        with self.lock:
+            docnum = self.docnums.get(sku_id)
+            return self.names[docnum] if docnum is not None else ''
+
+    def remove(self, sku_id):
+        docnum = self.docnums.pop(sku_id, None)
+        if docnum is not None:
+            self.deleted.add(docnum)
+            self.deleted_order.append(docnum)
+
+    def deleted_ratio(self):
+        return len(self.deleted) / len(self.sku_ids) if self.sku_ids else 0
+
+    def sort_prefix(self):
+        order = sorted(range(len(self.prefix_keys)), key=self.prefix_keys.__getitem__)
+        self.prefix_keys = [self.prefix_keys[i] for i in order]
+        self.prefix_docs = array.array('I', (self.prefix_docs[i] for i in order))
+
+    def search(self, query, offset=0, limit=20):
+        """查询商品,最新的商品在前,返回(命中总数, 商品id列表)"""
+        terms = query_terms(query)
+        if not terms:
+            return 0, []
+        with self.lock:
+            lists = []
+            for term in terms:
+                postings = self.postings.get(term)
+                if postings is None:
+                    return 0, []
+                lists.append(postings)
+
+            if len(lists) == 1:
+                return self.page_of(terms.pop(), lists[0], offset, limit)
+
+            lists.sort(key=len)
+            candidates = set(lists[0])
+            for postings in lists[1:]:
+                if len(postings) > len(candidates) * BISECT_RATIO:
+                    # 倒排表远长于候选集合时逐个二分查找,不遍历整个倒排表
+                    candidates = set(docnum for docnum in candidates if contains(postings, docnum))
+                else:
+                    candidates.intersection_update(postings)
+                if not candidates:
+                    return 0, []
+            if len(self.deleted) < len(candidates):
+                candidates -= self.deleted
+            else:
+                candidates = set(docnum for docnum in candidates if docnum not in self.deleted)
+
+            total = len(candidates)
+            docnums = heapq.nlargest(offset + limit, candidates)[offset:]
+            return total, [self.sku_ids[docnum] for docnum in docnums]
+
+    def dead_count(self, term, postings):
+        """倒排表中已删除的文档数,只检查上一次统计之后删除的文档"""
+        checked, count = self.dead_counts.get(term, (0, 0))
+        if checked < len(self.deleted_order):
+            for docnum in self.deleted_order[checked:]:
+                if contains(postings, docnum):
+                    count += 1
+            self.dead_counts[term] = (len(self.deleted_order), count)
+        return count
+
+    def page_of(self, term, postings, offset, limit):
+        """只有一个词时不需要求交集,从倒排表末尾取最新的文档"""
+        total = len(postings) - self.dead_count(term, postings)
+        page = []
+        i = len(postings) - 1
+        while i >= 0 and len(page) < offset + limit:
+            if postings[i] not in self.deleted:
+                page.append(self.sku_ids[postings[i]])
+            i -= 1
+        return total, page[offset:]
+
+    def suggest(self, prefix, limit=10):
+        """名称以prefix开头的商品,返回[(商品id, 商品名称)]"""
+        key = normalize(prefix)
+        if not key:
+            return []
+        result = []
+        names = set()
+        with self.lock:
+            i = bisect.bisect_left(self.prefix_keys, key)
+            while i < len(self.prefix_keys) and self.prefix_keys[i].startswith(key) and len(result) < limit:
+                docnum = self.prefix_docs[i]
+                i += 1
+                name = self.names[docnum]
+                if docnum in self.deleted or name in names:
+                    continue
+                names.add(name)
+                result.append((self.sku_ids[docnum], name))
+        return result
+
+    def apply_changes(self, conn, count=1000):
+        """
+        应用stream中新的修改记录,返回应用的记录数
+        先查询数据库,再加锁修改索引,一批修改完成后才更新feed_id,查询失败时下次同步重新应用
+        """
+        applied = 0
+        while True:
+            entries = conn.xread({CHANGE_STREAM_KEY: self.feed_id}, count=count)
+            if not entries:
+                return applied
+            _, messages = entries[0]
+            changes = {}
+            for _, fields in messages:
+                changes[int(fields[b'sku_id'])] = fields[b'op'].decode()
+
+            update_ids = [sku_id for sku_id, op in changes.items() if op == 'update']
+            rows = dict((row[0], row) for row in GoodsSKU.objects.filter(id__in=update_ids)
+                        .values_list('id', 'name', 'desc'))
+            with self.lock:
+                for sku_id in changes:
+                    if sku_id in rows:
+                        self.add(*rows[sku_id])
+                    else:
+                        self.remove(sku_id)
+                self.feed_id = messages[-1][0].decode()
+            applied += len(messages)
+
+    def sync(self, conn=None):
+        """应用新的修改记录,已删除的文档过多时发出重新生成快照的任务"""
+        conn = conn or get_redis_connection('default')
+        try:
+            applied = self.apply_changes(conn)
+        except Exception:
+            # 同步失败时继续使用当前的索引
+            logger.exception('同步商品搜索索引失败')
+            return 0
+        if self.deleted_ratio() > settings.NGRAM_COMPACT_RATIO:
+            request_snapshot(conn)
+        return applied
+
+    def dumps(self):
+        return pickle.dumps({
+            'sku_ids': self.sku_ids.tobytes(),
+            'names': self.names,
+            'deleted': self.deleted,
+            'postings': dict((term, postings.tobytes()) for term, postings in self.postings.items()),
+            'prefix_keys': self.prefix_keys,
+            'prefix_docs': self.prefix_docs.tobytes(),
+            'feed_id': self.feed_id,
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def loads(cls, data):
+        data = pickle.loads(data)
+        index = cls()
+        index.sku_ids.frombytes(data['sku_ids'])
+        index.names = data['names']
+        index.deleted = data['deleted']
+        index.deleted_order = array.array('I', sorted(index.deleted))
+        index.docnums = dict((sku_id, docnum) for docnum, sku_id in enumerate(index.sku_ids)
+                             if docnum not in index.deleted)
+        for term, postings in data['postings'].items():
+            index.postings[term] = array.array('I')
+            index.postings[term].frombytes(postings)
+        index.prefix_keys = data['prefix_keys']
+        index.prefix_docs.frombytes(data['prefix_docs'])
+        index.feed_id = data['feed_id']
+        return index
+
+
+def record_changes(pipe, update_ids=(), delete_ids=()):
+    """在pipeline中写入商品修改记录"""
+    for sku_id in update_ids:
+        pipe.xadd(CHANGE_STREAM_KEY, {'sku_id': sku_id, 'op': 'update'},
+                  maxlen=CHANGE_STREAM_MAXLEN, approximate=True)
+    for sku_id in delete_ids:
+        pipe.xadd(CHANGE_STREAM_KEY, {'sku_id': sku_id, 'op': 'delete'},
+                  maxlen=CHANGE_STREAM_MAXLEN, approximate=True)
+
+
+def is_trimmed(conn, feed_id):
+    """feed_id之后的修改记录是否可能已经被stream的MAXLEN裁剪"""
+    try:
+        info = conn.xinfo_stream(CHANGE_STREAM_KEY)
+    except Exception:
+        # stream不存在
+        return False
+    max_deleted = info.get('max-deleted-entry-id')
+    if max_deleted is not None:
+        # redis7以上记录了被裁剪的最大记录id
+        return stream_id(max_deleted.decode()) > stream_id(feed_id)
+    first = info.get('first-entry')
+    # 没有该信息时,stream达到过长度上限并且第一条记录晚于feed_id即认为有记录被裁剪
+    return first is not None and stream_id(first[0].decode()) > stream_id(feed_id) \
+        and info['length'] >= CHANGE_STREAM_MAXLEN
+
+
+def build_index(rows, feed_id='0-0'):
+    """rows为[(商品id, 名称, 简介)]"""
+    index = NgramIndex()
+    for sku_id, name, desc in rows:
+        index.add(sku_id, name, desc, sort_prefix=False)
+    index.sort_prefix()
+    index.feed_id = feed_id
+    return index
+
+
+def build_from_db(chunk_size=2000, conn=None):
+    """从数据库生成索引"""
+    conn = conn or get_redis_connection('default')
+    # 先记录stream的位置再读取数据库,读取期间的修改会在之后重新应用
+    last = conn.xrevrange(CHANGE_STREAM_KEY, count=1)
+    feed_id = last[0][0].decode() if last else '0-0'
+    rows = GoodsSKU.objects.order_by('id').values_list('id', 'name', 'desc').iterator(chunk_size=chunk_size)
+    return build_index(rows, feed_id)
+
+
+def save_snapshot(index, path=None):
+    """写入索引快照,先写临时文件再改名"""
+    path = path or settings.NGRAM_SNAPSHOT_PATH
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(index.dumps())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path=None):
+    """读取索引快照,不存在返回None"""
+    path = path or settings.NGRAM_SNAPSHOT_PATH
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    with open(path, 'rb') as f:
+        index = NgramIndex.loads(f.read())
+    index.snapshot_mtime = mtime
+    return index
+
+
+def request_snapshot(conn=None):
+    """发出重新生成快照的任务,同一时间只发出一个"""
+    conn = conn or get_redis_connection('default')
+    if conn.set(SNAPSHOT_SCHEDULED_KEY, 1, ex=600, nx=True):
+        from DailyFresh.celery_tasks.tasks import build_ngram_snapshot
+        build_ngram_snapshot.delay()
+
+
+def rebuild_snapshot(chunk_size=2000):
+    """从数据库生成索引并写入快照,由celery任务和管理命令调用"""
+    conn = get_redis_connection('default')
+    try:
+        index = build_from_db(chunk_size, conn)
+        save_snapshot(index)
+    finally:
+        conn.delete(SNAPSHOT_SCHEDULED_KEY)
+    return index
+
+
+_state = {
+    'index': None,
+}
+
+
+def load_latest(conn=None):
+    """加载新的快照并应用之后的修改记录,完成后替换本进程的索引"""
+    conn = conn or get_redis_connection('default')
+    index = load_snapshot()
+    if index is None:
+        request_snapshot(conn)
+        return
+    if is_trimmed(conn, index.feed_id):
+        # 快照之后的部分修改已经无法获取,先使用旧快照,同时重新生成
+        logger.warning('商品搜索索引快照过旧: %s', index.feed_id)
+        request_snapshot(conn)
+    index.sync(conn)
+    _state['index'] = index
+
+
+def snapshot_mtime():
+    try:
+        return os.path.getmtime(settings.NGRAM_SNAPSHOT_PATH)
+    except OSError:
+        return None
+
+
+def refresh():
+    """快照更新后重新加载,否则同步修改记录,在后台线程中每NGRAM_SYNC_INTERVAL秒调用一次"""
+    index = _state['index']
+    mtime = snapshot_mtime()
+    if mtime is None:
+        if index is None:
+            request_snapshot()
+    elif index is None or mtime > index.snapshot_mtime:
+        load_latest()
+        return
+    if index is not None:
+        index.sync()
+
+
+_refresher = PeriodicThread('ngram-index-refresher', refresh, lambda: settings.NGRAM_SYNC_INTERVAL)
+
+
+def get_index(wait=False):
+    """
+    本进程的索引,尚未加载完成时返回None
+    快照加载和修改记录的同步都在后台线程中进行,请求中只读取当前的索引
+    wait为True时在当前线程中加载且不启动后台线程,用于uwsgi主进程在fork之前预先加载
+    """
+    if wait:
+        try:
+            refresh()
+        except Exception:
+            logger.exception('加载商品搜索索引失败')
+    else:
+        _refresher.ensure_started()
+    return _state['index']
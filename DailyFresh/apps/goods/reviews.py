@@ -0,0 +1,87 @@
+import json
+
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.order.models import OrderGoods
+from DailyFresh.apps.order.signals import order_comments_submitted
+
+"""
+商品评论列表
+按照(update_time, id)倒序做游标分页,不使用OFFSET,翻到多深的页都只扫描一页的索引(df_order_goods(sku_id, update_time))
+游标为上一页最后一条评论的 "update_time|id"
+goods_reviews_商品id: 第一页评论的缓存 {reviews: [...], cursor: 下一页游标},写入评论后重新生成
+"""
+
+REVIEW_PAGE_KEY = 'goods_reviews_%d'
+
+
+def encode_cursor(review):
+    """根据一页中最后一条评论生成下一页的游标"""
+    return '%s|%d' % (review['update_time'], review['id'])
+
+
+def decode_cursor(cursor):
+    """解析游标,格式错误返回None"""
+    try:
+        update_time, review_id = cursor.split('|')
+        update_time = parse_datetime(update_time)
+        review_id = int(review_id)
+    except ValueError:
+        return None
+    if update_time is None:
+        return None
+    return update_time, review_id
+
+
+def fetch_reviews(sku_id, cursor=None, page_size=None):
+    """
+    查询一页评论,cursor为None时查询第一页
+    返回(reviews, next_cursor),没有下一页时next_cursor为None
+    """
+    page_size = page_size or settings.GOODS_REVIEW_PAGE_SIZE
+    reviews = OrderGoods.objects.filter(sku_id=sku_id).exclude(comment='')
+    if cursor is not None:
+        update_time, review_id = cursor
+        reviews = reviews.filter(Q(update_time__lt=update_time) | Q(update_time=update_time, id__lt=review_id))
+    # 多取一条判断是否还有下一页
+    rows = list(reviews.order_by('-update_time', '-id')
+                .values_list('id', 'comment', 'update_time', 'order__user__username')[:page_size + 1])
+
+    reviews = [{
+        'id': review_id,
+        'comment': comment,
+        'update_time': update_time.isoformat(sep=' '),
+        'username': username,
+    } for review_id, comment, update_time, username in rows[:page_size]]
+    next_cursor = encode_cursor(reviews[-1]) if len(rows) > page_size else None
+    return reviews, next_cursor
+
+
+def refresh_first_page(sku_id, conn=None):
+    """重新生成商品第一页评论的缓存"""
+    conn = conn or get_redis_connection('default')
+    reviews, next_cursor = fetch_reviews(sku_id)
+    page = {'reviews': reviews, 'cursor': next_cursor}
+    conn.set(REVIEW_PAGE_KEY % sku_id, json.dumps(page), ex=settings.GOODS_REVIEW_CACHE_TIMEOUT)
+    return page
+
+
+def get_first_page(sku_id, conn=None):
+    """获取商品的第一页评论,优先读取缓存"""
+    conn = conn or get_redis_connection('default')
+    page = conn.get(REVIEW_PAGE_KEY % sku_id)
+    if page is not None:
+        return json.loads(page.decode())
+    return refresh_first_page(sku_id, conn)
+
+
+@receiver(order_comments_submitted)
+def on_comments_submitted(sender, sku_ids, **kwargs):
+    """写入评论后只重新生成对应商品的第一页缓存"""
+    conn = get_redis_connection('default')
+    for sku_id in sku_ids:
+        refresh_first_page(sku_id, conn)
@@ -0,0 +1,100 @@
+import uuid
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Case, When, F, IntegerField
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from DailyFresh.apps.goods.models import GoodsSKU, GoodsSalesFlush
+
+"""
+商品销量计数
+下单时不再修改df_goods_sku.sales,销量增量先累加在redis的goods_sales_delta中{sku_id: 增量},
+由celery beat定时任务批量写入数据库,避免热门商品的行成为写热点
+页面展示和排序时使用 数据库销量 + redis中的增量
+写入时将增量改名为goods_sales_flushing并分配批次id,批次id与销量在同一个事务中写入df_goods_sales_flush,
+事务提交后进程退出、来不及删除goods_sales_flushing时,下一次写入发现批次已经存在,只删除不再累加
+"""
+
+SALES_DELTA_KEY = 'goods_sales_delta'
+# 正在写入数据库的增量
+SALES_FLUSHING_KEY = 'goods_sales_flushing'
+SALES_LOCK_KEY = 'goods_sales_lock'
+# 正在写入数据库的增量的批次id
+SALES_BATCH_KEY = 'goods_sales_flush_batch'
+# 写入批次记录的保留时间
+FLUSH_BATCH_KEEP = timedelta(days=1)
+# 每条UPDATE语句更新的商品数
+FLUSH_CHUNK_SIZE = 500
+
+
+def incr_sales(counts, conn=None):
+    """累加商品销量增量,counts为{sku_id: count},count为负数时减少销量"""
+    if not counts:
+        return
+    conn = conn or get_redis_connection('default')
+    pipe = conn.pipeline()
+    for sku_id, count in counts.items():
+        pipe.hincrby(SALES_DELTA_KEY, sku_id, count)
+    pipe.execute()
+
+    # 同时更新列表页的销量排序索引
+    from DailyFresh.apps.goods import list_index
+    list_index.incr_sales(counts, conn)
+
+
+def merge_sales(skus, conn=None):
+    """一次往返将redis中的销量增量合并到商品的sales属性上"""
+    skus = list(skus)
+    if not skus:
+        return skus
+    conn = conn or get_redis_connection('default')
+    sku_ids = [sku.id for sku in skus]
+    # 正在写入数据库的增量同样需要合并
+    pipe = conn.pipeline()
+    pipe.hmget(SALES_DELTA_KEY, sku_ids)
+    pipe.hmget(SALES_FLUSHING_KEY, sku_ids)
+    deltas, flushing = pipe.execute()
+    for sku, delta, pending in zip(skus, deltas, flushing):
+        sku.sales += int(delta or 0) + int(pending or 0)
+    return skus
+
+
+def flush_sales(conn=None):
+    """将redis中的销量增量批量写入数据库,返回更新的商品数"""
+    conn = conn or get_redis_connection('default')
+    with conn.lock(SALES_LOCK_KEY, timeout=300):
+        # 上一次写入中断时先处理遗留的增量,否则将当前增量整体改名,之后的下单累加到新的hash中
+        if not conn.exists(SALES_FLUSHING_KEY):
+            if not conn.exists(SALES_DELTA_KEY):
+                return 0
+            pipe = conn.pipeline()
+            pipe.rename(SALES_DELTA_KEY, SALES_FLUSHING_KEY)
+            pipe.set(SALES_BATCH_KEY, uuid.uuid4().hex)
+            pipe.execute()
+
+        batch_id = conn.get(SALES_BATCH_KEY)
+        if batch_id is None:
+            # 改名后来不及写入批次id,遗留的增量还没有写入过数据库
+            batch_id = uuid.uuid4().hex
+            conn.set(SALES_BATCH_KEY, batch_id)
+        else:
+            batch_id = batch_id.decode()
+
+        deltas = [(int(sku_id), int(delta)) for sku_id, delta in conn.hgetall(SALES_FLUSHING_KEY).items()]
+        deltas = [(sku_id, delta) for sku_id, delta in deltas if delta]
+        with transaction.atomic():
+            _, created = GoodsSalesFlush.objects.get_or_create(batch_id=batch_id)
+            if created:
+                for i in range(0, len(deltas), FLUSH_CHUNK_SIZE):
+                    chunk = deltas[i:i + FLUSH_CHUNK_SIZE]
+                    sales = Case(*[When(id=sku_id, then=F('sales') + delta) for sku_id, delta in chunk],
+                                 output_field=IntegerField())
+                    GoodsSKU.objects.filter(id__in=[sku_id for sku_id, _ in chunk]).update(sales=sales)
+            else:
+                # 该批次已经写入,上一次在删除redis中的增量前中断
+                deltas = []
+            GoodsSalesFlush.objects.filter(created_time__lt=timezone.now() - FLUSH_BATCH_KEEP).delete()
+        conn.delete(SALES_FLUSHING_KEY, SALES_BATCH_KEY)
+    return len(deltas)
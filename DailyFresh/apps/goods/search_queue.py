@@ -0,0 +1,139 @@
+import hashlib
+import logging
+
+from django.db import transaction
+from django.db.models import signals
+from django_redis import get_redis_connection
+from haystack import connections
+from haystack.signals import BaseSignalProcessor
+from haystack.utils import get_model_ct
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods import ngram_search, search_results
+from DailyFresh.apps.goods.models import GoodsSKU, Goods
+
+"""
+搜索索引的异步更新
+代替RealtimeSignalProcessor,商品保存、删除时只把商品id放入redis集合,由celery任务批量写入whoosh索引,
+请求中不再同步写索引,也不会在whoosh的文件锁上排队
+商品保存时比较索引内容(名称、简介、SPU)的摘要,只修改了库存、销量、价格等字段时不更新索引
+search_pending_update: 需要更新索引的商品id
+search_pending_delete: 需要从索引中删除的商品id
+search_fingerprint: 已写入索引的商品内容摘要 {商品id: 摘要}
+"""
+
+logger = logging.getLogger(__name__)
+
+PENDING_UPDATE_KEY = 'search_pending_update'
+PENDING_DELETE_KEY = 'search_pending_delete'
+FINGERPRINT_KEY = 'search_fingerprint'
+# 更新索引的任务已经发出的标记
+DRAIN_SCHEDULED_KEY = 'search_drain_scheduled'
+
+
+def fingerprint(sku):
+    """索引内容的摘要,索引模板search/indexes/goods/goodssku_text.txt中使用的字段"""
+    text = '\x00'.join([sku.name, sku.desc, str(sku.goods_id)])
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def schedule_drain(pipe):
+    """在pipeline中设置标记,返回的结果为True时需要发出任务"""
+    pipe.set(DRAIN_SCHEDULED_KEY, 1, ex=60, nx=True)
+
+
+def enqueue(update_ids=(), delete_ids=(), conn=None):
+    """登记需要更新或删除索引的商品,事务提交后发出任务"""
+    if not update_ids and not delete_ids:
+        return
+
+    def push():
+        redis_conn = conn or get_redis_connection('default')
+        pipe = redis_conn.pipeline()
+        if update_ids:
+            pipe.sadd(PENDING_UPDATE_KEY, *update_ids)
+        if delete_ids:
+            pipe.sadd(PENDING_DELETE_KEY, *delete_ids)
+            pipe.hdel(FINGERPRINT_KEY, *delete_ids)
+        # 进程内搜索索引的修改记录
+        ngram_search.record_changes(pipe, update_ids, delete_ids)
+        schedule_drain(pipe)
+        if pipe.execute()[-1]:
+            from DailyFresh.celery_tasks.tasks import drain_search_index
+            drain_search_index.apply_async(countdown=1)
+
+    transaction.on_commit(push)
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """只监听商品和SPU的保存、删除,放入队列后由celery任务写入索引"""
+
+    def setup(self):
+        signals.post_save.connect(self.handle_save, sender=GoodsSKU)
+        signals.post_delete.connect(self.handle_delete, sender=GoodsSKU)
+        # SPU的详情同样写入了商品的索引
+        signals.post_save.connect(self.handle_goods_save, sender=Goods)
+
+    def teardown(self):
+        signals.post_save.disconnect(self.handle_save, sender=GoodsSKU)
+        signals.post_delete.disconnect(self.handle_delete, sender=GoodsSKU)
+        signals.post_save.disconnect(self.handle_goods_save, sender=Goods)
+
+    def handle_save(self, sender, instance, **kwargs):
+        conn = get_redis_connection('default')
+        indexed = conn.hget(FINGERPRINT_KEY, instance.id)
+        if indexed is not None and indexed.decode() == fingerprint(instance):
+            # 索引内容没有变化
+            return
+        enqueue(update_ids=[instance.id], conn=conn)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        enqueue(delete_ids=[instance.id])
+
+    def handle_goods_save(self, sender, instance, **kwargs):
+        enqueue(update_ids=list(GoodsSKU.objects.filter(goods_id=instance.id).values_list('id', flat=True)))
+
+
+def drain(batch_size=None, conn=None):
+    """分批将队列中的商品写入索引,返回(更新数, 删除数)"""
+    conn = conn or get_redis_connection('default')
+    batch_size = batch_size or settings.SEARCH_INDEX_BATCH_SIZE
+    backend = connections['default'].get_backend()
+    index = connections['default'].get_unified_index().get_index(GoodsSKU)
+    ct = get_model_ct(GoodsSKU)
+
+    updated = 0
+    deleted = 0
+    while True:
+        # 清除标记后再取队列,之后放入的商品会重新发出任务
+        conn.delete(DRAIN_SCHEDULED_KEY)
+        delete_ids = [int(sku_id) for sku_id in conn.spop(PENDING_DELETE_KEY, batch_size) or []]
+        update_ids = [int(sku_id) for sku_id in conn.spop(PENDING_UPDATE_KEY, batch_size) or []]
+        if not delete_ids and not update_ids:
+            return updated, deleted
+
+        try:
+            skus = list(GoodsSKU.objects.filter(id__in=update_ids).select_related('goods'))
+            # 取出时已经被删除的商品同样从索引中删除
+            delete_ids = set(delete_ids) | (set(update_ids) - set(sku.id for sku in skus))
+            for sku_id in delete_ids:
+                backend.remove('%s.%d' % (ct, sku_id))
+            if skus:
+                # 一个批次只提交一次whoosh写入
+                backend.update(index, skus)
+        except Exception:
+            # 放回队列等待下一次处理
+            pipe = conn.pipeline()
+            if update_ids:
+                pipe.sadd(PENDING_UPDATE_KEY, *update_ids)
+            if delete_ids:
+                pipe.sadd(PENDING_DELETE_KEY, *delete_ids)
+            pipe.execute()
+            logger.exception('更新搜索索引失败')
+            raise
+
+        if skus:
+            conn.hmset(FINGERPRINT_KEY, dict((sku.id, fingerprint(sku)) for sku in skus))
+        search_results.bump_version(conn)
+        updated += len(skus)
+        deleted += len(delete_ids)
@@ -0,0 +1,58 @@
+import hashlib
+import json
+
+from django_redis import get_redis_connection
+from haystack.inputs import AutoQuery
+from haystack.query import SearchQuerySet
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods.listing import CARD_FIELDS
+from DailyFresh.apps.goods.models import GoodsSKU
+
+"""
+搜索结果缓存
+同一个搜索关键字(去掉多余空白、转为小写后)的排序结果只查询一次whoosh,商品id列表以json保存在redis中,
+    翻页时从缓存的id列表中取出当前页,再一次查询出当前页的全部商品
+search_version: 搜索索引的版本,写入索引后增加,缓存的键中带有版本,索引修改后旧的结果不再使用,由过期时间清理
+search_result_版本_关键字摘要: 商品id列表
+"""
+
+SEARCH_VERSION_KEY = 'search_version'
+RESULT_KEY = 'search_result_%d_%s'
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+def bump_version(conn=None):
+    """搜索索引修改后调用,使缓存的搜索结果失效"""
+    conn = conn or get_redis_connection('default')
+    conn.incr(SEARCH_VERSION_KEY)
+
+
+def search_ids(query):
+    """查询whoosh,返回按照相关度排序的商品id"""
+    sqs = SearchQuerySet().models(GoodsSKU).filter(content=AutoQuery(query))
+    return [int(result.pk) for result in sqs[:settings.SEARCH_RESULT_LIMIT]]
+
+
+def get_result_ids(query, conn=None):
+    """获取搜索关键字的商品id列表,优先读取缓存"""
+    conn = conn or get_redis_connection('default')
+    query = normalize_query(query)
+    version = int(conn.get(SEARCH_VERSION_KEY) or 0)
+    key = RESULT_KEY % (version, hashlib.sha1(query.encode()).hexdigest())
+    ids = conn.get(key)
+    if ids is not None:
+        return json.loads(ids.decode())
+
+    ids = search_ids(query)
+    conn.set(key, json.dumps(ids), ex=settings.SEARCH_RESULT_CACHE_TIMEOUT)
+    return ids
+
+
+def load_skus(sku_ids):
+    """一次查询出商品,保持sku_ids的顺序,已经删除的商品跳过"""
+    skus = GoodsSKU.objects.only(*CARD_FIELDS).in_bulk(sku_ids)
+    return [skus[sku_id] for sku_id in sku_ids if sku_id in skus]
@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from django.template import loader
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods import index_data
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+静态首页
+后台修改首页数据时调用request_render()登记修改时间,短时间内的多次修改合并为一次生成:
+    第一次修改时发出延迟STATIC_INDEX_DEBOUNCE秒执行的任务,之后的修改只更新修改时间,
+    任务执行时距离最后一次修改不足STATIC_INDEX_DEBOUNCE秒则推迟到静默期结束后再执行
+生成的文件先写入同一目录下的临时文件再改名,读取的一方不会看到写了一半的文件,
+同时生成预压缩的index.html.gz、index.html.br(安装了brotli时)和记录ETag的index.html.json,
+nginx开启gzip_static/brotli_static后可以直接返回
+static_index_changed_at: 最后一次修改的时间
+static_index_scheduled: 生成任务已经发出的标记
+"""
+
+CHANGED_AT_KEY = 'static_index_changed_at'
+SCHEDULED_KEY = 'static_index_scheduled'
+
+
+def get_save_path():
+    return os.path.join(settings.BASE_DIR, 'static/index.html')
+
+
+def request_render(conn=None):
+    """首页数据发生修改,登记重新生成静态首页"""
+    conn = conn or get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.set(CHANGED_AT_KEY, time.time())
+    # 标记的有效期兜底,任务丢失时之后的修改可以重新发出任务
+    pipe.set(SCHEDULED_KEY, 1, ex=settings.STATIC_INDEX_DEBOUNCE * 10, nx=True)
+    if pipe.execute()[-1]:
+        from DailyFresh.celery_tasks.tasks import generate_static_index_html
+        generate_static_index_html.apply_async(countdown=settings.STATIC_INDEX_DEBOUNCE)
+
+
+def pending_delay(conn=None):
+    """距离静默期结束还需要等待的秒数,为0时可以生成"""
+    conn = conn or get_redis_connection('default')
+    changed_at = conn.get(CHANGED_AT_KEY)
+    if changed_at is None:
+        return 0
+    return max(0, float(changed_at) + settings.STATIC_INDEX_DEBOUNCE - time.time())
+
+
+def atomic_write(path, content):
+    """先写入临时文件再改名,替换是原子的"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def render(conn=None):
+    """生成静态首页及其压缩文件,内容没有变化时不写入,返回ETag"""
+    # 清除标记后再读取数据,之后的修改会重新发出任务
+    conn = conn or get_redis_connection('default')
+    conn.delete(SCHEDULED_KEY)
+
+    # 与首页共用同一份首页数据
+    context = index_data.get_index_context(conn)
+    content = loader.get_template('static_index.html').render(context).encode()
+    etag = hashlib.sha1(content).hexdigest()
+
+    save_path = get_save_path()
+    manifest_path = save_path + '.json'
+    try:
+        with open(manifest_path) as f:
+            if json.load(f).get('etag') == etag and os.path.exists(save_path):
+                return etag
+    except (IOError, ValueError):
+        pass
+
+    files = {'': len(content)}
+    # 压缩文件先于index.html替换,nginx不会返回比index.html旧的压缩文件
+    # mtime=0使相同的内容生成相同的压缩文件
+    gz = gzip.compress(content, compresslevel=9, mtime=0)
+    atomic_write(save_path + '.gz', gz)
+    files['.gz'] = len(gz)
+    if brotli is not None:
+        br = brotli.compress(content)
+        atomic_write(save_path + '.br', br)
+        files['.br'] = len(br)
+    elif os.path.exists(save_path + '.br'):
+        # 不能生成时删除旧的br文件,避免返回过期的内容
+        os.remove(save_path + '.br')
+    atomic_write(save_path, content)
+
+    manifest = {
+        'etag': etag,
+        'generated_at': time.time(),
+        'files': dict(('index.html' + suffix, size) for suffix, size in files.items()),
+    }
+    atomic_write(manifest_path, json.dumps(manifest).encode())
+    return etag
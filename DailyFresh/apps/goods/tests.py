@@ -0,0 +1,198 @@
+from decimal import Decimal
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from DailyFresh.apps.goods import detail, facets, ngram_search
+
+
+class FakeStream(object):
+    """按照XREAD的格式返回预先放入的修改记录"""
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def xread(self, streams, count=None):
+        last_id = list(streams.values())[0]
+        messages = [m for m in self.messages if m[0].decode() > last_id][:count]
+        if not messages:
+            return []
+        return [(b'stream', messages)]
+
+
+def sku_rows(*rows):
+    """模拟values_list查询的结果"""
+    queryset = mock.Mock()
+    queryset.values_list.return_value = iter(rows)
+    return queryset
+
+
+class FacetIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.index = facets.FacetIndex()
+        # (商品id, 种类id, 价格, 库存)
+        self.index.load([
+            (1, 1, Decimal('5.00'), 10),
+            (2, 1, Decimal('15.00'), 0),
+            (3, 2, Decimal('15.00'), 3),
+            (4, 2, Decimal('150.00'), 1),
+            (20, 3, Decimal('60.00'), 0),
+        ])
+
+    def test_filter_without_selection(self):
+        sku_ids, counts = self.index.filter([4, 1, 3, 2], {})
+        self.assertEqual(sku_ids, [4, 1, 3, 2])
+        self.assertEqual(counts['category'], {1: 2, 2: 2})
+        self.assertEqual(counts['price'], {0: 1, 1: 2, 4: 1})
+        self.assertEqual(counts['stock'], {1: 3, 0: 1})
+
+    def test_filter_keeps_order(self):
+        sku_ids, _ = self.index.filter([20, 4, 3, 2, 1], {'stock': 1})
+        self.assertEqual(sku_ids, [4, 3, 1])
+
+    def test_counts_use_other_groups(self):
+        sku_ids, counts = self.index.filter([1, 2, 3, 4], {'category': 1, 'stock': 1})
+        self.assertEqual(sku_ids, [1])
+        # 种类的数量只受有货筛选影响,切换种类时数量不变
+        self.assertEqual(counts['category'], {1: 1, 2: 2})
+        # 有货的数量只受种类筛选影响
+        self.assertEqual(counts['stock'], {1: 1, 0: 1})
+        self.assertEqual(counts['price'], {0: 1})
+
+    def test_unknown_facet(self):
+        sku_ids, _ = self.index.filter([1, 2, 3], {'category': 99})
+        self.assertEqual(sku_ids, [])
+
+    def test_apply_changes(self):
+        conn = FakeStream([(b'1-0', {b'sku_id': b'2'}), (b'2-0', {b'sku_id': b'4'})])
+        # 商品2补货,商品4已被删除
+        with mock.patch.object(facets.GoodsSKU.objects, 'filter', return_value=sku_rows(
+                (2, 1, Decimal('15.00'), 8))):
+            self.assertEqual(self.index.apply_changes(conn), 2)
+        self.assertEqual(self.index.feed_id, '2-0')
+        sku_ids, counts = self.index.filter([1, 2, 3, 4], {'stock': 1})
+        self.assertEqual(sku_ids, [1, 2, 3])
+        self.assertEqual(counts['category'], {1: 2, 2: 1})
+
+    def test_apply_changes_db_error(self):
+        conn = FakeStream([(b'1-0', {b'sku_id': b'1'})])
+        with mock.patch.object(facets.GoodsSKU.objects, 'filter', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.index.apply_changes(conn)
+        # 位图和stream的位置都没有变化,下次同步会重新应用
+        self.assertEqual(self.index.feed_id, '0-0')
+        self.assertEqual(self.index.filter([1], {'category': 1})[0], [1])
+
+    def test_filter_results_before_loaded(self):
+        # 位图生成之前只查询搜索结果中的商品,不阻塞请求
+        with mock.patch.dict(facets._state, {'index': None}), \
+                mock.patch.object(facets._refresher, 'ensure_started'), \
+                mock.patch.object(facets.GoodsSKU.objects, 'filter', return_value=sku_rows(
+                    (3, 2, Decimal('15.00'), 3), (2, 1, Decimal('15.00'), 0))) as query:
+            sku_ids, counts = facets.filter_results([3, 2], {'stock': 1})
+        query.assert_called_once_with(id__in=[3, 2])
+        self.assertEqual(sku_ids, [3])
+        self.assertEqual(counts['category'], {2: 1})
+
+
+class NgramIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.index = ngram_search.build_index([
+            (1, '山东有机草莓 500g', '产地直发'),
+            (2, '丹东草莓 1kg', '当日采摘'),
+            (3, '有机苹果', '口感细腻'),
+            (4, '草莓酸奶', '无添加'),
+        ])
+
+    def test_search(self):
+        # 最新的商品在前
+        self.assertEqual(self.index.search('草莓'), (3, [4, 2, 1]))
+        self.assertEqual(self.index.search('有机草莓'), (1, [1]))
+        self.assertEqual(self.index.search('有机'), (2, [3, 1]))
+        self.assertEqual(self.index.search('香蕉'), (0, []))
+        self.assertEqual(self.index.search('  '), (0, []))
+
+    def test_search_page(self):
+        self.assertEqual(self.index.search('草莓', offset=1, limit=1), (3, [2]))
+        self.assertEqual(self.index.search('草莓', offset=3, limit=1), (3, []))
+
+    def test_search_desc(self):
+        self.assertEqual(self.index.search('采摘'), (1, [2]))
+
+    def test_suggest(self):
+        self.assertEqual(self.index.suggest('丹东'), [(2, '丹东草莓 1kg')])
+        self.assertEqual(self.index.suggest('有'), [(3, '有机苹果')])
+        self.assertEqual(self.index.suggest('西'), [])
+
+    def test_add_and_remove(self):
+        # 更新商品后只能搜索到新的内容
+        self.index.add(2, '丹东蓝莓 1kg', '当日采摘')
+        self.assertEqual(self.index.search('草莓'), (2, [4, 1]))
+        self.assertEqual(self.index.search('蓝莓'), (1, [2]))
+        self.assertEqual(self.index.suggest('丹东'), [(2, '丹东蓝莓 1kg')])
+
+        self.index.remove(4)
+        self.assertEqual(self.index.search('草莓'), (1, [1]))
+        self.assertEqual(self.index.suggest('草莓'), [])
+        self.assertEqual(self.index.name(4), '')
+        self.assertEqual(len(self.index), 3)
+
+    def test_dumps_and_loads(self):
+        self.index.remove(1)
+        self.index.feed_id = '5-0'
+        index = ngram_search.NgramIndex.loads(self.index.dumps())
+        self.assertEqual(index.search('草莓'), (2, [4, 2]))
+        self.assertEqual(index.suggest('有'), [(3, '有机苹果')])
+        self.assertEqual(index.feed_id, '5-0')
+        self.assertEqual(len(index), 3)
+
+    def test_apply_changes(self):
+        conn = FakeStream([
+            (b'1-0', {b'sku_id': b'3', b'op': b'update'}),
+            (b'2-0', {b'sku_id': b'4', b'op': b'delete'}),
+        ])
+        with mock.patch.object(ngram_search.GoodsSKU.objects, 'filter', return_value=sku_rows(
+                (3, '有机草莓干', '口感细腻'))):
+            self.assertEqual(self.index.apply_changes(conn), 2)
+        self.assertEqual(self.index.feed_id, '2-0')
+        self.assertEqual(self.index.search('草莓'), (3, [3, 2, 1]))
+
+    def test_apply_changes_db_error(self):
+        conn = FakeStream([(b'1-0', {b'sku_id': b'4', b'op': b'update'})])
+        with mock.patch.object(ngram_search.GoodsSKU.objects, 'filter', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.index.apply_changes(conn)
+        # 没有跳过这批修改,下次同步重新应用
+        self.assertEqual(self.index.feed_id, '0-0')
+        self.assertEqual(self.index.search('酸奶'), (1, [4]))
+
+    def test_get_index_reads_only(self):
+        # 请求中只读取当前的索引,同步在后台线程中进行
+        with mock.patch.dict(ngram_search._state, {'index': self.index}), \
+                mock.patch.object(ngram_search._refresher, 'ensure_started') as started, \
+                mock.patch.object(self.index, 'sync') as sync:
+            self.assertIs(ngram_search.get_index(), self.index)
+        started.assert_called_once_with()
+        sync.assert_not_called()
+
+
+class DetailVersionTest(SimpleTestCase):
+
+    def test_sku_moved(self):
+        # 修改了SPU和种类时,原来的SPU和种类的版本同样增加
+        sku = mock.Mock(pk=1, id=1, goods_id=3, category_id=4)
+        with mock.patch.object(detail, 'saved_fields', return_value=(2, 4)), \
+                mock.patch.object(detail, 'bump_versions') as bump:
+            detail.remember_sku_relations(detail.GoodsSKU, sku)
+            detail.on_sku_changed(detail.GoodsSKU, sku)
+        bump.assert_called_once_with('sku:1', 'goods:3', 'type:4', 'goods:2')
+
+    def test_image_moved(self):
+        image = mock.Mock(pk=1, sku_id=7)
+        with mock.patch.object(detail, 'saved_fields', return_value=(6,)), \
+                mock.patch.object(detail, 'bump_versions') as bump:
+            detail.remember_image_sku(detail.GoodsImage, image)
+            detail.on_image_changed(detail.GoodsImage, image)
+        bump.assert_called_once_with('sku:7', 'sku:6')
@@ -1,10 +1,15 @@
 from django.conf.urls import url
 
-from DailyFresh.apps.goods.views import IndexView, DetailView, ListView
+from DailyFresh.apps.goods.views import IndexView, DetailView, ListView, ReviewListView, SuggestView, \
+    QuickSearchView, SearchView
 
 urlpatterns = [
     url(r'^index$', IndexView.as_view(), name='index'),  # 首页
     url(r'^goods/(?P<sku_id>\d+)$', DetailView.as_view(), name='detail'),  # 详情页
+    url(r'^goods/(?P<sku_id>\d+)/comments$', ReviewListView.as_view(), name='comments'),  # 评论分页
     url(r'^list/(?P<type_id>\d+)/(?P<page>\d+)$', ListView.as_view(), name='list'),  # 列表页
+    url(r'^search/$', SearchView.as_view(), name='search'),  # 搜索结果页
+    url(r'^search/suggest$', SuggestView.as_view(), name='suggest'),  # 搜索补全
+    url(r'^search/quick$', QuickSearchView.as_view(), name='quick_search'),  # 进程内索引搜索
 
 ]
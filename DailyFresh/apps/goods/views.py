@@ -1,13 +1,15 @@
-from django.core.cache import cache
 from django.core.paginator import Paginator
+from django.http import JsonResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.views.generic.base import View
 from django_redis import get_redis_connection
 
-from DailyFresh.apps.goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner, \
-    GoodsSKU
-from DailyFresh.apps.order.models import OrderGoods
+from DailyFresh.apps.goods.models import GoodsType, GoodsSKU
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods import detail, facets, index_data, listing, ngram_search, reviews, search_results
+from DailyFresh.apps.goods.context_processors import get_goods_types
+from DailyFresh.apps.goods.sales import merge_sales
 
 
 class IndexView(View):
@@ -15,31 +17,8 @@ class IndexView(View):
 
     def get(self, request):
         """展示页面"""
-        # 尝试从缓存中获取数据
-        context = cache.get('index_page_data')
-        if context is None:
-            # 获取商品的分类信息
-            types = GoodsType.objects.all()
-            # 获取首页的轮播商品信息
-            index_banner = IndexGoodsBanner.objects.all().order_by('index')
-            # 获取首页促销活动的信息
-            promotion_banner = IndexPromotionBanner.objects.all().order_by('index')
-            # 获取首页分类商品的展示信息
-            for category in types:
-                image_banner = IndexTypeGoodsBanner.objects.filter(category=category, display_type=1)
-                title_banner = IndexTypeGoodsBanner.objects.filter(category=category, display_type=0)
-                category.title_banner = title_banner
-                category.image_banner = image_banner
-
-            context = {
-                'type': types,
-                'index_banner': index_banner,
-                'promotion_banner': promotion_banner,
-                'cart_count': 0,
-            }
-            # 缓存数据
-            # cache.set('缓存名称', '缓存数据', '缓存有效时间')
-            cache.set('index_page_data', context, 3600)
+        # 获取首页数据,各部分分别缓存,只重新查询修改过的部分
+        context = index_data.get_index_context()
 
         # 判断用户是否已登录
         cart_count = 0
@@ -63,26 +42,19 @@ class DetailView(View):
 
     def get(self, request, sku_id):
         """展示"""
-        # 获取商品的详细信息
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        # 获取商品详情页数据(商品、分类、同一SPU的其他规格、新品推荐),优先读取缓存
+        conn = get_redis_connection('default')
+        payload = detail.get_detail_payload(int(sku_id), conn)
+        if payload is None:
             # 商品不存在直接跳回首页
             return redirect(reverse('goods:index'))
 
-        # 获取商品的分类信息
-        types = GoodsType.objects.all()
-        # 获取商品的评论信息
-        order_skus = OrderGoods.objects.filter(sku=sku).exclude(comment='').order_by('-update_time')
-        # 获取同一SPU的其他规格商品
-        same_spu_skus = GoodsSKU.objects.filter(goods=sku.goods).exclude(id=sku_id)
-        # 获取同一种类的新品信息
-        new_skus = GoodsSKU.objects.filter(category=sku.category).order_by('-created_time')[:2]
+        # 获取商品的第一页评论,其余的评论通过ajax分页加载
+        review_page = reviews.get_first_page(int(sku_id), conn)
 
         # 若用户登录,获取购物车中的商品的条目数
         cart_count = 0
         if request.user.is_authenticated():
-            conn = get_redis_connection('default')
             cart_key = 'cart_%d' % request.user.id
             # hlen(key)->返回属性的数量
             cart_count = conn.hlen(cart_key)
@@ -105,16 +77,34 @@ class DetailView(View):
             conn.ltrim(history_key, 0, 4)
 
         context = {
-            'sku': sku,
-            'types': types,
-            'order_skus': order_skus,
-            'same_spu_skus': same_spu_skus,
-            'new_skus': new_skus,
+            'sku': payload['sku'],
+            'order_skus': review_page['reviews'],
+            'review_cursor': review_page['cursor'] or '',
+            'same_spu_skus': payload['same_spu_skus'],
+            'new_skus': payload['new_skus'],
             'cart_count': cart_count,
         }
         return render(request, 'detail.html', context)
 
 
+# 前端传递过来的参数:游标(cursor)
+# url地址:/goods/商品id/comments?cursor=游标
+class ReviewListView(View):
+    """商品评论分页"""
+
+    def get(self, request, sku_id):
+        cursor = request.GET.get('cursor', '')
+        if not cursor:
+            page = reviews.get_first_page(int(sku_id))
+            return JsonResponse({'res': 1, 'reviews': page['reviews'], 'cursor': page['cursor']})
+
+        cursor = reviews.decode_cursor(cursor)
+        if cursor is None:
+            return JsonResponse({'res': 0, 'error_msg': '参数错误'})
+        page, next_cursor = reviews.fetch_reviews(int(sku_id), cursor)
+        return JsonResponse({'res': 1, 'reviews': page, 'cursor': next_cursor})
+
+
 # 前端传递过来的参数:种类id(type_id) 页码(page) 排列方式(sort)
 # url地址:/list/种类id/页码?sort=排列方式
 class ListView(View):
@@ -131,10 +121,7 @@ class ListView(View):
         try:
             category = GoodsType.objects.get(id=type_id)
         except GoodsType.DoesNotExist:
-            return redirect(reverse('goods: index'))
-
-        # 获取所有种类
-        types = GoodsType.objects.all()
+            return redirect(reverse('goods:index'))
 
         # 获取排列顺序
         # 排列顺序:
@@ -142,29 +129,21 @@ class ListView(View):
         # 2.sort=sales:按照商品的销量排序(从高到低)
         # 3.sort=default:按照默认排序方式(id)排序(从高到低)
         sort = request.GET.get('sort', '')
-
-        # 按照种类获取商品信息的排列结果集
-        if sort == 'price':
-            skus = GoodsSKU.objects.filter(category=category).order_by('price')
-        elif sort == 'sales':
-            skus = GoodsSKU.objects.filter(category=category).order_by('-sales')
-        else:
+        if sort not in listing.SORTS:
             sort = 'default'
-            skus = GoodsSKU.objects.filter(category=category).order_by('-id')
 
-        # 将结果集按照每页显示5条数据进行分页操作
-        paginator = Paginator(skus, 5)
-
-        # 处理页码
-        page = int(page)
-        if page > paginator.num_pages:
-            page = 1
-
-        # 获取第page页内容,返回Page类的实例对象
-        skus_page = paginator.page(page)
+        # 获取第page页内容,点击上一页/下一页时携带游标,不需要OFFSET
+        conn = get_redis_connection('default')
+        skus_page = listing.get_page(category.id, sort, int(page),
+                                     after=request.GET.get('after'), before=request.GET.get('before'), conn=conn)
+        page = skus_page.number
+        # 合并redis中尚未写入数据库的销量
+        skus_page.object_list = merge_sales(skus_page.object_list, conn)
+        if sort == 'sales':
+            skus_page.object_list.sort(key=lambda sku: (-sku.sales, -sku.id))
 
         # 页码处理
-        num_pages = paginator.num_pages
+        num_pages = skus_page.num_pages
         if num_pages < 5:
             # 1-num_pages
             pages = range(1, num_pages + 1)
@@ -183,13 +162,11 @@ class ListView(View):
         # 如果用户登录,获取用户购物车中商品的条目数
         cart_count = 0
         if request.user.is_authenticated():
-            conn = get_redis_connection('default')
             cart_key = 'cart_%s' % request.user.id
-            cart_count = conn.lhen(cart_key)
+            cart_count = conn.hlen(cart_key)
 
         context = {
             'type': category,
-            'types': types,
             'skus_page': skus_page,
             'new_skus': new_skus,
             'cart_count': cart_count,
@@ -198,3 +175,73 @@ class ListView(View):
         }
 
         return render(request, 'list.html', context)
+
+
+# 前端传递过来的参数:输入的前缀(q)
+# url地址:/search/suggest?q=前缀
+class SuggestView(View):
+    """搜索框的商品名称补全"""
+
+    def get(self, request):
+        prefix = request.GET.get('q', '').strip()
+        if not prefix:
+            return JsonResponse({'res': 1, 'suggestions': []})
+
+        index = ngram_search.get_index()
+        if index is None:
+            return JsonResponse({'res': 0, 'error_msg': '搜索索引加载中'})
+        suggestions = index.suggest(prefix)
+        return JsonResponse({'res': 1, 'suggestions': [{'id': sku_id, 'name': name} for sku_id, name in suggestions]})
+
+
+# 前端传递过来的参数:搜索关键字(q) 页码(page)
+# url地址:/search/quick?q=关键字&page=页码
+class QuickSearchView(View):
+    """使用进程内索引搜索商品,返回商品id和名称"""
+
+    page_size = 20
+
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            return JsonResponse({'res': 0, 'error_msg': '参数错误'})
+        if not query:
+            return JsonResponse({'res': 0, 'error_msg': '请输入搜索关键字'})
+
+        index = ngram_search.get_index()
+        if index is None:
+            return JsonResponse({'res': 0, 'error_msg': '搜索索引加载中'})
+        total, sku_ids = index.search(query, offset=(page - 1) * self.page_size, limit=self.page_size)
+        skus = [{'id': sku_id, 'name': index.name(sku_id)} for sku_id in sku_ids]
+        return JsonResponse({'res': 1, 'total': total, 'page': page, 'skus': skus})
+
+
+# 前端传递过来的参数:搜索关键字(q) 页码(page) 种类id(category) 价格区间(price) 有货(stock)
+# url地址:/search/?q=关键字&page=页码&category=种类id&price=价格区间&stock=1
+class SearchView(View):
+    """商品搜索结果页"""
+
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        context = {'query': query, 'page': None, 'paginator': None, 'facets': None, 'filters': ''}
+        if not query:
+            return render(request, 'search/search.html', context)
+
+        # 搜索结果的商品id列表,相同的关键字只查询一次whoosh
+        sku_ids = search_results.get_result_ids(query)
+        # 在内存中按照筛选项的位图筛选,并统计每个筛选项的商品数
+        selected = facets.parse_selected(request.GET)
+        sku_ids, counts = facets.filter_results(sku_ids, selected)
+        context['facets'] = facets.facet_options(counts, selected, get_goods_types())
+        # 翻页链接中保留已选的筛选项
+        context['filters'] = facets.filter_params(selected)
+
+        paginator = Paginator(sku_ids, settings.HAYSTACK_SEARCH_RESULTS_PER_PAGE)
+        page = paginator.get_page(request.GET.get('page'))
+        # 一次查询出当前页的全部商品
+        page.object_list = search_results.load_skus(list(page.object_list))
+
+        context.update(page=page, paginator=paginator)
+        return render(request, 'search/search.html', context)
@@ -0,0 +1,63 @@
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django_redis import get_redis_connection
+
+from DailyFresh.apps.goods import detail
+from DailyFresh.apps.goods.models import GoodsSKU
+from DailyFresh.apps.goods.reviews import REVIEW_PAGE_KEY
+from DailyFresh.apps.goods.views import DetailView
+
+
+class Command(BaseCommand):
+    """
+    商品详情页压测,对比缓存未命中(与原来每次查询数据库相同)和命中时每个请求的SQL条数及耗时
+    python manage.py bench_detail_view --skus 20 --requests 50
+    """
+    help = '商品详情页每个请求的SQL条数和耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skus', type=int, default=20, help='参与压测的商品数')
+        parser.add_argument('--requests', type=int, default=20, help='每个商品的请求数')
+
+    def handle(self, *args, **options):
+        sku_ids = list(GoodsSKU.objects.order_by('id').values_list('id', flat=True)[:options['skus']])
+        if not sku_ids:
+            self.stderr.write('没有商品数据')
+            return
+
+        conn = get_redis_connection('default')
+        view = DetailView.as_view()
+        factory = RequestFactory()
+
+        def request(sku_id):
+            req = factory.get('/goods/%d' % sku_id)
+            req.user = AnonymousUser()
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.time()
+                view(req, sku_id=str(sku_id))
+                elapsed = time.time() - start
+            return len(ctx.captured_queries), elapsed
+
+        self.stdout.write('%-8s %10s %12s %12s' % ('cache', 'requests', 'queries/req', 'avg(ms)'))
+        # 缓存未命中: 每次请求前删除详情页和评论的缓存
+        results = []
+        for sku_id in sku_ids:
+            for _ in range(options['requests']):
+                conn.delete(detail.DETAIL_KEY % sku_id, REVIEW_PAGE_KEY % sku_id)
+                results.append(request(sku_id))
+        self.report('miss', results)
+
+        # 缓存命中
+        results = [request(sku_id) for sku_id in sku_ids for _ in range(options['requests'])]
+        self.report('hit', results)
+
+    def report(self, name, results):
+        queries = sum(q for q, _ in results)
+        elapsed = sum(t for _, t in results)
+        self.stdout.write('%-8s %10d %12.2f %12.2f' % (
+            name, len(results), queries / len(results), elapsed * 1000 / len(results)))
@@ -0,0 +1,126 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django_redis import get_redis_connection
+
+from DailyFresh.apps.goods import inventory, sales
+from DailyFresh.apps.goods.models import GoodsType, Goods, GoodsSKU
+from DailyFresh.apps.order.commit import OrderCommitError, commit_order
+from DailyFresh.apps.order.models import OrderInfo
+from DailyFresh.apps.order.strategies import STRATEGIES, get_strategy
+from DailyFresh.apps.user.models import User, Address
+
+
+class Command(BaseCommand):
+    """
+    下单并发压测: N个买家同时抢购同一个商品,对比各库存控制策略的
+    下单吞吐量(orders/sec)、失败率和p99延迟
+    python manage.py bench_order_commit --buyers 100 --stock 50
+    """
+    help = '对比各库存控制策略在热点商品上的下单性能'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=50, help='并发买家数')
+        parser.add_argument('--orders', type=int, default=1, help='每个买家的下单次数')
+        parser.add_argument('--count', type=int, default=1, help='每个订单购买的商品数量')
+        parser.add_argument('--stock', type=int, default=1000, help='商品初始库存')
+        parser.add_argument('--strategies', default=','.join(STRATEGIES), help='参与对比的策略,逗号分隔')
+
+    def handle(self, *args, **options):
+        sku = self.get_hot_sku()
+        buyers = self.get_buyers(options['buyers'])
+
+        self.stdout.write('%-12s %8s %8s %10s %10s %10s' % ('strategy', 'orders', 'aborts', 'abort%', 'orders/s', 'p99(ms)'))
+        for name in options['strategies'].split(','):
+            self.reset(sku, options['stock'])
+            result = self.run(name, sku, buyers, options['orders'], options['count'])
+            total = result['orders'] + result['aborts']
+            self.stdout.write('%-12s %8d %8d %9.1f%% %10.1f %10.1f' % (
+                name,
+                result['orders'],
+                result['aborts'],
+                100.0 * result['aborts'] / total if total else 0,
+                result['orders'] / result['elapsed'] if result['elapsed'] else 0,
+                result['p99'] * 1000,
+            ))
+            for error, times in sorted(result['errors'].items()):
+                self.stdout.write('    %s x %d' % (error, times))
+        self.reset(sku, options['stock'])
+
+    def get_hot_sku(self):
+        """获取压测使用的热点商品"""
+        category, _ = GoodsType.objects.get_or_create(name='压测', defaults={'logo': 'bench', 'image': 'type/bench.jpg'})
+        goods, _ = Goods.objects.get_or_create(name='压测商品', defaults={'detail': ''})
+        sku, _ = GoodsSKU.objects.get_or_create(
+            name='压测商品',
+            category=category,
+            goods=goods,
+            defaults={'desc': '压测商品', 'price': 1, 'unite': '个', 'image': 'goods/bench.jpg'},
+        )
+        return sku
+
+    def get_buyers(self, num):
+        """获取压测使用的买家及其收货地址"""
+        buyers = []
+        for i in range(num):
+            user, _ = User.objects.get_or_create(username='bench_buyer_%d' % i)
+            addr, _ = Address.objects.get_or_create(
+                user=user,
+                defaults={'receiver': user.username, 'addr': '压测地址', 'phone_num': '13800000000'},
+            )
+            buyers.append((user, addr))
+        return buyers
+
+    def reset(self, sku, stock):
+        """删除压测订单,恢复商品库存"""
+        OrderInfo.objects.filter(user__username__startswith='bench_buyer_').delete()
+        GoodsSKU.objects.filter(id=sku.id).update(stock=stock, sales=0)
+        conn = get_redis_connection('default')
+        conn.delete(inventory.STOCK_KEY % sku.id)
+        conn.hdel(sales.SALES_DELTA_KEY, sku.id)
+
+    def run(self, name, sku, buyers, orders, count):
+        latencies = []
+        errors = {}
+        lock = threading.Lock()
+        barrier = threading.Barrier(len(buyers))
+
+        def buy(user, addr):
+            strategy = get_strategy(name)
+            barrier.wait()
+            try:
+                for i in range(orders):
+                    start = time.time()
+                    try:
+                        commit_order(user, addr, '1', {sku.id: count}, strategy)
+                        error = None
+                    except OrderCommitError as e:
+                        error = e.error_msg
+                    except Exception as e:
+                        error = e.__class__.__name__
+                    with lock:
+                        latencies.append(time.time() - start)
+                        if error is not None:
+                            errors[error] = errors.get(error, 0) + 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=buyer) for buyer in buyers]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        aborts = sum(errors.values())
+        latencies.sort()
+        return {
+            'orders': len(latencies) - aborts,
+            'aborts': aborts,
+            'errors': errors,
+            'elapsed': elapsed,
+            'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0,
+        }
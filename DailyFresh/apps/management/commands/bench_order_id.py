@@ -0,0 +1,40 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from DailyFresh.utils.id_generator import IdGenerator
+
+
+class Command(BaseCommand):
+    """
+    订单id生成器压测,输出每秒生成的id数,并校验id唯一且按生成顺序递增
+    python manage.py bench_order_id --count 1000000 --threads 4
+    """
+    help = '订单id生成器吞吐量压测'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000000, help='每个线程生成的id数')
+        parser.add_argument('--threads', type=int, default=1, help='并发线程数')
+
+    def handle(self, *args, **options):
+        generator = IdGenerator(0)
+        results = []
+
+        def run():
+            ids = [generator.next_id() for _ in range(options['count'])]
+            results.append(ids)
+
+        threads = [threading.Thread(target=run) for _ in range(options['threads'])]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        total = sum(len(ids) for ids in results)
+        unique = len(set(i for ids in results for i in ids))
+        ordered = all(ids == sorted(ids) for ids in results)
+        self.stdout.write('生成 %d 个id, 耗时 %.3fs, %.0f ids/s' % (total, elapsed, total / elapsed))
+        self.stdout.write('唯一: %s  有序: %s' % (unique == total, ordered))
@@ -0,0 +1,106 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from haystack import connections
+from whoosh.filedb.filestore import RamStorage
+from whoosh.qparser import QueryParser
+
+from DailyFresh.apps.goods import ngram_search
+
+ORIGINS = ['山东', '新疆', '云南', '海南', '东北', '福建', '进口', '智利', '泰国', '内蒙古']
+ADJECTIVES = ['新鲜', '有机', '精品', '冷冻', '特级', '野生', '散养', '当季', '现摘', '礼盒装']
+PRODUCTS = ['草莓', '苹果', '香蕉', '葡萄', '柠檬', '芒果', '猕猴桃', '车厘子', '大虾', '扇贝', '带鱼', '三文鱼',
+            '牛排', '羊肉卷', '鸡胸肉', '猪五花', '鸡蛋', '鸭蛋', '白菜', '土豆', '西红柿', '黄瓜', '香菇', '金针菇',
+            '速冻水饺', '汤圆', '馄饨', '牛奶', '酸奶', '奶酪']
+SPECS = ['500g', '1kg', '2.5kg', '5斤装', '10枚', '30枚', '一箱', '整只', '6盒', '家庭装']
+WORDS = ['产地直发', '顺丰冷链', '坏果包赔', '口感细腻', '肉质鲜嫩', '营养丰富', '当日采摘', '无添加',
+         '全程冷链', '现货速发', '企业采购', '节日送礼']
+
+
+class Command(BaseCommand):
+    """
+    商品搜索压测,在内存中生成模拟商品数据,分别写入进程内bigram索引和whoosh索引(与搜索后端相同的schema),
+    对比索引耗时、索引大小、搜索和前缀补全的平均及p99延迟
+    python manage.py bench_search --count 1000000 --queries 2000
+    """
+    help = '进程内bigram索引与whoosh的搜索性能对比'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100000, help='模拟的商品数')
+        parser.add_argument('--queries', type=int, default=1000, help='查询次数')
+        parser.add_argument('--seed', type=int, default=1, help='随机数种子')
+        parser.add_argument('--skip-whoosh', action='store_true', help='只测试进程内索引')
+
+    def handle(self, *args, **options):
+        rand = random.Random(options['seed'])
+        rows = [self.make_sku(rand, sku_id) for sku_id in range(1, options['count'] + 1)]
+        queries = [self.make_query(rand) for _ in range(options['queries'])]
+        prefixes = [rand.choice(rows)[1][:rand.randint(1, 4)] for _ in range(options['queries'])]
+
+        self.stdout.write('%-10s %12s %10s %14s %14s %14s' % (
+            'engine', 'index(s)', 'size(MB)', 'search(ms)', 'p99(ms)', 'suggest(ms)'))
+
+        start = time.time()
+        index = ngram_search.build_index(rows)
+        index_elapsed = time.time() - start
+        size = len(index.dumps())
+        search_times = self.measure(queries, lambda q: index.search(q))
+        suggest_times = self.measure(prefixes, lambda p: index.suggest(p))
+        self.report('ngram', index_elapsed, size, search_times, suggest_times)
+
+        if not options['skip_whoosh']:
+            self.bench_whoosh(rows, queries)
+
+    def make_sku(self, rand, sku_id):
+        name = '%s%s%s %s' % (rand.choice(ORIGINS), rand.choice(ADJECTIVES), rand.choice(PRODUCTS), rand.choice(SPECS))
+        desc = ' '.join(rand.sample(WORDS, 3))
+        return sku_id, name, desc
+
+    def make_query(self, rand):
+        kind = rand.random()
+        if kind < 0.5:
+            return rand.choice(PRODUCTS)
+        if kind < 0.8:
+            return rand.choice(ADJECTIVES) + rand.choice(PRODUCTS)
+        return rand.choice(ORIGINS) + rand.choice(PRODUCTS)
+
+    def bench_whoosh(self, rows, queries):
+        backend = connections['default'].get_backend()
+        _, schema = backend.build_schema(connections['default'].get_unified_index().all_searchfields())
+        storage = RamStorage()
+        whoosh_index = storage.create_index(schema)
+
+        start = time.time()
+        writer = whoosh_index.writer(limitmb=256)
+        for sku_id, name, desc in rows:
+            writer.add_document(**{
+                'id': 'goods.goodssku.%d' % sku_id,
+                'django_ct': 'goods.goodssku',
+                'django_id': str(sku_id),
+                'text': '%s\n%s' % (name, desc),
+            })
+        writer.commit()
+        index_elapsed = time.time() - start
+        size = sum(storage.file_length(name) for name in storage.list())
+
+        parser = QueryParser('text', schema=schema)
+        with whoosh_index.searcher() as searcher:
+            search_times = self.measure(queries, lambda q: searcher.search_page(parser.parse(q), 1, pagelen=20))
+        self.report('whoosh', index_elapsed, size, search_times, [])
+
+    def measure(self, inputs, func):
+        times = []
+        for value in inputs:
+            start = time.perf_counter()
+            func(value)
+            times.append(time.perf_counter() - start)
+        return times
+
+    def report(self, name, index_elapsed, size, search_times, suggest_times):
+        search_times = sorted(search_times)
+        avg = sum(search_times) / len(search_times) * 1000 if search_times else 0
+        p99 = search_times[min(int(len(search_times) * 0.99), len(search_times) - 1)] * 1000 if search_times else 0
+        suggest = sum(suggest_times) / len(suggest_times) * 1000 if suggest_times else 0
+        self.stdout.write('%-10s %12.2f %10.1f %14.3f %14.3f %14s' % (
+            name, index_elapsed, size / 1024 / 1024, avg, p99, '%.3f' % suggest if suggest_times else '-'))
@@ -0,0 +1,25 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods import ngram_search
+
+
+class Command(BaseCommand):
+    """
+    从数据库重新生成进程内商品搜索索引的快照,工作进程启动时加载快照后只需应用之后的修改记录
+    python manage.py build_ngram_snapshot --chunk-size 2000
+    """
+    help = '生成进程内商品搜索索引的快照'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000, help='每批读取的商品数')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        index = ngram_search.rebuild_snapshot(chunk_size=options['chunk_size'])
+        self.stdout.write('索引 %d 个商品, %d 个词, 快照 %s (%.1fMB), 耗时 %.3fs' % (
+            len(index), len(index.postings), settings.NGRAM_SNAPSHOT_PATH,
+            os.path.getsize(settings.NGRAM_SNAPSHOT_PATH) / 1024 / 1024, time.time() - start))
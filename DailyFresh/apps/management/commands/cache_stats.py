@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from DailyFresh.utils.cache import get_cache_stats
+
+
+class Command(BaseCommand):
+    """
+    查看各缓存的命中、返回旧数据及重新生成的次数
+    python manage.py cache_stats
+    """
+    help = '缓存统计信息'
+
+    def handle(self, *args, **options):
+        self.stdout.write('%-12s %10s %10s %10s %10s %10s %10s' % (
+            'cache', 'hit', 'stale', 'miss', 'wait', 'rebuild', 'hit%'))
+        for name, stats in sorted(get_cache_stats().items()):
+            total = stats['hit'] + stats['stale'] + stats['miss']
+            self.stdout.write('%-12s %10d %10d %10d %10d %10d %9.1f%%' % (
+                name, stats['hit'], stats['stale'], stats['miss'], stats['wait'], stats['rebuild'],
+                100.0 * (stats['hit'] + stats['stale']) / total if total else 0,
+            ))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from DailyFresh.apps.goods import list_index
+from DailyFresh.apps.goods.models import GoodsType
+
+
+class Command(BaseCommand):
+    """
+    对比列表页的redis排序索引与数据库,输出缺少、多余和分值不一致的商品
+    python manage.py check_list_index [--fix]
+    """
+    help = '校验商品列表排序索引'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='存在不一致时重建索引')
+
+    def handle(self, *args, **options):
+        inconsistent = False
+        for category_id in GoodsType.objects.values_list('id', flat=True):
+            result = list_index.check(category_id)
+            if not (result['missing'] or result['extra'] or result['mismatched']):
+                continue
+            inconsistent = True
+            self.stdout.write('种类 %d: 缺少 %d, 多余 %d, 分值不一致 %d' % (
+                category_id, len(result['missing']), len(result['extra']), len(result['mismatched'])))
+            for sku_id, sort, indexed, expected in result['mismatched'][:10]:
+                self.stdout.write('    商品 %d %s: 索引 %s, 数据库 %s' % (sku_id, sort, indexed, expected))
+
+        if not inconsistent:
+            self.stdout.write('索引与数据库一致')
+        elif options['fix']:
+            list_index.rebuild()
+            self.stdout.write('已重建索引')
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+
+from DailyFresh.apps.goods import inventory
+
+"""
+秒杀商品管理
+python manage.py flash_sale add 1 2     将商品1,2标记为秒杀商品,库存同步到redis
+python manage.py flash_sale remove 1    取消秒杀,未写入的数量先写入数据库
+python manage.py flash_sale list        查看秒杀商品及其可售库存
+python manage.py flash_sale reconcile   立即校对可售库存
+"""
+
+
+class Command(BaseCommand):
+    help = '管理秒杀商品的redis库存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['add', 'remove', 'list', 'reconcile'])
+        parser.add_argument('sku_ids', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        action = options['action']
+        sku_ids = options['sku_ids']
+        if action in ('add', 'remove') and not sku_ids:
+            raise CommandError('请指定商品id')
+
+        if action == 'add':
+            inventory.add_flash_sale(sku_ids)
+        elif action == 'remove':
+            inventory.remove_flash_sale(sku_ids)
+        elif action == 'reconcile':
+            self.stdout.write('修复的商品: %s' % inventory.reconcile_flash_stock())
+
+        conn = get_redis_connection('default')
+        for sku_id in sorted(inventory.get_flash_sale_skus(conn)):
+            stock = conn.get(inventory.FLASH_STOCK_KEY % sku_id)
+            pending = inventory.get_pending(conn, sku_id)
+            self.stdout.write('sku %d  可售库存 %s  待写入 %s' % (sku_id, stock and int(stock), pending))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from DailyFresh.utils.idempotency import get_idempotency_stats
+
+
+class Command(BaseCommand):
+    """
+    查看各接口被幂等处理拦截的重复请求数
+    python manage.py idempotency_stats
+    """
+    help = '幂等统计信息'
+
+    def handle(self, *args, **options):
+        self.stdout.write('%-20s %10s %10s %10s %10s' % ('path', 'first', 'replayed', 'in_flight', 'absorbed%'))
+        for path, stats in sorted(get_idempotency_stats().items()):
+            duplicates = stats['replayed'] + stats['in_flight']
+            total = stats['first'] + duplicates
+            self.stdout.write('%-20s %10d %10d %10d %9.1f%%' % (
+                path, stats['first'], stats['replayed'], stats['in_flight'],
+                100.0 * duplicates / total if total else 0,
+            ))
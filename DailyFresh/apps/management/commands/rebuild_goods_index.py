@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import shutil
+import time
+from collections import deque
+
+from django import db
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from haystack import connections
+from whoosh.filedb.filestore import FileStorage
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods import search_queue, search_results
+from DailyFresh.apps.goods.models import GoodsSKU
+
+
+def render_chunk(skus):
+    """在子进程中生成一批商品的索引文档"""
+    backend = connections['default'].get_backend()
+    index = connections['default'].get_unified_index().get_index(GoodsSKU)
+    docs = []
+    for sku in skus:
+        doc = index.full_prepare(sku)
+        # 与WhooshSearchBackend.update相同的转换
+        for key in doc:
+            doc[key] = backend._from_python(doc[key])
+        doc.pop('boost', None)
+        docs.append(doc)
+    return docs
+
+
+def iter_chunks(chunk_size):
+    """按主键分批读取商品,每批一条LIMIT查询,不依赖数据库驱动的流式游标"""
+    last_id = 0
+    while True:
+        skus = list(GoodsSKU.objects.select_related('goods').filter(id__gt=last_id).order_by('id')[:chunk_size])
+        if not skus:
+            return
+        last_id = skus[-1].id
+        yield skus
+
+
+class Command(BaseCommand):
+    """
+    并行重建商品搜索索引
+    主进程分批读取商品,子进程生成索引文档,主进程写入新的索引目录,
+    完成后将索引路径(符号链接)原子地切换到新目录,重建期间搜索继续使用旧索引
+    第一次运行时索引路径还是普通目录,无法原子地替换为符号链接,改名和创建链接之间的极短时间内搜索会失败,
+    需要在维护时间内加--allow-downtime参数运行一次,之后的重建不影响搜索
+    python manage.py rebuild_goods_index --chunk-size 2000 --workers 8
+    """
+    help = '并行重建商品搜索索引'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000, help='每批读取的商品数')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='生成索引文档的进程数')
+        parser.add_argument('--keep', type=int, default=1, help='保留的旧索引目录数,用于回滚')
+        parser.add_argument('--allow-downtime', action='store_true',
+                            help='索引路径为普通目录时允许改为符号链接,切换期间搜索会短暂失败')
+
+    def handle(self, *args, **options):
+        path = os.path.abspath(settings.HAYSTACK_CONNECTIONS['default']['PATH'])
+        if os.path.isdir(path) and not os.path.islink(path) and not options['allow_downtime']:
+            raise CommandError('%s 为普通目录,第一次重建需要在维护时间内使用--allow-downtime参数运行' % path)
+        new_dir = '%s.%s' % (path, time.strftime('%Y%m%d%H%M%S'))
+        started_at = timezone.now()
+        start = time.time()
+
+        backend = connections['default'].get_backend()
+        _, schema = backend.build_schema(connections['default'].get_unified_index().all_searchfields())
+        os.makedirs(new_dir)
+        writer = FileStorage(new_dir).create_index(schema).writer(limitmb=256)
+
+        indexed = set()
+
+        def collect(docs):
+            for doc in docs:
+                writer.add_document(**doc)
+                indexed.add(int(doc['django_id']))
+            return len(docs)
+
+        # 创建进程池之前关闭数据库连接,multiprocessing.Pool在创建时fork出全部子进程,子进程不会继承父进程的连接
+        db.connections.close_all()
+        total = 0
+        with multiprocessing.Pool(options['workers']) as pool:
+            pending = deque()
+            for skus in iter_chunks(options['chunk_size']):
+                pending.append(pool.apply_async(render_chunk, (skus,)))
+                # 限制同时在途的批次,不把整张表读进内存
+                if len(pending) >= options['workers'] * 2:
+                    total += collect(pending.popleft().get())
+            while pending:
+                total += collect(pending.popleft().get())
+
+        writer.commit()
+        render_elapsed = time.time() - start
+        self.swap(path, new_dir, options['keep'])
+        search_results.bump_version()
+
+        # 重建期间修改的商品可能写入了旧索引,重新放入更新队列
+        changed = list(GoodsSKU.objects.filter(update_time__gte=started_at).values_list('id', flat=True))
+        # 重建期间删除的商品已经读入了新索引,删除只作用在旧索引上,需要从新索引中再删除一次
+        deleted = list(indexed - set(GoodsSKU.objects.values_list('id', flat=True)))
+        search_queue.enqueue(update_ids=changed, delete_ids=deleted)
+
+        elapsed = time.time() - start
+        self.stdout.write('索引 %d 个商品, 进程数 %d, 耗时 %.3fs, %.0f docs/s' % (
+            total, options['workers'], elapsed, total / render_elapsed if render_elapsed else 0))
+        self.stdout.write('索引目录: %s, 重新放入更新队列 %d 个商品, 删除 %d 个商品' % (
+            new_dir, len(changed), len(deleted)))
+
+    def swap(self, path, new_dir, keep):
+        """将索引路径原子地切换到新目录,删除多余的旧目录"""
+        link = '%s.link' % path
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(new_dir), link)
+        if os.path.isdir(path) and not os.path.islink(path):
+            # 第一次切换,原来的索引路径为普通目录,改名后立即放入符号链接,两次调用之间搜索会失败
+            os.rename(path, '%s.initial' % path)
+        os.replace(link, path)
+
+        parent = os.path.dirname(path)
+        prefix = os.path.basename(path) + '.'
+        old_dirs = [os.path.join(parent, name) for name in os.listdir(parent) if name.startswith(prefix)]
+        old_dirs = sorted((d for d in old_dirs if d != new_dir and os.path.isdir(d) and not os.path.islink(d)),
+                          key=os.path.getmtime)
+        for old_dir in old_dirs[:max(0, len(old_dirs) - keep)]:
+            shutil.rmtree(old_dir)
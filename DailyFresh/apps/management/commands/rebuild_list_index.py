@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from DailyFresh.apps.goods import list_index
+
+
+class Command(BaseCommand):
+    """
+    分批读取全部商品,重建列表页的redis排序索引
+    python manage.py rebuild_list_index --chunk-size 1000
+    """
+    help = '重建商品列表排序索引'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每批读取的商品数')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        totals = list_index.rebuild(options['chunk_size'])
+        elapsed = time.time() - start
+        for category_id, total in sorted(totals.items()):
+            self.stdout.write('种类 %d: %d 个商品' % (category_id, total))
+        self.stdout.write('共 %d 个商品, 耗时 %.3fs' % (sum(totals.values()), elapsed))
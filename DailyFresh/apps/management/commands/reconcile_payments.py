@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.order import payment, reconcile
+from DailyFresh.apps.order.models import OrderInfo
+from DailyFresh.apps.user.models import User, Address
+from DailyFresh.utils.id_generator import next_id
+
+
+class Command(BaseCommand):
+    """
+    立即执行一次支付对账并输出吞吐量
+    在本地模拟网关上压测(settings.ALIPAY_FAKE_GATEWAY = True):
+    python manage.py reconcile_payments --seed 20000 --latency 0.05 --workers 32
+    """
+    help = '支付对账'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None, help='每批查询的订单数')
+        parser.add_argument('--workers', type=int, default=None, help='并发查询的线程数')
+        parser.add_argument('--seed', type=int, default=0, help='对账前生成的待支付订单数,其中一半在模拟网关中已支付')
+        parser.add_argument('--latency', type=float, default=None, help='模拟网关交易查询接口的延迟(秒)')
+
+    def handle(self, *args, **options):
+        if options['seed'] or options['latency'] is not None:
+            if not settings.ALIPAY_FAKE_GATEWAY:
+                raise CommandError('--seed和--latency只能在ALIPAY_FAKE_GATEWAY = True时使用')
+            if options['latency'] is not None:
+                payment.get_alipay().latency = options['latency']
+            if options['seed']:
+                self.seed(options['seed'])
+
+        stats = reconcile.reconcile_payments(options['chunk_size'], options['workers'])
+        self.stdout.write('查询 %(checked)d 个订单, 修复 %(paid)d 个, 失败 %(errors)d 个, '
+                          '耗时 %(elapsed).2fs, %(rate).1f orders/s' % stats)
+
+    def seed(self, num):
+        """生成待支付的支付宝订单,一半在模拟网关中完成支付"""
+        user, _ = User.objects.get_or_create(username='bench_reconcile')
+        addr, _ = Address.objects.get_or_create(
+            user=user,
+            defaults={'receiver': user.username, 'addr': '压测地址', 'phone_num': '13800000000'},
+        )
+        OrderInfo.objects.filter(user=user).delete()
+
+        orders = [OrderInfo(order_id=next_id(), user=user, addr=addr, pay_method=payment.PAY_METHOD_ALIPAY,
+                            total_count=1, total_price=1, transport_price=10) for _ in range(num)]
+        OrderInfo.objects.bulk_create(orders, batch_size=1000)
+
+        ali_pay = payment.get_alipay()
+        for order in orders[::2]:
+            ali_pay.pay(order.order_id, '11.00')
@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from functools import reduce
+from operator import or_
+
+from django.db import transaction, IntegrityError
+from django.db.models import Case, When, F, Q, IntegerField
+
+from DailyFresh.apps.goods import facets, inventory, sales
+from DailyFresh.apps.goods.models import GoodsSKU
+from DailyFresh.apps.order.models import OrderInfo, OrderGoods
+from DailyFresh.utils.id_generator import next_id
+
+"""
+批量下单流程:
+1.一次IN查询获取订单中的全部商品
+2.一次HMGET获取购物车中全部商品的数量
+3.向df_order_info中添加一条记录
+4.bulk_create一次性向df_order_goods中添加全部记录
+5.一条带条件的UPDATE语句减少全部商品的库存
+6.事务提交后在redis中累加商品销量
+行锁从第5步开始持有,到事务提交为止,与订单中商品的数量无关
+秒杀商品在事务开始前已经在redis中预扣库存并记入journal,事务中不再修改df_goods_sku,
+由celery任务异步写入数据库,见apps/goods/inventory.py
+"""
+
+# 运费
+TRANSPORT_PRICE = 10
+# 货到付款
+PAY_METHOD_CASH = 1
+
+
+class OrderCommitError(Exception):
+    """下单失败,res和error_msg与接口返回的json保持一致"""
+
+    def __init__(self, res, error_msg):
+        super(OrderCommitError, self).__init__(error_msg)
+        self.res = res
+        self.error_msg = error_msg
+
+
+def parse_sku_ids(sku_ids):
+    """将前端传递的'1,2,3'解析为去重后的商品id列表"""
+    result = []
+    for sku_id in sku_ids.split(','):
+        sku_id = sku_id.strip()
+        if not sku_id.isdigit():
+            raise OrderCommitError(4, '商品信息错误')
+        if sku_id not in result:
+            result.append(sku_id)
+    return result
+
+
+def get_cart_counts(conn, cart_key, sku_ids):
+    """一次HMGET获取用户要购买的商品的数量,返回{sku_id: count}"""
+    counts = OrderedDict()
+    for sku_id, count in zip(sku_ids, conn.hmget(cart_key, sku_ids)):
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            raise OrderCommitError(4, '商品信息错误')
+        if count <= 0:
+            raise OrderCommitError(4, '商品信息错误')
+        counts[int(sku_id)] = count
+    return counts
+
+
+def decrement_stock(counts, expected=None, check=True):
+    """
+    一条语句减少库存:
+    update df_goods_sku set stock=case id when 1 then stock-2 ... end
+    where (id=1 and stock>=2) or (id=2 and stock>=3) ...
+    expected为{sku_id: 读取到的库存}时,条件改为库存等于读取到的值(乐观锁)
+    check为False时不加库存条件,用于库存已经在redis中校验过的秒杀商品
+    销量累加在redis中,由定时任务写入数据库,见apps/goods/sales.py
+    返回更新的行数,小于商品种数说明有商品库存不足或已被修改
+    """
+    if not check:
+        condition = Q(id__in=list(counts.keys()))
+    elif expected is None:
+        condition = reduce(or_, [Q(id=sku_id, stock__gte=count) for sku_id, count in counts.items()])
+    else:
+        condition = reduce(or_, [Q(id=sku_id, stock=expected[sku_id]) for sku_id in counts])
+    stock = Case(*[When(id=sku_id, then=F('stock') - count) for sku_id, count in counts.items()],
+                 output_field=IntegerField())
+    updated = GoodsSKU.objects.filter(condition).update(stock=stock)
+    # 批量更新不会发出post_save,需要单独登记搜索筛选中有货状态可能变化的商品
+    facets.record_changes_on_commit(counts.keys())
+    return updated
+
+
+def make_order_id(user):
+    """订单id:按时间有序、进程内唯一的30位数字,见utils/id_generator.py"""
+    return next_id()
+
+
+def commit_order(user, addr, pay_method, counts, strategy=None, prices=None, ticket=None):
+    """
+    创建订单,counts为{sku_id: count}
+    strategy为库存控制策略,默认使用settings.ORDER_COMMIT_STRATEGY
+    prices为价格快照中的{sku_id: price},提供时使用快照中的价格,策略不需要读取商品行时不再查询商品
+    ticket为异步下单的排队号,保存在订单中
+    成功返回OrderInfo对象,失败抛出OrderCommitError,事务整体回滚
+    """
+    from DailyFresh.apps.order.strategies import get_strategy
+    strategy = strategy or get_strategy()
+
+    # 将订单中的商品分为秒杀商品和普通商品
+    flash_sale_skus = inventory.get_flash_sale_skus() if counts else set()
+    flash_counts = OrderedDict((k, v) for k, v in counts.items() if k in flash_sale_skus)
+    db_counts = OrderedDict((k, v) for k, v in counts.items() if k not in flash_sale_skus)
+
+    # 需要查询的商品: 没有价格快照时查询全部商品,有快照时只查询策略需要读取的普通商品
+    if prices is None:
+        load_ids = set(counts.keys())
+    elif strategy.needs_rows:
+        load_ids = set(db_counts.keys())
+    else:
+        load_ids = set()
+    db_ids = [k for k in db_counts if k in load_ids]
+    flash_ids = [k for k in flash_counts if k in load_ids]
+
+    def attempt():
+        with transaction.atomic():
+            # 一次IN查询获取商品,秒杀商品不加锁
+            skus = {}
+            if db_ids:
+                skus.update(strategy.load_skus(db_ids))
+            if flash_ids:
+                skus.update(GoodsSKU.objects.in_bulk(flash_ids))
+            if len(skus) != len(load_ids):
+                raise OrderCommitError(4, '商品信息错误')
+
+            total_count = 0
+            total_price = 0
+            line_prices = {}
+            for sku_id, count in counts.items():
+                # 秒杀商品的数据库库存是滞后的,已经在redis中校验过
+                if sku_id in db_counts and sku_id in skus and count > skus[sku_id].stock:
+                    raise OrderCommitError(6, '商品库存不足')
+                line_prices[sku_id] = prices[sku_id] if prices is not None else skus[sku_id].price
+                total_count += count
+                total_price += line_prices[sku_id] * count
+
+            # 先写订单记录,最后再执行减库存语句,缩短商品行锁的持有时间
+            order = OrderInfo.objects.create(
+                order_id=make_order_id(user),
+                user=user,
+                addr=addr,
+                pay_method=int(pay_method),
+                total_count=total_count,
+                total_price=total_price,
+                transport_price=TRANSPORT_PRICE,
+                intake_ticket=ticket,
+            )
+
+            try:
+                OrderGoods.objects.bulk_create([
+                    OrderGoods(order=order, sku_id=sku_id, count=count, price=line_prices[sku_id])
+                    for sku_id, count in counts.items()
+                ])
+            except IntegrityError:
+                # 价格快照中的商品已被删除
+                raise OrderCommitError(4, '商品信息错误')
+
+            if db_counts:
+                strategy.decrement(skus, db_counts)
+            if flash_counts:
+                # 预扣时已经记入journal
+                transaction.on_commit(inventory.schedule_flash_persist)
+            transaction.on_commit(lambda: sales.incr_sales(counts))
+            # 在线支付的订单登记支付超时时间,超时未支付自动关闭并归还库存
+            if order.pay_method != PAY_METHOD_CASH:
+                from DailyFresh.apps.order.expiry import schedule_expiry
+                transaction.on_commit(lambda: schedule_expiry(order.order_id))
+        return order
+
+    if not flash_counts:
+        return strategy.run(attempt, db_counts)
+
+    if not inventory.reserve_flash_stock(flash_counts):
+        raise OrderCommitError(6, '商品库存不足')
+    try:
+        return strategy.run(attempt, db_counts)
+    except Exception:
+        inventory.release_flash_stock(flash_counts)
+        raise
@@ -0,0 +1,107 @@
+import time
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Sum
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods import inventory, sales
+from DailyFresh.apps.order.commit import decrement_stock
+from DailyFresh.apps.order.models import OrderInfo, OrderGoods
+
+"""
+超时未支付订单的关闭
+创建订单时将订单id放入redis有序集合order_expire_zset,分值为超时时间戳,
+由celery beat定时任务按超时时间批量取出,关闭仍为待支付的订单并归还库存
+支付宝订单关闭前先查询交易,已经付款但没有收到通知的订单改为已支付,查询失败的订单稍后重试
+"""
+
+ORDER_EXPIRE_KEY = 'order_expire_zset'
+# 待支付
+ORDER_STATUS_UNPAID = 1
+# 已取消
+ORDER_STATUS_CANCELED = 6
+# 交易查询失败时,推迟关闭的秒数
+EXPIRE_RETRY_DELAY = 60
+
+
+def schedule_expiry(order_id, conn=None):
+    """登记订单的支付超时时间"""
+    conn = conn or get_redis_connection('default')
+    conn.zadd(ORDER_EXPIRE_KEY, {order_id: time.time() + settings.ORDER_PAY_TIMEOUT})
+
+
+def cancel_expiry(*order_ids, conn=None):
+    """订单已支付,取消超时关闭"""
+    if not order_ids:
+        return
+    conn = conn or get_redis_connection('default')
+    conn.zrem(ORDER_EXPIRE_KEY, *order_ids)
+
+
+def release_order_stock(order_ids):
+    """
+    归还订单中商品的库存,一条语句更新全部普通商品
+    秒杀商品归还到redis的可售库存中,并记录负数的journal由异步任务写回数据库
+    需要在事务中调用
+    """
+    counts = defaultdict(int)
+    for sku_id, total in OrderGoods.objects.filter(order_id__in=order_ids) \
+            .values('sku_id').annotate(total=Sum('count')).values_list('sku_id', 'total'):
+        counts[sku_id] += total
+    if not counts:
+        return counts
+
+    flash_sale_skus = inventory.get_flash_sale_skus()
+    flash_counts = dict((k, v) for k, v in counts.items() if k in flash_sale_skus)
+    db_counts = dict((k, -v) for k, v in counts.items() if k not in flash_sale_skus)
+    if db_counts:
+        # 扣减负数即增加库存
+        decrement_stock(db_counts, check=False)
+
+    def after_commit():
+        if flash_counts:
+            inventory.release_flash_stock(flash_counts)
+            inventory.schedule_flash_persist()
+        sales.incr_sales(dict((k, -v) for k, v in counts.items()))
+
+    transaction.on_commit(after_commit)
+    return counts
+
+
+def close_expired_orders(batch_size=None, conn=None):
+    """关闭全部已超时的待支付订单,返回关闭的订单数"""
+    from DailyFresh.apps.order.reconcile import settle_expiring_orders
+
+    conn = conn or get_redis_connection('default')
+    batch_size = batch_size or settings.ORDER_EXPIRE_BATCH_SIZE
+    closed = 0
+    while True:
+        order_ids = [order_id.decode() for order_id in
+                     conn.zrangebyscore(ORDER_EXPIRE_KEY, '-inf', time.time(), start=0, num=batch_size)]
+        if not order_ids:
+            return closed
+
+        failed = settle_expiring_orders(order_ids)
+        if failed:
+            # 无法确认是否已经付款,推迟关闭
+            retry_at = time.time() + EXPIRE_RETRY_DELAY
+            conn.zadd(ORDER_EXPIRE_KEY, dict((order_id, retry_at) for order_id in failed))
+            failed = set(failed)
+            order_ids = [order_id for order_id in order_ids if order_id not in failed]
+            if not order_ids:
+                continue
+
+        with transaction.atomic():
+            # 锁定仍为待支付的订单,避免与支付结果的处理同时修改
+            unpaid = list(OrderInfo.objects.select_for_update()
+                          .filter(order_id__in=order_ids, order_status=ORDER_STATUS_UNPAID)
+                          .values_list('order_id', flat=True))
+            if unpaid:
+                OrderInfo.objects.filter(order_id__in=unpaid).update(order_status=ORDER_STATUS_CANCELED)
+                release_order_stock(unpaid)
+        closed += len(unpaid)
+
+        # 已支付或已关闭的订单一并移出集合
+        conn.zrem(ORDER_EXPIRE_KEY, *order_ids)
@@ -0,0 +1,71 @@
+import hashlib
+import hmac
+import time
+import uuid
+from urllib.parse import urlencode
+
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+
+"""
+本地模拟的支付宝网关,settings.ALIPAY_FAKE_GATEWAY为True时代替支付宝python SDK,
+不需要访问网络即可走通 下单->支付->异步通知->支付结果 的完整流程
+接口与python SDK中的AliPay保持一致,签名使用SECRET_KEY做HMAC-SHA256
+fake_alipay_trades: 已支付的交易 {订单id: 支付宝交易号}
+"""
+
+FAKE_TRADES_KEY = 'fake_alipay_trades'
+
+
+class FakeAliPay(object):
+    """模拟的支付宝客户端"""
+
+    def __init__(self, latency=None):
+        # 模拟交易查询接口的网络延迟(秒)
+        self.latency = settings.ALIPAY_FAKE_LATENCY if latency is None else latency
+
+    def sign(self, data):
+        """对参数签名,与SDK一致,按照参数名排序后拼接"""
+        message = '&'.join('%s=%s' % (k, data[k]) for k in sorted(data) if k not in ('sign', 'sign_type'))
+        return hmac.new(settings.SECRET_KEY.encode(), message.encode(), hashlib.sha256).hexdigest()
+
+    def verify(self, data, signature):
+        """校验签名"""
+        return hmac.compare_digest(self.sign(data), signature or '')
+
+    def api_alipay_trade_page_pay(self, out_trade_no, total_amount, subject, return_url=None, notify_url=None):
+        """生成电脑网站支付的参数,拼接在网关地址后面"""
+        data = {
+            'out_trade_no': out_trade_no,
+            'total_amount': total_amount,
+            'subject': subject,
+            'return_url': return_url or settings.ALIPAY_APP_RETURN_URL,
+            'notify_url': notify_url or settings.ALIPAY_APP_NOTIFY_URL or '',
+        }
+        data['sign'] = self.sign(data)
+        return urlencode(data)
+
+    def api_alipay_trade_query(self, out_trade_no):
+        """交易查询"""
+        if self.latency:
+            time.sleep(self.latency)
+        trade_no = get_redis_connection('default').hget(FAKE_TRADES_KEY, out_trade_no)
+        if trade_no is None:
+            return {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_NOT_EXIST',
+                    'out_trade_no': out_trade_no}
+        return {'code': '10000', 'msg': 'Success', 'trade_status': 'TRADE_SUCCESS',
+                'out_trade_no': out_trade_no, 'trade_no': trade_no.decode()}
+
+    def pay(self, out_trade_no, total_amount):
+        """模拟用户完成支付,返回签名后的异步通知参数"""
+        trade_no = uuid.uuid4().hex
+        get_redis_connection('default').hset(FAKE_TRADES_KEY, out_trade_no, trade_no)
+        data = {
+            'out_trade_no': out_trade_no,
+            'trade_no': trade_no,
+            'total_amount': total_amount,
+            'trade_status': 'TRADE_SUCCESS',
+        }
+        data['sign'] = self.sign(data)
+        return data
@@ -0,0 +1,184 @@
+import json
+import logging
+import uuid
+from decimal import Decimal
+
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.order.commit import OrderCommitError, commit_order
+from DailyFresh.apps.order.models import OrderInfo
+from DailyFresh.apps.user.models import User, Address
+
+"""
+异步下单
+settings.ORDER_COMMIT_ASYNC为True时,OrderCommitView只校验参数,将下单请求放入redis队列后立即返回排队号(ticket),
+由celery worker批量取出请求创建订单,前端通过/order/status/?ticket=排队号轮询下单结果
+order_intake_queue: 下单请求队列,LPUSH放入,RPOPLPUSH取出
+order_intake_processing: 已取出、尚未处理完成的下单请求,每个订单事务提交、写入下单结果后才从中删除,
+    worker中途退出时留在其中,下一次处理队列时放回队列重新处理,下单结果不是pending的请求直接删除,
+    排队号与订单在同一事务中写入df_order_info.intake_ticket,订单已经提交、来不及写入下单结果的请求直接返回已有的订单
+order_ticket_排队号: 下单结果 {status: pending/done/failed, user_id, order_id, error_msg}
+同一时间只有一个worker处理队列(order_intake_lock)
+"""
+
+logger = logging.getLogger(__name__)
+
+INTAKE_QUEUE_KEY = 'order_intake_queue'
+PROCESSING_KEY = 'order_intake_processing'
+DRAIN_LOCK_KEY = 'order_intake_lock'
+# 处理队列的锁的有效时间(秒),每处理一批延长一次
+DRAIN_LOCK_TIMEOUT = 300
+TICKET_KEY = 'order_ticket_%s'
+# 处理队列的任务已经发出的标记
+DRAIN_SCHEDULED_KEY = 'order_intake_scheduled'
+
+TICKET_PENDING = 'pending'
+TICKET_DONE = 'done'
+TICKET_FAILED = 'failed'
+
+
+def submit_order(user, addr, pay_method, counts, prices=None, conn=None):
+    """将下单请求放入队列,返回排队号,prices为价格快照中的{sku_id: price}"""
+    conn = conn or get_redis_connection('default')
+    ticket = uuid.uuid4().hex
+    payload = {
+        'ticket': ticket,
+        'user_id': user.id,
+        'addr_id': addr.id,
+        'pay_method': pay_method,
+        'counts': list(counts.items()),
+        'prices': [[sku_id, str(price)] for sku_id, price in prices.items()] if prices else None,
+    }
+    ticket_key = TICKET_KEY % ticket
+    pipe = conn.pipeline()
+    pipe.hmset(ticket_key, {'status': TICKET_PENDING, 'user_id': user.id})
+    pipe.expire(ticket_key, settings.ORDER_TICKET_EXPIRES)
+    pipe.lpush(INTAKE_QUEUE_KEY, json.dumps(payload))
+    pipe.set(DRAIN_SCHEDULED_KEY, 1, ex=60, nx=True)
+    if pipe.execute()[-1]:
+        from DailyFresh.celery_tasks.tasks import drain_order_intake
+        drain_order_intake.delay()
+    return ticket
+
+
+def get_ticket(ticket, conn=None):
+    """获取排队号对应的下单结果,不存在返回None"""
+    conn = conn or get_redis_connection('default')
+    result = conn.hgetall(TICKET_KEY % ticket)
+    if not result:
+        return None
+    return {k.decode(): v.decode() for k, v in result.items()}
+
+
+# 将处理中的请求放回队列的出队一端,优先重新处理
+# KEYS: 处理中列表, 队列
+REQUEUE_SCRIPT = """
+local count = 0
+while true do
+    local payload = redis.call('lpop', KEYS[1])
+    if not payload then
+        return count
+    end
+    redis.call('rpush', KEYS[2], payload)
+    count = count + 1
+end
+"""
+
+
+def requeue_processing(conn):
+    """将上一次处理中断时留下的请求放回队列,需要持有处理队列的锁"""
+    count = conn.eval(REQUEUE_SCRIPT, 2, PROCESSING_KEY, INTAKE_QUEUE_KEY)
+    if count:
+        logger.warning('放回队列的未完成下单请求: %d', count)
+    return count
+
+
+def pop_batch(conn, batch_size):
+    """一次往返从队列中取出最多batch_size个下单请求,同时放入处理中列表,返回[(原始数据, 请求)]"""
+    pipe = conn.pipeline()
+    for _ in range(batch_size):
+        pipe.rpoplpush(INTAKE_QUEUE_KEY, PROCESSING_KEY)
+    return [(raw, json.loads(raw)) for raw in pipe.execute() if raw is not None]
+
+
+def finish(conn, raw, ticket, result, cart=None):
+    """写入下单结果并从处理中列表删除请求,cart为(用户id, 商品id)时同时删除购物车中的记录"""
+    pipe = conn.pipeline()
+    pipe.hmset(TICKET_KEY % ticket, result)
+    if cart:
+        pipe.hdel('cart_%d' % cart[0], *cart[1])
+    pipe.lrem(PROCESSING_KEY, 1, raw)
+    pipe.execute()
+
+
+def process_batch(items, conn):
+    """批量创建订单,每个订单使用独立的事务,订单提交后立即写入结果并确认"""
+    payloads = [payload for _, payload in items]
+    # 重新处理的请求可能已经创建过订单
+    pipe = conn.pipeline()
+    for payload in payloads:
+        pipe.hget(TICKET_KEY % payload['ticket'], 'status')
+    statuses = pipe.execute()
+
+    # 订单已经提交但下单结果没有写入的请求
+    committed = dict(OrderInfo.objects.filter(intake_ticket__in=[p['ticket'] for p in payloads])
+                     .values_list('intake_ticket', 'order_id'))
+    users = User.objects.in_bulk({p['user_id'] for p in payloads})
+    addrs = Address.objects.in_bulk({p['addr_id'] for p in payloads})
+
+    for (raw, payload), status in zip(items, statuses):
+        ticket = payload['ticket']
+        if status is not None and status.decode() != TICKET_PENDING:
+            conn.lrem(PROCESSING_KEY, 1, raw)
+            continue
+        counts = dict((int(sku_id), int(count)) for sku_id, count in payload['counts'])
+        if ticket in committed:
+            finish(conn, raw, ticket, {'status': TICKET_DONE, 'order_id': committed[ticket]},
+                   (payload['user_id'], list(counts)))
+            continue
+        user = users.get(payload['user_id'])
+        addr = addrs.get(payload['addr_id'])
+        if user is None or addr is None:
+            finish(conn, raw, ticket, {'status': TICKET_FAILED, 'error_msg': '地址信息错误'})
+            continue
+        prices = None
+        if payload.get('prices'):
+            prices = dict((int(sku_id), Decimal(price)) for sku_id, price in payload['prices'])
+        try:
+            order = commit_order(user, addr, payload['pay_method'], counts, prices=prices, ticket=ticket)
+        except OrderCommitError as e:
+            finish(conn, raw, ticket, {'status': TICKET_FAILED, 'error_msg': e.error_msg})
+            continue
+        except Exception:
+            logger.exception('异步下单失败: %s', ticket)
+            finish(conn, raw, ticket, {'status': TICKET_FAILED, 'error_msg': '下单失败'})
+            continue
+        finish(conn, raw, ticket, {'status': TICKET_DONE, 'order_id': order.order_id}, (user.id, list(counts)))
+    return len(items)
+
+
+def drain(batch_size=None, conn=None):
+    """处理队列中全部的下单请求,返回处理的请求数"""
+    conn = conn or get_redis_connection('default')
+    batch_size = batch_size or settings.ORDER_INTAKE_BATCH_SIZE
+    lock = conn.lock(DRAIN_LOCK_KEY, timeout=DRAIN_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        # 其他worker正在处理
+        return 0
+    try:
+        # 持有锁时处理中列表里的请求都是之前中断留下的
+        requeue_processing(conn)
+        processed = 0
+        while True:
+            items = pop_batch(conn, batch_size)
+            if items:
+                processed += process_batch(items, conn)
+                lock.reacquire()
+                continue
+            # 队列为空,清除标记后再检查一次,避免清除标记前放入的请求无人处理
+            conn.delete(DRAIN_SCHEDULED_KEY)
+            if not conn.llen(INTAKE_QUEUE_KEY) or not conn.set(DRAIN_SCHEDULED_KEY, 1, ex=60, nx=True):
+                return processed
+    finally:
+        lock.release()
@@ -29,6 +29,7 @@ class OrderInfo(BaseModel):
         3: '待签收',
         4: '待评价',
         5: '已完成',
+        6: '已取消',
     }
 
     # 订单可选状态
@@ -38,6 +39,7 @@ class OrderInfo(BaseModel):
         (3, '待签收'),
         (4, '待评价'),
         (5, '已完成'),
+        (6, '已取消'),
     )
 
     order_id = models.CharField(max_length=128, primary_key=True, verbose_name='订单id')
@@ -49,6 +51,8 @@ class OrderInfo(BaseModel):
     transport_price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='订单运费')
     order_status = models.SmallIntegerField(choices=ORDER_STATUS_CHOICES, default=1, verbose_name='订单状态')
     trade_no = models.CharField(max_length=128, default='', verbose_name='支付编号')
+    # 异步下单的排队号,与订单在同一事务中写入,重新处理同一请求时不会重复下单
+    intake_ticket = models.CharField(max_length=32, null=True, blank=True, unique=True, verbose_name='排队号')
 
     class Meta:
         db_table = 'df_order_info'
@@ -69,3 +73,7 @@ class OrderGoods(BaseModel):
         db_table = 'df_order_goods'
         verbose_name = '订单商品'
         verbose_name_plural = '订单商品列表'
+        indexes = [
+            # 商品评论按照更新时间倒序分页
+            models.Index(fields=['sku', 'update_time'], name='order_goods_sku_time_idx'),
+        ]
@@ -0,0 +1,108 @@
+import logging
+import threading
+from decimal import Decimal
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.order.models import OrderInfo
+
+"""
+支付宝支付
+支付宝客户端在每个进程中只创建一次,私钥和支付宝公钥文件只读取一次
+支付结果以支付宝的异步通知(notify_url)为准,由celery任务幂等地修改订单状态,
+同步跳转的支付结果页(return_url)只读取本地订单状态,不再同步调用交易查询接口
+"""
+
+logger = logging.getLogger(__name__)
+
+# 支付宝支付
+PAY_METHOD_ALIPAY = 3
+# 待支付
+ORDER_STATUS_UNPAID = 1
+# 支付成功后的订单状态:待评价
+ORDER_STATUS_PAID = 4
+# 已取消(超时未支付被关闭)
+ORDER_STATUS_CANCELED = 6
+# 已经支付的订单状态:待发货、待签收、待评价、已完成
+PAID_ORDER_STATUS = (2, 3, 4, 5)
+# 支付成功的交易状态
+TRADE_SUCCESS_STATUS = ('TRADE_SUCCESS', 'TRADE_FINISHED')
+
+_alipay = None
+_alipay_lock = threading.Lock()
+
+
+def get_alipay():
+    """获取当前进程的支付宝客户端"""
+    global _alipay
+    if _alipay is None:
+        with _alipay_lock:
+            if _alipay is None:
+                _alipay = create_alipay()
+    return _alipay
+
+
+def create_alipay():
+    """创建支付宝客户端,ALIPAY_FAKE_GATEWAY为True时使用本地模拟网关"""
+    if settings.ALIPAY_FAKE_GATEWAY:
+        from DailyFresh.apps.order.fake_gateway import FakeAliPay
+        return FakeAliPay()
+
+    from alipay import AliPay
+    with open(settings.APP_PRIVATE_KEY_PATH) as f:
+        app_private_key = f.read()
+    with open(settings.ALIPAY_PUBLIC_KEY_PATH) as f:
+        alipay_public_key = f.read()
+    return AliPay(
+        appid=settings.ALIPAY_APP_ID, #应用APPID
+        app_notify_url=settings.ALIPAY_APP_NOTIFY_URL, #默认回调url
+        app_private_key_string=app_private_key, #应用私钥
+        alipay_public_key_string=alipay_public_key, #支付宝的公钥,验证支付宝回传消息使用,不要使用自己的公钥
+        sign_type='RSA2', #RSA或者RSA2
+        debug=settings.ALIPAY_DEBUG, #默认False, 线上环境,True代表沙箱环境
+    )
+
+
+def get_gateway_url():
+    """支付网关地址"""
+    if settings.ALIPAY_FAKE_GATEWAY:
+        return '/order/fake_gateway/?'
+    return settings.ALIPAY_GATEWAY_URL
+
+
+def verify_notify(data):
+    """校验支付宝异步通知的签名,data为通知参数的字典"""
+    data = dict(data)
+    signature = data.pop('sign', None)
+    if not signature:
+        return False
+    return get_alipay().verify(data, signature)
+
+
+def apply_payment(order_id, trade_no, total_amount):
+    """
+    支付成功,修改订单状态,可以重复调用
+    返回True表示本次调用修改了订单状态
+    """
+    try:
+        order = OrderInfo.objects.get(order_id=order_id, pay_method=PAY_METHOD_ALIPAY)
+    except OrderInfo.DoesNotExist:
+        logger.warning('支付通知的订单不存在: %s', order_id)
+        return False
+
+    if Decimal(total_amount) != order.total_price + order.transport_price:
+        logger.warning('支付通知的金额与订单不符: %s %s', order_id, total_amount)
+        return False
+
+    # 只修改待支付的订单,重复的通知不会产生影响
+    updated = OrderInfo.objects.filter(order_id=order_id, order_status=ORDER_STATUS_UNPAID) \
+        .update(order_status=ORDER_STATUS_PAID, trade_no=trade_no)
+
+    from DailyFresh.apps.order.expiry import cancel_expiry
+    cancel_expiry(order_id)
+    if updated == 0:
+        # 订单已经超时关闭、库存已经归还,但买家仍然完成了付款,保存支付编号用于退款
+        refund = OrderInfo.objects.filter(order_id=order_id, order_status=ORDER_STATUS_CANCELED, trade_no='') \
+            .update(trade_no=trade_no)
+        if refund:
+            logger.error('已关闭的订单收到支付通知,需要退款: %s %s', order_id, trade_no)
+    return updated == 1
@@ -0,0 +1,117 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.db.models import Case, When, Value, CharField
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.order import payment
+from DailyFresh.apps.order.expiry import cancel_expiry
+from DailyFresh.apps.order.models import OrderInfo
+
+"""
+支付对账
+找出已经在支付宝完成支付,但没有收到异步通知也没有跳转回/order/check/的订单:
+按照订单id分批遍历待支付的支付宝订单,使用有限大小的线程池并发调用交易查询接口,
+每批支付成功的订单用一条UPDATE语句修改状态和支付编号
+超时关闭订单前同样先查询交易(settle_expiring_orders),避免关闭已经付款的订单
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def query_trade(ali_pay, order_id):
+    """调用交易查询接口,查询失败返回None"""
+    try:
+        return ali_pay.api_alipay_trade_query(out_trade_no=order_id)
+    except Exception:
+        logger.exception('交易查询失败: %s', order_id)
+        return None
+
+
+def apply_paid_orders(paid):
+    """批量修改支付成功的订单,paid为{order_id: trade_no},返回修改的订单数"""
+    if not paid:
+        return 0
+    trade_no = Case(*[When(order_id=order_id, then=Value(no)) for order_id, no in paid.items()],
+                    output_field=CharField())
+    updated = OrderInfo.objects.filter(order_id__in=list(paid.keys()), order_status=payment.ORDER_STATUS_UNPAID) \
+        .update(order_status=payment.ORDER_STATUS_PAID, trade_no=trade_no)
+    cancel_expiry(*paid.keys())
+    return updated
+
+
+def check_trades(pool, ali_pay, orders):
+    """
+    并发查询orders [(order_id, total_price, transport_price)]的交易
+    返回({order_id: trade_no}支付成功的订单, [查询失败的订单id])
+    """
+    responses = pool.map(lambda order: query_trade(ali_pay, order[0]), orders)
+    paid = {}
+    failed = []
+    for (order_id, total_price, transport_price), response in zip(orders, responses):
+        if response is None:
+            failed.append(order_id)
+            continue
+        if response.get('code') != '10000' or response.get('trade_status') not in payment.TRADE_SUCCESS_STATUS:
+            continue
+        if 'total_amount' in response and Decimal(response['total_amount']) != total_price + transport_price:
+            logger.warning('交易金额与订单不符: %s %s', order_id, response['total_amount'])
+            continue
+        paid[order_id] = response.get('trade_no', '')
+    return paid, failed
+
+
+def settle_expiring_orders(order_ids):
+    """
+    超时关闭前查询其中待支付的支付宝订单,已经支付但没有收到通知的订单改为已支付
+    返回查询失败的订单id,这些订单不能关闭
+    """
+    orders = list(OrderInfo.objects.filter(
+        order_id__in=order_ids,
+        order_status=payment.ORDER_STATUS_UNPAID,
+        pay_method=payment.PAY_METHOD_ALIPAY,
+    ).values_list('order_id', 'total_price', 'transport_price'))
+    if not orders:
+        return []
+    ali_pay = payment.get_alipay()
+    with ThreadPoolExecutor(max_workers=min(settings.PAY_RECONCILE_WORKERS, len(orders))) as pool:
+        paid, failed = check_trades(pool, ali_pay, orders)
+    apply_paid_orders(paid)
+    return failed
+
+
+def reconcile_payments(chunk_size=None, workers=None):
+    """
+    对账全部待支付的支付宝订单
+    返回统计信息 {checked: 查询的订单数, paid: 修改为已支付的订单数, errors: 查询失败数, elapsed: 耗时, rate: 每秒查询数}
+    """
+    chunk_size = chunk_size or settings.PAY_RECONCILE_CHUNK_SIZE
+    workers = workers or settings.PAY_RECONCILE_WORKERS
+    ali_pay = payment.get_alipay()
+    stats = {'checked': 0, 'paid': 0, 'errors': 0}
+    start = time.time()
+
+    last_order_id = ''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            # 按主键分批遍历,不使用OFFSET
+            orders = list(OrderInfo.objects.filter(
+                order_status=payment.ORDER_STATUS_UNPAID,
+                pay_method=payment.PAY_METHOD_ALIPAY,
+                order_id__gt=last_order_id,
+            ).order_by('order_id').values_list('order_id', 'total_price', 'transport_price')[:chunk_size])
+            if not orders:
+                break
+            last_order_id = orders[-1][0]
+
+            paid, failed = check_trades(pool, ali_pay, orders)
+            stats['errors'] += len(failed)
+            stats['checked'] += len(orders)
+            stats['paid'] += apply_paid_orders(paid)
+
+    stats['elapsed'] = time.time() - start
+    stats['rate'] = stats['checked'] / stats['elapsed'] if stats['elapsed'] else 0
+    logger.info('支付对账完成: %s', stats)
+    return stats
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+"""
+订单相关的信号
+order_comments_submitted: 订单评论提交的事务提交后发送,sku_ids为本次写入了评论的商品id,
+                          缓存了商品评论的模块据此只清除对应商品的缓存
+"""
+
+order_comments_submitted = Signal(providing_args=['order_id', 'sku_ids'])
@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from decimal import Decimal
+
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from itsdangerous import BadSignature
+
+from DailyFresh.DailyFresh import settings
+
+"""
+订单价格快照
+提交订单页面(OrderPlaceView)将用户要购买的商品id、数量、价格及总计签名后放入页面,
+创建订单(OrderCommitView)时校验签名即可得到商品数量和价格,不需要再读取购物车和商品价格,只需校验库存
+快照在ORDER_SNAPSHOT_EXPIRES秒后失效,失效或与提交的商品不一致时按照原流程重新读取
+"""
+
+
+def dumps_snapshot(user, lines, total_count, total_amount):
+    """生成签名的快照,lines为[(sku_id, count, price)]"""
+    serializer = Serializer(settings.SECRET_KEY, settings.ORDER_SNAPSHOT_EXPIRES)
+    info = {
+        'user': user.id,
+        'lines': [[sku_id, count, str(price)] for sku_id, count, price in lines],
+        'total_count': total_count,
+        'total_amount': str(total_amount),
+    }
+    return serializer.dumps(info).decode()
+
+
+def loads_snapshot(user, token, sku_ids):
+    """
+    校验快照,sku_ids为本次提交的商品id
+    成功返回(counts, prices),counts为{sku_id: count},prices为{sku_id: price},
+    签名错误、已过期或与提交的商品不一致时返回None
+    """
+    serializer = Serializer(settings.SECRET_KEY, settings.ORDER_SNAPSHOT_EXPIRES)
+    try:
+        info = serializer.loads(token)
+    except BadSignature:
+        return None
+
+    if info.get('user') != user.id:
+        return None
+    counts = OrderedDict()
+    prices = {}
+    for sku_id, count, price in info['lines']:
+        counts[sku_id] = count
+        prices[sku_id] = Decimal(price)
+    if set(counts.keys()) != set(int(sku_id) for sku_id in sku_ids):
+        return None
+    return counts, prices
@@ -0,0 +1,109 @@
+import random
+import time
+
+from DailyFresh.DailyFresh import settings
+from DailyFresh.apps.goods import inventory
+from DailyFresh.apps.goods.models import GoodsSKU
+from DailyFresh.apps.order.commit import OrderCommitError, decrement_stock
+
+"""
+创建订单时的库存并发控制策略,通过settings.ORDER_COMMIT_STRATEGY选择:
+pessimistic: 悲观锁,select_for_update锁定商品行后再扣减库存
+optimistic: 乐观锁,扣减库存时比较读取到的库存,被其他订单修改则整体重试
+redis: 先在redis中原子预扣库存,预扣成功后再写数据库,失败时归还
+"""
+
+
+class StockConflict(OrderCommitError):
+    """乐观锁更新失败,商品库存已被其他订单修改"""
+
+    def __init__(self):
+        super(StockConflict, self).__init__(7, '下单失败')
+
+
+class InventoryStrategy(object):
+    """库存控制策略基类"""
+    name = ''
+    # 扣减库存前是否需要读取商品行,不需要时有价格快照的订单可以不查询商品
+    needs_rows = False
+
+    def run(self, attempt, counts):
+        """执行一次下单,attempt为在事务中完成下单的函数"""
+        return attempt()
+
+    def load_skus(self, sku_ids):
+        """获取订单中的商品"""
+        return GoodsSKU.objects.in_bulk(sku_ids)
+
+    def decrement(self, skus, counts):
+        """减少库存,增加销量"""
+        if decrement_stock(counts) != len(counts):
+            raise OrderCommitError(6, '商品库存不足')
+
+
+class PessimisticStrategy(InventoryStrategy):
+    """悲观锁"""
+    name = 'pessimistic'
+    needs_rows = True
+
+    def load_skus(self, sku_ids):
+        # 按照id顺序加锁,避免多个订单交叉加锁产生死锁
+        skus = GoodsSKU.objects.select_for_update().filter(id__in=sku_ids).order_by('id')
+        return {sku.id: sku for sku in skus}
+
+
+class OptimisticStrategy(InventoryStrategy):
+    """乐观锁,冲突时按照指数退避加随机抖动重试"""
+    name = 'optimistic'
+    needs_rows = True
+
+    def __init__(self, retries=None, backoff=None):
+        self.retries = retries or settings.ORDER_OPTIMISTIC_RETRIES
+        self.backoff = backoff if backoff is not None else settings.ORDER_OPTIMISTIC_BACKOFF
+
+    def run(self, attempt, counts):
+        for i in range(self.retries):
+            try:
+                return attempt()
+            except StockConflict:
+                # 连续尝试retries次,仍然下单失败,下单失败
+                if i == self.retries - 1:
+                    raise
+                time.sleep(random.uniform(0, self.backoff * (2 ** i)))
+
+    def decrement(self, skus, counts):
+        expected = {sku_id: skus[sku_id].stock for sku_id in counts}
+        if decrement_stock(counts, expected) != len(counts):
+            raise StockConflict()
+
+
+class RedisStrategy(InventoryStrategy):
+    """redis预扣库存,数据库只处理已经预扣成功的订单"""
+    name = 'redis'
+
+    def run(self, attempt, counts):
+        if not counts:
+            return attempt()
+        if not inventory.reserve_stock(counts):
+            raise OrderCommitError(6, '商品库存不足')
+        try:
+            return attempt()
+        except Exception:
+            inventory.release_stock(counts)
+            raise
+
+
+STRATEGIES = {
+    PessimisticStrategy.name: PessimisticStrategy,
+    OptimisticStrategy.name: OptimisticStrategy,
+    RedisStrategy.name: RedisStrategy,
+}
+
+
+def get_strategy(name=None):
+    """根据名称获取库存控制策略,默认使用settings.ORDER_COMMIT_STRATEGY"""
+    name = name or settings.ORDER_COMMIT_STRATEGY
+    try:
+        return STRATEGIES[name]()
+    except KeyError:
+        raise ValueError('未知的库存控制策略: %s' % name)
@@ -1,11 +1,15 @@
 from django.conf.urls import url
 
-from DailyFresh.apps.order.views import OrderPlaceView, OrderCommitView, OrderPayView, OrderCheckView, OrderCommentView
+from DailyFresh.apps.order.views import OrderPlaceView, OrderCommitView, OrderStatusView, OrderPayView, OrderNotifyView, \
+    FakeGatewayView, OrderCheckView, OrderCommentView
 
 urlpatterns = [
     url(r'^place/$', OrderPlaceView.as_view(), name='place'), #提交订单页面
     url(r'^commit/$', OrderCommitView.as_view(), name='commit'), #创建订单
+    url(r'^status/$', OrderStatusView.as_view(), name='status'), #异步下单结果查询
     url(r'^pay/$', OrderPayView.as_view(), name='pay'), #订单支付
+    url(r'^notify/$', OrderNotifyView.as_view(), name='notify'), #支付宝异步通知
+    url(r'^fake_gateway/$', FakeGatewayView.as_view(), name='fake_gateway'), #本地模拟支付网关
     url(r'^check/$', OrderCheckView.as_view(), name='check'), #订单签收
     url(r'^comment/$', OrderCommentView.as_view(), name='comment'), #订单评论
 ]
\ No newline at end of file
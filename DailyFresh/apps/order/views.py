@@ -1,7 +1,11 @@
 from django.http import JsonResponse, HttpResponse
+from django.db import transaction
 from django.shortcuts import redirect, render
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 
 
 # 提交订单页面
@@ -10,9 +14,15 @@ from django_redis import get_redis_connection
 
 from DailyFresh.DailyFresh import settings
 from DailyFresh.apps.goods.models import GoodsSKU
+from DailyFresh.apps.order import intake, payment
+from DailyFresh.apps.order.commit import OrderCommitError, parse_sku_ids, get_cart_counts, commit_order, \
+    TRANSPORT_PRICE
 from DailyFresh.apps.order.models import OrderInfo, OrderGoods
+from DailyFresh.apps.order.signals import order_comments_submitted
+from DailyFresh.apps.order.snapshot import dumps_snapshot, loads_snapshot
 from DailyFresh.apps.user.models import Address
 from DailyFresh.apps.user.views import LoginRequiredMixin
+from DailyFresh.utils.idempotency import IdempotentMixin
 
 
 class OrderPlaceView(View):
@@ -31,28 +41,36 @@ class OrderPlaceView(View):
         cart_key = 'cart_%d' % user.id
         conn = get_redis_connection('default')
 
-        # 便利sku_ids获取用户所购买的商品的信息
+        # 一次HMGET从redis中获取用户所购买的商品的数量,一次IN查询获取商品信息
+        try:
+            counts = get_cart_counts(conn, cart_key, sku_ids)
+        except OrderCommitError:
+            return redirect(reverse('cart:display'))
+        sku_dict = GoodsSKU.objects.in_bulk(list(counts.keys()))
+        if len(sku_dict) != len(counts):
+            return redirect(reverse('cart:display'))
+
         skus = []
+        lines = []
         total_count = 0
         total_amount = 0
-        for sku_id in sku_ids:
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 从redis中获取用户所购买的商品的数量
-            count = conn.hget(cart_key, sku_id)
+        for sku_id, count in counts.items():
+            sku = sku_dict[sku_id]
             # 商品小计
-            amount = sku.price * int(count)
+            amount = sku.price * count
             # 给sku增加count和amount属性,分别用来保存用户要购买的商品数量和小计
             sku.count = count
             sku.amount = amount
 
             # 追加到商品列表
             skus.append(sku)
+            lines.append((sku_id, count, sku.price))
             # 累加计算用户购买的商品的总件数和总金额
-            total_count += int(count)
+            total_count += count
             total_amount += amount
 
         # 运费
-        transport_price = 10
+        transport_price = TRANSPORT_PRICE
         # 付款总额
         total_pay = total_amount + transport_price
 
@@ -63,7 +81,9 @@ class OrderPlaceView(View):
             'total_amount': total_amount,
             'transport_price': transport_price,
             'total_pay': total_pay,
-            'sku_ids': ','.join(sku_ids),
+            'sku_ids': ','.join(str(sku_id) for sku_id in counts.keys()),
+            # 签名的价格快照,创建订单时只需校验库存
+            'snapshot': dumps_snapshot(user, lines, total_count, total_amount),
         }
         return render(request, 'place_order.html', context)
 
@@ -88,312 +108,91 @@ class OrderPlaceView(View):
 6.更新订单信息中的商品的总数量和总价格
 7.删除购物车中对应的记录
 """
-# 未处理订单并发问题
-class OrderCommitView(View):
+# 库存并发控制策略通过settings.ORDER_COMMIT_STRATEGY配置,见apps/order/strategies.py
+class OrderCommitView(IdempotentMixin, View):
     """创建订单"""
-    # pass
+    # 订单创建成功或已经进入排队
+    idempotency_success_res = (5, 8)
+
     def post(self, request):
-        # 判断用户是否登录
         user = request.user
-        if not user.is_authenticated():
+        if not user.is_authenticated:
             return JsonResponse({'res': 0, 'error_msg': '用户未登录'})
 
-        # 接受参数
         addr_id = request.POST.get('addr_id', '')
         pay_method = request.POST.get('pay_method', '')
         sku_ids = request.POST.get('sku_ids', '')
-
-        # 校验参数
         if not all([addr_id, pay_method, sku_ids]):
             return JsonResponse({'res': 1, 'error_msg': '参数不完整'})
 
-        # 校验地址id
         try:
             addr = Address.objects.get(id=addr_id)
         except Address.DoesNotExist:
             return JsonResponse({'res': 2, 'error_msg': '地址信息错误'})
 
-        # 校验支付方式
         if pay_method not in OrderInfo.PAY_METHODS.keys():
             return JsonResponse({'res': 3, 'error_msg': '非法的支付方式'})
 
-        # 组织订单信息
-        # 订单id:当前时间+用户id
-        from datetime import datetime
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
-
-        transport_price = 10
-        total_count = 0
-        total_price = 0
-        # todo: 向df_order_info中添加一条记录
-        order = OrderInfo.objects.create(
-            order_id=order_id,
-            user=user,
-            addr=addr,
-            pay_method=pay_method,
-            total_count=total_price,
-            total_price=total_price,
-            transport_price=transport_price,
-        )
-        # todo:订单中包含几个商品需要向df_order_goods中添加几条记录
         conn = get_redis_connection('default')
         cart_key = 'cart_%d' % user.id
-        sku_ids = sku_ids.split(',')
-        for sku_id in sku_ids:
-            try:
-                sku = GoodsSKU.objects.get(id=sku_id)
-            except GoodsSKU.DoesNotExist:
-                return JsonResponse({'res': 4, 'error_msg': '商品信息错误'})
-
-            count = conn.hget(cart_key, sku_id)
-
-            import time
-            time.sleep(10)
-
-            OrderGoods.objects.create(
-                order=order,
-                sku=sku,
-                count=count,
-                price=sku.price,
-            )
-
-            # 减少商品库存,增加销量
-            sku.stock -= int(count)
-            sku.sales += int(count)
-            sku.save()
-
-            # 累计计算订单中商品的总数量和总价格
-            total_count += int(count)
-            total_price += sku.price * int(count)
-
-        # todo:更新订单信息中商品的总数量和总价格
-        order.total_count = total_count
-        order.total_price = total_price
-        order.save()
-
-        # todo: 删除购物车中对应的记录
-        #     hdel(key, *args)
-        conn.hdel(cart_key, *sku_ids)
-        return JsonResponse({'res': 5, 'error_msg': '订单创建成功'})
-
-
-from django.db import transaction
-# 使用悲观锁处理创建订单
-class OrderCommitView(View):
-    """创建订单"""
-
-    @transaction.atomic
-    def post(self, request):
-        user = request.user
-        if not user.is_authenticated():
-            return JsonResponse({'res': 0, 'error_msg': '用户未登录'})
-
-        addr_id = request.POST.get('addr_id', '')
-        pay_method = request.POST.get('pay_method', '')
-        sku_ids = request.POST.get('sku_ids', '')
-        if not all([addr_id, pay_method, sku_ids]):
-            return JsonResponse({'res': 1, 'error_msg': '参数不完整'})
-
         try:
-            addr = Address.objects.get(id=addr_id)
-        except Address.DoesNotExist:
-            return JsonResponse({'res': 2, 'error_msg': '地址信息错误'})
-
-        if pay_method not in OrderInfo.PAY_METHODS.keys():
-            return JsonResponse({'res': 3, 'error_msg': '非法的支付方式'})
-
-        from datetime import datetime
-        order_id = datetime.now().strftime("%Y%m%d%H%M%S") + str(user.id)
-
-        transpost_price = 10
-
-        total_count = 0
-        total_price = 0
-        # 设置事务保护点
-        sid = transaction.savepoint()
-        try:
-            # 向df_order_info中添加一条记录
-            order = OrderInfo.objects.create(
-                order_id=order_id,
-                user=user,
-                addr=addr,
-                pay_method=pay_method,
-                total_count=total_count,
-                total_price=total_price,
-                transpost_price=transpost_price,
-            )
-
-            # 订单中包含几个商品就需要向df_order_goods中添加几条记录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-
-            sku_ids = sku_ids.split(',')
-            for sku_id in sku_ids:
-                try:
-                    sku = GoodsSKU.objects.select_for_update().get(id=sku_id)
-                except GoodsSKU.DoesNotExist:
-                    # 回滚事务到sid保护点
-                    transaction.savepoint_rollback(sid)
-                    return JsonResponse({'res': 4, 'error_msg': '商品信息错误'})
-
-                # 从redis中获取用户要购买的商品的数量
-                count = conn.hget(cart_key, sku_id)
-                # 判断商品的库存
-                if int(count) > sku.stock:
-                    transaction.savepoint_rollback(sid)
-                    return JsonResponse({'res': 6, 'error_msg': '商品库存不足'})
-
-                # 模拟订单并发问题
-                import time
-                time.sleep(10)
-
-                # 向df_order_goods中添加一条记录
-                OrderGoods.objects.create(
-                    order=order,
-                    sku=sku,
-                    count=count,
-                    price=sku.price,
-                )
-
-                # 减少商品库存,增加销量
-                sku.stock -= int(count)
-                sku.sales += int(count)
-                sku.save()
-
-                # 累计计算订单中商品的总数量和总价格
-                total_count += int(count)
-                total_price += sku.price * int(count)
-
-            # 更新订单信息中的商品的总数量和总价格
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
-        except Exception as e:
-            transaction.savepoint_rollback(sid)
-            return JsonResponse({'res': 7, 'error_msg': '下单失败'})
+            sku_ids = parse_sku_ids(sku_ids)
+            # 价格快照有效时直接使用快照中的数量和价格,否则从购物车中读取
+            lines = loads_snapshot(user, request.POST.get('snapshot', ''), sku_ids)
+            if lines is not None:
+                counts, prices = lines
+            else:
+                counts, prices = get_cart_counts(conn, cart_key, sku_ids), None
+            # 异步下单,放入队列后立即返回排队号
+            if settings.ORDER_COMMIT_ASYNC:
+                ticket = intake.submit_order(user, addr, pay_method, counts, prices, conn)
+                return JsonResponse({'res': 8, 'ticket': ticket, 'error_msg': '订单排队中'})
+            commit_order(user, addr, pay_method, counts, prices=prices)
+        except OrderCommitError as e:
+            return JsonResponse({'res': e.res, 'error_msg': e.error_msg})
 
         # 删除购物车中对应的记录
-        # hdel(key, *args)
+        # conn.hdel(key, *args)
         conn.hdel(cart_key, *sku_ids)
-        return JsonResponse({'res': 5, 'error': '订单创建成功'})
+        return JsonResponse({'res': 5, 'error_msg': '订单创建成功'})
 
 
-# 使用乐观锁处理创建订单
-class OrderCommitView(View):
-    """创建订单"""
+# 异步下单结果查询
+# 前端传递的参数:排队号(ticket)
+# url地址: /order/status/
+class OrderStatusView(View):
+    """查询异步下单结果"""
 
-    def post(self, request):
+    def get(self, request):
         user = request.user
-        if not user.is_authenticated():
+        if not user.is_authenticated:
             return JsonResponse({'res': 0, 'error_msg': '用户未登录'})
 
-        addr_id = request.POST.get('addr_id', '')
-        pay_method = request.POST.get('pay_method', '')
-        sku_ids = request.POST.get('sku_ids', '')
-        if not all([addr_id, pay_method, sku_ids]):
-            return JsonResponse({'res': 1, 'error_msg': '参数不完整'})
+        result = intake.get_ticket(request.GET.get('ticket', ''))
+        if result is None or result['user_id'] != str(user.id):
+            return JsonResponse({'res': 1, 'error_msg': '无效的排队号'})
 
-        try:
-            addr = Address.objects.get(id=addr_id)
-        except Address.DoesNotExist:
-            return JsonResponse({'res': 2, 'error_msg': '地址信息错误'})
-
-        if pay_method not in OrderInfo.PAY_METHODS.keys():
-            return JsonResponse({'res': 3, 'error_msg': '非法的支付方式'})
-
-        # 组织订单信息
-        from datetime import datetime
-        order_id = datetime.now().strftime("%Y%m%d%H%M%S") + str(user.id)
-
-        transpost_price = 10
-
-        total_count = 0
-        total_price = 0
-        # 设置事务保护点
-        sid = transaction.savepoint()
-        try:
-            # 向df_order_info中添加一条记录
-            order = OrderInfo.objects.create(
-                order_id=order_id,
-                user=user,
-                addr=addr,
-                pay_method=pay_method,
-                total_count=total_count,
-                total_price=total_price,
-                transpost_price=transpost_price,
-            )
-
-            # 订单中包含几个商品就需要向df_order_goods中添加几条记录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-
-            sku_ids = sku_ids.split(',')
-            for sku_id in sku_ids:
-                for i in range(3):
-                    try:
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except GoodsSKU.DoesNotExist:
-                        transaction.savepoint_rollbask(sid)
-                        return JsonResponse({'res': 4, 'error_msg': '商品信息错误'})
-
-                    count = conn.hget(cart_key, sku_id)
-
-                    if int(count) > sku.stock:
-                        transaction.savepoint_rollback(sid)
-                        return JsonResponse({'res': 6, 'error_msg': '商品库存不足'})
-
-                    origin_stock = sku.stock
-                    new_stock = origin_stock - int(count)
-                    new_sales = sku.sales + int(count)
-
-                    # update df_goods_sku set stock="new_stock", sales='new_sales' where id=sku_id and stock=origin_stock;
-                    # update方法返回更新的行数
-                    res = GoodsSKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=new_stock, sales=new_sales)
-                    if res == 0:
-                        # 连续尝试3次,仍然下单失败,下单失败
-                        if i == 2:
-                            transaction.savepoint_rollback(sid)
-                            return JsonResponse({'res': 7, 'error_msg': '下单失败2'})
-                        continue
-
-                    # 向df_order_goods中添加一条记录
-                    OrderGoods.objects.create(
-                        order=order,
-                        sku=sku,
-                        count=count,
-                        price=sku.price,
-                    )
-
-                    # 累计计算订单中商品的总数量和总价格
-                    total_count += int(count)
-                    total_price += sku.price * int(count)
-                    # 更新成功,跳出循环
-                    break
-
-            # 更新订单信息中商品的总数量和总价格
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
-        except Exception as e:
-            transaction.savepoint_rollback(sid)
-            return JsonResponse({'res': 7, 'error_msg': '下单失败1'})
-
-        # 删除购物车中对应的记录
-        # conn.hdel(key, *args)
-        conn.hdel(cart_key, *sku_ids)
-        return JsonResponse({'res': 5, 'error_msg': '订单创建成功'})
+        if result['status'] == intake.TICKET_PENDING:
+            return JsonResponse({'res': 2, 'status': result['status'], 'error_msg': '订单排队中'})
+        if result['status'] == intake.TICKET_DONE:
+            return JsonResponse({'res': 3, 'status': result['status'], 'order_id': result['order_id'],
+                                 'error_msg': '订单创建成功'})
+        return JsonResponse({'res': 4, 'status': result['status'], 'error_msg': result['error_msg']})
 
 
 # 订单支付
 # 前端传递的参数:订单id(order_id)
 # url地址:/order/pay/
-class OrderPayView(View):
+class OrderPayView(IdempotentMixin, View):
     """订单支付"""
+    idempotency_success_res = (3,)
+    # 订单超时关闭后不再返回保存的支付地址
+    idempotency_ttl = settings.ORDER_PAY_TIMEOUT
     # pass
     def post(self, request):
         # 登录验证
         user = request.user
-        if not user.is_authenticated():
+        if not user.is_authenticated:
             return JsonResponse({'res': 0, 'error_msg': '用户未登录'})
 
         order_id = request.POST.get('order_id', '')
@@ -411,94 +210,91 @@ class OrderPayView(View):
             return JsonResponse({'res': 2, 'error_msg': '无效订单id'})
 
         # 业务处理:调用支付宝python SDK中的api_alipay_trade_page_pay函数
-        ali_pay = AliPay(
-            appid=settings.ALIPAY_APP_ID, #应用APPID
-            app_notify_url=settings.ALIPAY_APP_NOTIFY_URL, #默认回调url
-            app_private_key_path=settings.APP_PRIVATE_KEY_PATH, #应用私钥文件路径
-            alipay_public_key_path=settings.ALIPAY_PUBLIC_KEY_PATH, #支付宝的公钥文件,验证支付宝回传消息使用,不要使用自己的公钥
-            sign_type='RSA2', #RSA或者RSA2
-            debug = settings.ALIPAY_DEBUG, #默认False, 线上环境,True代表沙箱环境
-        )
+        # 支付宝客户端在进程中只创建一次
+        ali_pay = payment.get_alipay()
 
         # 电脑网站支付,需要跳转https://openapi.alipay.com/gateway.do? + order_string
         total_pay = order.total_price + order.transport_price
-        order_string = ali_pay.api_alipay_trande_page_apy(
-            out_trade_on=order_id, #订单id
+        order_string = ali_pay.api_alipay_trade_page_pay(
+            out_trade_no=order_id, #订单id
             total_amount=str(total_pay), #订单实付款
             subject="dailyfresh%s" % order_id, #订单标题
-            return_url='http://127.0.0.1:8000/order/check',
-            notify_url=None #不填默认为notify_url
+            return_url=settings.ALIPAY_APP_RETURN_URL,
+            notify_url=settings.ALIPAY_APP_NOTIFY_URL, #支付宝异步通知地址
         )
 
-        pay_url = settings.ALIPAY_GATEWAY_URL + order_string
+        pay_url = payment.get_gateway_url() + order_string
         return JsonResponse({'res': 3, 'pay_url': pay_url, 'error_msg': 'OK'})
 
 
+# 支付宝异步通知
+# url地址:/order/notify/
+@method_decorator(csrf_exempt, name='dispatch')
+class OrderNotifyView(View):
+    """支付结果异步通知"""
+
+    def post(self, request):
+        data = request.POST.dict()
+        if not payment.verify_notify(data):
+            return HttpResponse('failure')
+
+        if data.get('trade_status') in payment.TRADE_SUCCESS_STATUS:
+            # 修改订单状态交给celery任务处理,支付宝收到success后不再重复通知
+            from DailyFresh.celery_tasks.tasks import apply_order_payment
+            apply_order_payment.delay(data.get('out_trade_no'), data.get('trade_no'), data.get('total_amount'))
+        return HttpResponse('success')
+
+
+# 本地模拟的支付网关,settings.ALIPAY_FAKE_GATEWAY为True时使用
+# url地址:/order/fake_gateway/
+class FakeGatewayView(View):
+    """模拟用户在支付宝完成支付"""
+
+    def get(self, request):
+        if not settings.ALIPAY_FAKE_GATEWAY:
+            return HttpResponse(status=404)
+
+        ali_pay = payment.get_alipay()
+        params = request.GET.dict()
+        if not ali_pay.verify(params, params.pop('sign', '')):
+            return HttpResponse('签名错误')
+
+        # 模拟支付宝发出异步通知,然后跳转回return_url
+        notify = ali_pay.pay(params['out_trade_no'], params['total_amount'])
+        if payment.verify_notify(notify):
+            from DailyFresh.celery_tasks.tasks import apply_order_payment
+            apply_order_payment.delay(notify['out_trade_no'], notify['trade_no'], notify['total_amount'])
+        return redirect('%s?out_trade_no=%s' % (params['return_url'], params['out_trade_no']))
+
+
 # url地址:/order/check/
 class OrderCheckView(LoginRequiredMixin, View):
     """订单签收"""
     # pass
     def get(self, request):
-        """订单支付结果查询"""
+        """订单支付结果,只读取本地订单状态,支付结果由异步通知更新"""
         user = request.user
         order_id = request.GET.get('out_trade_no')
         try:
             order = OrderInfo.objects.get(
                 order_id=order_id,
                 user=user,
-                order_status=1,
                 pay_method=3,
             )
         except OrderInfo.DoesNotExist:
             return HttpResponse("订单信息错误")
 
-        # 业务处理:调用python SDK中的交易查询接口
-        # 初始化
-        ali_pay = AliPay(
-            appid=settings.ALIPAY_APP_ID,
-            app_notify_url=settings.ALIPAY_APP_NOTIFY_URL,
-            app_private_key_path=settings.APP_PRIVATE_KEY_PATH,
-            alipay_public_key_path=settings.ALIPAY_PUBLIC_KEY_PATH,
-            sign_type='RSA2',
-            debug=settings.ALIPAY_DEBUG,
-        )
-        """
-        调用python SDK中api_alipay_trade_query参数说明:
-        {
-            'trade_no': '', #支付宝交易号
-            'code': '10000', #网关返回码
-            'invoice_amount': '20.00',
-            'open_id': '',
-            'fund_bill_list': [
-                {
-                    'amount': '20.00',
-                    'fund_chanel': 'ALIPAYACCOUNT'
-                }
-            ],
-            'buyer_login_id': '',
-            'send_pay_date': '',
-            'receipt_amount': '20.00',
-            'out_trade_no': '',
-            'buyer_pay_amount': '',
-            'buyer_user_id': '',
-            'msg': 'Success',
-            'point_amount': '0.00',
-            'trade_status': 'TRADE_SUCCESS', #支付状态
-            'total_amount': '20.00',
-        }
-        """
-
-        # 调用python SDK中api_alipay_trade_query查询结果
-        response = ali_pay.api_alipay_trande_query(out_trade_no=order_id)
-        # 获取支付宝网关的返回码
-        res_code = response.get('code')
-        if res_code == '10000' and response.get('trade_status') == 'TRADE_SUCCESS':
-            order.order_status = 4 #待评价
-            order.trade_no = response.get('trade_no')
-            order.save()
+        if order.order_status == payment.ORDER_STATUS_UNPAID:
+            # 尚未收到支付宝的异步通知
+            return render(request, 'pay_result.html', {'pay_result': '支付结果确认中', 'pending': True})
+        if order.order_status == payment.ORDER_STATUS_CANCELED:
+            if order.trade_no:
+                # 订单超时关闭后才收到付款,见payment.apply_payment
+                return render(request, 'pay_result.html', {'pay_result': '订单已关闭,支付的款项将原路退回'})
+            return render(request, 'pay_result.html', {'pay_result': '订单已超时关闭'})
+        if order.order_status in payment.PAID_ORDER_STATUS:
             return render(request, 'pay_result.html', {'pay_result': '支付成功'})
-        else:
-            return render(request, 'pay_result.html', {'pay_result': '支付失败'})
+        return HttpResponse("订单信息错误")
 
 
 # 订单评论
@@ -510,18 +306,18 @@ class OrderCommentView(LoginRequiredMixin, View):
         """展示评论页面"""
         user = request.user
         if not order_id:
-            return redirect(reverse('user: order', kwargs={'page: 1'}))
+            return redirect(reverse('user:order', kwargs={'page': 1}))
 
         try:
             order = OrderInfo.objects.get(order_id=order_id, user=user)
         except OrderInfo.DoesNotExist:
-            return redirect(reverse('user: order', kwargs={'page': 1}))
+            return redirect(reverse('user:order', kwargs={'page': 1}))
 
         # 根据订单的状态获取订单的状态标题
         order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
 
-        # 获取订单的商品信息
-        order_skus = OrderInfo.objects.filter(order_id=order_id)
+        # 获取订单的商品信息,一次查询同时取出商品
+        order_skus = list(OrderGoods.objects.filter(order=order).select_related('sku'))
         for order_sku in order_skus:
             amount = order_sku.count * order_sku.price
             # 动态给order_sku增加属性amount,保存商品小计
@@ -535,28 +331,49 @@ class OrderCommentView(LoginRequiredMixin, View):
         """处理评论内容"""
         user = request.user
         if not order_id:
-            return redirect(reverse('user: order', kwargs={'page': 1}))
+            return redirect(reverse('user:order', kwargs={'page': 1}))
 
         try:
             order = OrderInfo.objects.get(order_id=order_id, user=user)
         except OrderInfo.DoesNotExist:
-            return redirect(reverse('user: order', kwargs={'page': 1}))
+            return redirect(reverse('user:order', kwargs={'page': 1}))
 
         # 获取评论条数
-        total_count = request.POST.get('total_count')
-        total_count = int(total_count)
+        try:
+            total_count = int(request.POST.get('total_count', 0))
+        except ValueError:
+            return redirect(reverse('user:order', kwargs={'page': 1}))
 
-        # 循环获取订单中商品的评论内容
+        # 一次查询取出订单中的全部商品
+        order_goods = dict((og.sku_id, og) for og in OrderGoods.objects.filter(order=order))
+
+        # 获取订单中商品的评论内容,只修改属于该订单的商品
+        now = timezone.now()
+        commented = {}
         for i in range(1, total_count + 1):
-            sku_id = request.POST.get('sku_%d' % i, '')
-            content = request.POST.get('content_%d' % i, '')
             try:
-                order_goods = OrderGoods.objects.get(order=order, sku_id=sku_id)
-            except OrderGoods.DoesNotExist:
+                sku_id = int(request.POST.get('sku_%d' % i, ''))
+            except ValueError:
                 continue
-            order_goods.content = content
-            order_goods.save()
-
-        order.order_status = 5 #完成
-        order.save()
-        return redirect(reverse('user: order', kwargs={'page': 1}))
+            content = request.POST.get('content_%d' % i, '').strip()
+            og = order_goods.get(sku_id)
+            if og is None or not content:
+                continue
+            og.comment = content[:OrderGoods._meta.get_field('comment').max_length]
+            # bulk_update不会自动更新auto_now字段
+            og.update_time = now
+            commented[sku_id] = og
+
+        with transaction.atomic():
+            # 一条语句写入全部评论
+            if commented:
+                OrderGoods.objects.bulk_update(commented.values(), ['comment', 'update_time'])
+            order.order_status = 5 #完成
+            order.save(update_fields=['order_status', 'update_time'])
+
+            if commented:
+                # 事务提交后通知评论缓存清除对应商品
+                transaction.on_commit(lambda: order_comments_submitted.send(
+                    sender=OrderGoods, order_id=order.order_id, sku_ids=list(commented.keys())))
+
+        return redirect(reverse('user:order', kwargs={'page': 1}))
@@ -44,7 +44,7 @@ class Address(BaseModel):
     is_default = models.BooleanField(default=False, verbose_name='是否默认')
 
     # 自定义模型管理器类对象
-    manager = AddressManager()
+    objects = AddressManager()
 
     class Meta:
         db_table = "df_address"
@@ -253,8 +253,8 @@ class UserOrderView(LoginRequiredMixin, View):
         # 查询订单情况,若有订单则为1
         info_msg = 1
         try:
-            # 查询结果按照创建时间倒序排列
-            order_infos = OrderInfo.objects.filter(user = user).order_by('-created_time')
+            # 查询结果按照创建时间倒序排列,订单id按时间有序,直接使用主键排序
+            order_infos = OrderInfo.objects.filter(user = user).order_by('-order_id')
         except OrderInfo.DoesNotExist:
             info_msg = 0
 
@@ -1,3 +1,55 @@
 """celery配置"""
+from datetime import timedelta
+
 BROKER_URL = 'redis://127.0.0.1:6379/1'
-CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/2'
\ No newline at end of file
+CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/2'
+
+# 定时任务,使用celery beat启动
+CELERYBEAT_SCHEDULE = {
+    # 将秒杀商品的库存写入数据库
+    'persist-flash-sale-stock': {
+        'task': 'celery_tasks.tasks.persist_flash_sale_stock',
+        'schedule': timedelta(seconds=10),
+    },
+    # 将redis中累加的商品销量写入数据库
+    'flush-goods-sales': {
+        'task': 'celery_tasks.tasks.flush_goods_sales',
+        'schedule': timedelta(seconds=10),
+    },
+    # 兜底处理异步下单队列
+    'drain-order-intake': {
+        'task': 'celery_tasks.tasks.drain_order_intake',
+        'schedule': timedelta(seconds=30),
+    },
+    # 关闭超时未支付的订单
+    'close-expired-orders': {
+        'task': 'celery_tasks.tasks.close_expired_orders',
+        'schedule': timedelta(minutes=1),
+    },
+    # 支付对账
+    'reconcile-payments': {
+        'task': 'celery_tasks.tasks.reconcile_payments',
+        'schedule': timedelta(minutes=10),
+    },
+    # 兜底处理搜索索引的更新队列
+    'drain-search-index': {
+        'task': 'celery_tasks.tasks.drain_search_index',
+        'schedule': timedelta(minutes=1),
+    },
+    # 重新生成进程内商品搜索索引的快照,清除已删除的文档
+    'build-ngram-snapshot': {
+        'task': 'celery_tasks.tasks.build_ngram_snapshot',
+        'schedule': timedelta(hours=1),
+    },
+    # 校对秒杀商品在redis中的库存
+    'reconcile-flash-sale-stock': {
+        'task': 'celery_tasks.tasks.reconcile_flash_sale_stock',
+        'schedule': timedelta(minutes=1),
+    },
+}
+
+# 异步下单任务使用单独的队列,由专门的worker处理
+# celery -A celery_tasks.tasks worker -Q order
+CELERY_ROUTES = {
+    'celery_tasks.tasks.drain_order_intake': {'queue': 'order'},
+}
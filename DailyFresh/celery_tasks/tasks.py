@@ -3,10 +3,9 @@ import sys
 
 import django
 from django.core.mail import send_mail
-from django.template import loader
 
 from DailyFresh.DailyFresh import settings
-from DailyFresh.apps.goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from DailyFresh.apps.goods import inventory, sales, static_index
 from DailyFresh.celery_tasks.celery import app as app
 
 # 设置django配置依赖的环境变量
@@ -32,38 +31,73 @@ def send_register_active_email(to_email, username, token):
 
 @app.task
 def generate_static_index_html():
-    """使用celery生成静态首页文件"""
-    # 获取商品的分类信息
-    types = GoodsType.objects.all()
-    # 获取首页轮播商品信息
-    index_banner = IndexGoodsBanner.objects.all().order_by('index')
-    # 获取首页促销活动的信息
-    promotion_banner = IndexPromotionBanner.objects.all().order_by('index')
-    # 获取首页分类商品的展示信息
-    for category in types:
-        # 获取type种类在首页展示的图片商品信息和文字商品信息
-        image_banner = IndexTypeGoodsBanner.objects.filter(category=category, display_type=1)
-        title_banner = IndexTypeGoodsBanner.objects.filter(category=category, display_type=0)
-
-        # 给category对象增加title_banner, image_banner
-        # 分别保存category种类在首页展示的文字商品和图片商品的信息
-        category.title_banner = title_banner
-        category.image_banner = image_banner
-
-    cart_count = 0
-    # 组织模板上下文
-    context = {
-        'types': types,
-        'index_banner': index_banner,
-        'promotion_banner': promotion_banner,
-        'cart_count': cart_count,
-    }
-
-    # 加载模板
-    temp = loader.get_template('static_index.html')
-    # 渲染模板
-    static_html = temp.render(context)
-    # 生成静态首页文件
-    save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
-    with open(save_path, 'w') as f:
-        f.write(static_html)
+    """使用celery生成静态首页文件,距离最后一次修改不足静默期时推迟执行"""
+    delay = static_index.pending_delay()
+    if delay > 0:
+        generate_static_index_html.apply_async(countdown=delay)
+        return None
+    return static_index.render()
+
+
+@app.task
+def persist_flash_sale_stock():
+    """将秒杀商品已下单的数量写入数据库"""
+    from django_redis import get_redis_connection
+    conn = get_redis_connection('default')
+    # 清除标记,之后提交的订单会重新发出任务
+    conn.delete(inventory.FLASH_PERSIST_SCHEDULED_KEY)
+    return inventory.persist_flash_journal(conn)
+
+
+@app.task
+def reconcile_flash_sale_stock():
+    """校对秒杀商品在redis中的库存,修复偏差"""
+    return inventory.reconcile_flash_stock()
+
+
+@app.task
+def drain_order_intake():
+    """批量处理异步下单队列中的请求"""
+    from DailyFresh.apps.order import intake
+    return intake.drain()
+
+
+@app.task
+def drain_search_index():
+    """将队列中修改过的商品批量写入搜索索引"""
+    from DailyFresh.apps.goods import search_queue
+    return search_queue.drain()
+
+
+@app.task
+def build_ngram_snapshot():
+    """重新生成进程内商品搜索索引的快照,各进程检测到快照更新后重新加载"""
+    from DailyFresh.apps.goods import ngram_search
+    return len(ngram_search.rebuild_snapshot())
+
+
+@app.task
+def flush_goods_sales():
+    """将redis中累加的商品销量批量写入数据库"""
+    return sales.flush_sales()
+
+
+@app.task
+def close_expired_orders():
+    """批量关闭超时未支付的订单,归还库存"""
+    from DailyFresh.apps.order import expiry
+    return expiry.close_expired_orders()
+
+
+@app.task
+def apply_order_payment(order_id, trade_no, total_amount):
+    """处理支付宝异步通知,修改订单状态"""
+    from DailyFresh.apps.order import payment
+    return payment.apply_payment(order_id, trade_no, total_amount)
+
+
+@app.task
+def reconcile_payments():
+    """支付对账,修复已支付但未收到通知的订单"""
+    from DailyFresh.apps.order import reconcile
+    return reconcile.reconcile_payments()
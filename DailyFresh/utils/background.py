@@ -0,0 +1,48 @@
+import logging
+import os
+import threading
+import time
+
+"""
+进程内的后台同步线程
+进程内的索引(搜索索引、筛选位图)由后台线程定时加载和同步,请求中只读取当前的索引对象
+线程在第一次使用时启动,记录启动时的pid,fork出的子进程中会重新启动
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicThread(object):
+    """
+    每隔interval()秒在后台线程中调用一次func
+    interval为返回秒数的函数,修改settings后下一次等待即生效
+    """
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        """当前进程中线程尚未启动时启动"""
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            thread = threading.Thread(target=self.run, name=self.name)
+            thread.daemon = True
+            thread.start()
+            self.pid = pid
+
+    def run(self):
+        while True:
+            try:
+                self.func()
+            except Exception:
+                # 本次失败时继续使用当前的索引,下次重试
+                logger.exception('后台同步失败: %s', self.name)
+            time.sleep(self.interval())
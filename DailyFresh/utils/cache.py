@@ -0,0 +1,143 @@
+import json
+import random
+import time
+from collections import defaultdict
+
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
+
+from DailyFresh.DailyFresh import settings
+
+"""
+防击穿的缓存
+每条缓存保存 {data: 数据, version: 数据版本, fresh_until: 软过期时间},
+    软过期或版本不一致后只有拿到重建锁的一个请求重新生成,其余请求继续返回旧数据,
+    完全没有缓存时拿不到锁的请求等待重新生成的结果,超过等待时间后自行生成
+软过期和硬过期(redis过期时间)都加入随机抖动,避免大量缓存在同一时刻过期
+cache_stats: 统计信息 {名称:hit 命中数, 名称:stale 返回旧数据数, 名称:miss 未命中数,
+                       名称:wait 等待其他请求生成数, 名称:rebuild 重新生成数}
+"""
+
+CACHE_STATS_KEY = 'cache_stats'
+STAT_KINDS = ('hit', 'stale', 'miss', 'wait', 'rebuild')
+
+
+def get_cache_stats(conn=None):
+    """获取各缓存的统计信息"""
+    conn = conn or get_redis_connection('default')
+    stats = {}
+    for field, value in conn.hgetall(CACHE_STATS_KEY).items():
+        name, kind = field.decode().rsplit(':', 1)
+        stats.setdefault(name, dict((k, 0) for k in STAT_KINDS))[kind] = int(value)
+    return stats
+
+
+class SWRCache(object):
+    """
+    name: 缓存名称,用于统计
+    key_format: 缓存key的格式,如'index_section_%s'
+    fresh_ttl: 软过期时间(秒),超过后重新生成,生成完成前继续返回旧数据
+    stale_ttl: 软过期后旧数据最多保留的时间(秒)
+    """
+
+    def __init__(self, name, key_format, fresh_ttl, stale_ttl):
+        self.name = name
+        self.key_format = key_format
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+
+    def jitter(self, ttl):
+        """随机抖动过期时间"""
+        spread = settings.CACHE_TTL_JITTER
+        return ttl * random.uniform(1 - spread, 1 + spread)
+
+    def get_many(self, names, build, versions=None, conn=None):
+        """
+        读取多条缓存,build(需要生成的名称列表)返回{名称: 数据}
+        versions为{名称: 当前版本},缓存的版本与当前版本不一致时视为过期
+        """
+        conn = conn or get_redis_connection('default')
+        versions = versions or {}
+        keys = [self.key_format % name for name in names]
+        cached = conn.mget(keys) if keys else []
+
+        now = time.time()
+        result = {}
+        stale = []
+        missing = []
+        for name, entry in zip(names, cached):
+            if entry is None:
+                missing.append(name)
+                continue
+            entry = json.loads(entry.decode())
+            result[name] = entry['data']
+            if entry['version'] != int(versions.get(name, 0)) or entry['fresh_until'] < now:
+                stale.append(name)
+
+        stats = defaultdict(int)
+        stats['hit'] = len(result) - len(stale)
+        stats['miss'] = len(missing)
+
+        # 每条缓存同一时间只有一个请求重新生成
+        locks = {}
+        for name in stale + missing:
+            lock = conn.lock(self.key_format % name + '_lock', timeout=settings.CACHE_REBUILD_LOCK_TIMEOUT)
+            if lock.acquire(blocking=False):
+                locks[name] = lock
+
+        try:
+            # 已过期但有旧数据的,拿不到锁时直接返回旧数据
+            stats['stale'] = len([name for name in stale if name not in locks])
+            # 没有数据又拿不到锁的,等待其他请求生成
+            waiting = [name for name in missing if name not in locks]
+            if waiting:
+                stats['wait'] = len(waiting)
+                result.update(self.wait(conn, waiting))
+
+            rebuild = [name for name in stale + missing if name in locks or name not in result]
+            if rebuild:
+                stats['rebuild'] = len(rebuild)
+                built = build(rebuild)
+                self.set_many(conn, built, versions)
+                result.update(built)
+        finally:
+            for lock in locks.values():
+                try:
+                    lock.release()
+                except LockError:
+                    # 生成时间超过了锁的有效期
+                    pass
+
+        pipe = conn.pipeline()
+        for kind, count in stats.items():
+            if count:
+                pipe.hincrby(CACHE_STATS_KEY, '%s:%s' % (self.name, kind), count)
+        pipe.execute()
+        return result
+
+    def wait(self, conn, names):
+        """等待其他请求生成缓存,返回等待期间生成的{名称: 数据}"""
+        result = {}
+        keys = dict((name, self.key_format % name) for name in names)
+        deadline = time.time() + settings.CACHE_REBUILD_WAIT
+        while keys and time.time() < deadline:
+            time.sleep(0.05)
+            for name, entry in zip(list(keys), conn.mget(list(keys.values()))):
+                if entry is not None:
+                    result[name] = json.loads(entry.decode())['data']
+                    del keys[name]
+        return result
+
+    def set_many(self, conn, data, versions=None):
+        """写入多条缓存"""
+        versions = versions or {}
+        now = time.time()
+        pipe = conn.pipeline()
+        for name, value in data.items():
+            entry = {
+                'data': value,
+                'version': int(versions.get(name, 0)),
+                'fresh_until': now + self.jitter(self.fresh_ttl),
+            }
+            pipe.set(self.key_format % name, json.dumps(entry), ex=int(self.jitter(self.fresh_ttl + self.stale_ttl)))
+        pipe.execute()
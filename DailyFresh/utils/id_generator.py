@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+
+from DailyFresh.DailyFresh import settings
+
+"""
+按时间有序、进程内唯一的id生成器,不需要访问数据库或redis
+id格式(固定30位数字): UTC年月日时分秒(14位) + 毫秒(3位) + 进程编号(9位) + 毫秒内序号(4位)
+    使用UTC时间,服务器时区有夏令时的情况下,时钟回拨一小时时id也不会倒退
+固定长度的数字字符串按字典序排列即按生成时间排列,可以直接作为排序字段
+进程编号 = 服务器编号(2位) + 进程pid(7位,linux的pid_max最大为4194304):
+    同一台服务器上同时运行的进程pid各不相同,fork出的uwsgi、celery子进程也会重新获取,
+    服务器编号通过settings.ORDER_ID_SERVER_ID或环境变量DF_SERVER_ID指定,多台服务器部署时每台需要不同的编号
+    编号超出位数时抛出异常,不会截断后与其他进程重复
+"""
+
+SERVER_DIGITS = 2
+PID_DIGITS = 7
+WORKER_DIGITS = SERVER_DIGITS + PID_DIGITS
+SEQUENCE_DIGITS = 4
+MAX_SERVER = 10 ** SERVER_DIGITS
+MAX_PID = 10 ** PID_DIGITS
+MAX_WORKER = 10 ** WORKER_DIGITS
+MAX_SEQUENCE = 10 ** SEQUENCE_DIGITS
+
+
+def worker_number(server_id, pid):
+    """服务器编号和进程pid组成的进程编号,超出位数时抛出ValueError"""
+    server_id = int(server_id)
+    if not 0 <= server_id < MAX_SERVER:
+        raise ValueError('服务器编号超出范围(0~%d): %d' % (MAX_SERVER - 1, server_id))
+    if not 0 <= pid < MAX_PID:
+        raise ValueError('进程pid超出范围(0~%d): %d' % (MAX_PID - 1, pid))
+    return server_id * MAX_PID + pid
+
+
+class IdGenerator(object):
+    """id生成器,worker_id为完整的进程编号,不指定时使用服务器编号和进程pid"""
+
+    def __init__(self, worker_id=None, server_id=None):
+        self.worker_id = worker_id
+        self.server_id = server_id
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        worker_id = self.worker_id
+        if worker_id is None:
+            server_id = self.server_id
+            if server_id is None:
+                server_id = os.environ.get('DF_SERVER_ID', 0)
+            worker_id = worker_number(server_id, self.pid)
+        elif not 0 <= worker_id < MAX_WORKER:
+            raise ValueError('进程编号超出范围(0~%d): %d' % (MAX_WORKER - 1, worker_id))
+        self.worker = '%0*d' % (WORKER_DIGITS, worker_id)
+        self.last_ms = 0
+        self.sequence = 0
+        self.second = None
+        self.second_str = ''
+
+    def next_id(self):
+        with self.lock:
+            # fork出的子进程重新获取进程编号
+            if os.getpid() != self.pid:
+                self.reset()
+
+            now_ms = int(time.time() * 1000)
+            if now_ms > self.last_ms:
+                self.last_ms = now_ms
+                self.sequence = 0
+            else:
+                # 同一毫秒内或时钟回拨,沿用上一次的时间继续递增序号,
+                # 序号用完后借用下一毫秒,保证id唯一且递增
+                self.sequence += 1
+                if self.sequence >= MAX_SEQUENCE:
+                    self.last_ms += 1
+                    self.sequence = 0
+            ms = self.last_ms
+            sequence = self.sequence
+
+            second = ms // 1000
+            if second != self.second:
+                self.second = second
+                self.second_str = time.strftime('%Y%m%d%H%M%S', time.gmtime(second))
+            return '%s%03d%s%0*d' % (self.second_str, ms % 1000, self.worker, SEQUENCE_DIGITS, sequence)
+
+
+# 每个进程一个生成器,fork后在子进程中自动重新获取进程编号
+_generator = IdGenerator(server_id=settings.ORDER_ID_SERVER_ID)
+
+
+def next_id():
+    """生成一个新的id"""
+    return _generator.next_id()
@@ -0,0 +1,93 @@
+import hashlib
+import json
+
+from django.http import HttpResponse, JsonResponse
+from django_redis import get_redis_connection
+
+from DailyFresh.DailyFresh import settings
+
+"""
+接口幂等
+POST请求通过Idempotency-Key请求头或idempotency_key参数携带幂等key,
+同一用户对同一接口使用同一key的请求只处理一次,成功的处理结果在redis中保存IDEMPOTENCY_KEY_TTL秒
+(视图可以通过idempotency_ttl缩短),业务失败的结果不保存,客户端可以使用同一key重试,
+处理中的标记只保存IDEMPOTENCY_PENDING_TTL秒,处理请求的进程被杀死时不会长时间阻止重试,
+重复的请求直接返回第一次的结果,不再访问数据库
+idem_接口路径_用户id_key的摘要: 处理中为pending, 处理完成后为json格式的响应
+idempotency_stats: 统计信息 {接口路径:first 首次请求数, 接口路径:replayed 返回已保存结果的重复请求数,
+                             接口路径:in_flight 第一次请求尚未处理完成时到达的重复请求数}
+"""
+
+IDEMPOTENCY_KEY = 'idem_%s_%d_%s'
+IDEMPOTENCY_STATS_KEY = 'idempotency_stats'
+PENDING = b'pending'
+
+
+def get_idempotency_stats(conn=None):
+    """获取各接口的幂等统计信息"""
+    conn = conn or get_redis_connection('default')
+    stats = {}
+    for field, value in conn.hgetall(IDEMPOTENCY_STATS_KEY).items():
+        path, kind = field.decode().rsplit(':', 1)
+        stats.setdefault(path, {'first': 0, 'replayed': 0, 'in_flight': 0})[kind] = int(value)
+    return stats
+
+
+class IdempotentMixin(object):
+    """为POST接口提供幂等处理,需要放在View之前"""
+    # 需要保存的成功结果的res,其他结果不保存
+    idempotency_success_res = ()
+    # 成功结果的保存时间(秒),为None时使用settings.IDEMPOTENCY_KEY_TTL
+    idempotency_ttl = None
+
+    def is_idempotent_success(self, response):
+        """响应是否为需要保存的成功结果"""
+        if response.status_code >= 400 or getattr(response, 'streaming', False):
+            return False
+        try:
+            return json.loads(response.content.decode()).get('res') in self.idempotency_success_res
+        except (ValueError, AttributeError):
+            return False
+
+    def dispatch(self, request, *args, **kwargs):
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY') or request.POST.get('idempotency_key')
+        if request.method != 'POST' or not key or not request.user.is_authenticated:
+            return super(IdempotentMixin, self).dispatch(request, *args, **kwargs)
+
+        conn = get_redis_connection('default')
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        redis_key = IDEMPOTENCY_KEY % (request.path, request.user.id, digest)
+
+        if not conn.set(redis_key, PENDING, nx=True, ex=settings.IDEMPOTENCY_PENDING_TTL):
+            stored = conn.get(redis_key)
+            if stored is None or stored == PENDING:
+                # 第一次请求仍在处理中
+                conn.hincrby(IDEMPOTENCY_STATS_KEY, '%s:in_flight' % request.path)
+                return JsonResponse({'res': 9, 'error_msg': '请求正在处理中,请勿重复提交'})
+            conn.hincrby(IDEMPOTENCY_STATS_KEY, '%s:replayed' % request.path)
+            stored = json.loads(stored.decode())
+            response = HttpResponse(stored['body'], status=stored['status'], content_type=stored['content_type'])
+            response['Idempotent-Replayed'] = 'true'
+            return response
+
+        conn.hincrby(IDEMPOTENCY_STATS_KEY, '%s:first' % request.path)
+        try:
+            response = super(IdempotentMixin, self).dispatch(request, *args, **kwargs)
+        except BaseException:
+            # 视图抛出异常时删除处理中的标记,允许客户端重试
+            conn.delete(redis_key)
+            raise
+
+        # 错误和业务失败不保存,允许客户端重试
+        if not self.is_idempotent_success(response):
+            conn.delete(redis_key)
+            return response
+
+        stored = {
+            'status': response.status_code,
+            'content_type': response['Content-Type'],
+            'body': response.content.decode(),
+        }
+        # 只有保存最终结果时使用较长的有效时间
+        conn.set(redis_key, json.dumps(stored), ex=self.idempotency_ttl or settings.IDEMPOTENCY_KEY_TTL)
+        return response
@@ -0,0 +1,77 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from DailyFresh.utils import id_generator
+from DailyFresh.utils.id_generator import IdGenerator, MAX_SEQUENCE, worker_number
+
+
+class FakeClock(object):
+    """替代time.time,返回设置的时间"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class IdGeneratorTest(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(1600000000.123)
+        patcher = mock.patch.object(id_generator.time, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.generator = IdGenerator(server_id=1)
+
+    def test_worker_number(self):
+        self.assertEqual(worker_number(1, 12345), 10012345)
+        self.assertEqual(worker_number('99', 9999999), 999999999)
+        with self.assertRaises(ValueError):
+            worker_number(100, 1)
+        with self.assertRaises(ValueError):
+            worker_number(-1, 1)
+        with self.assertRaises(ValueError):
+            worker_number(1, 10000000)
+        with self.assertRaises(ValueError):
+            IdGenerator(worker_id=10 ** 9)
+
+    def test_format(self):
+        order_id = self.generator.next_id()
+        self.assertEqual(len(order_id), 30)
+        self.assertTrue(order_id.isdigit())
+        # UTC时间
+        self.assertTrue(order_id.startswith('20200913122640123'))
+        self.assertEqual(order_id[17:26], '%02d%07d' % (1, self.generator.pid))
+
+    def test_same_millisecond(self):
+        ids = [self.generator.next_id() for _ in range(5)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(ids[-1][-4:], '0004')
+
+    def test_sequence_overflow(self):
+        # 序号用完后借用下一毫秒
+        ids = [self.generator.next_id() for _ in range(MAX_SEQUENCE + 1)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(ids[-1][14:17], '124')
+        self.assertEqual(ids[-1][-4:], '0000')
+        # 时间追上借用的毫秒后仍然递增
+        self.clock.now = 1600000000.124
+        self.assertGreater(self.generator.next_id(), ids[-1])
+
+    def test_clock_rollback(self):
+        first = self.generator.next_id()
+        self.clock.now -= 3600
+        second = self.generator.next_id()
+        self.assertGreater(second, first)
+        self.assertEqual(second[:17], first[:17])
+
+    def test_fork(self):
+        first = self.generator.next_id()
+        with mock.patch.object(id_generator.os, 'getpid', return_value=54321):
+            second = self.generator.next_id()
+        self.assertEqual(second[17:26], '010054321')
+        # 新进程的序号重新开始
+        self.assertEqual(second[:17], first[:17])
+        self.assertEqual(second[-4:], '0000')